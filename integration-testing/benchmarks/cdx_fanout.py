@@ -0,0 +1,55 @@
+"""
+Times a large domain query through /mementos/cdx, unsharded and split into parallel key range shards,
+against a stub OutbackCDX loaded with integration-testing/test.cdx, and checks the results agree.
+
+The stub charges for every row it scans, and can do `--capacity` queries' worth of work at once, as a
+server with that many cores would. It also counts the rows it scans, so any extra upstream work shows.
+
+Run from the top-level folder:
+
+    $ python integration-testing/benchmarks/cdx_fanout.py --copies 25 --scan-cost 0.0002 --capacity 4
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+sys.path.insert(0, os.path.dirname(__file__))
+from stubs import outbackcdx, run_in_thread
+
+CDX_PORT = 18790
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--copies', type=int, default=25, help="Copies of the test captures to load, one per earlier year.")
+    parser.add_argument('--scan-cost', type=float, default=0.0002, help="Seconds per row scanned by the stub.")
+    parser.add_argument('--emit-cost', type=float, default=0.0, help="Seconds per row returned by the stub.")
+    parser.add_argument('--batch', type=int, default=50, help="Rows the stub scans at a time.")
+    parser.add_argument('--capacity', type=int, default=4, help="Number of queries the stub can work on at once.")
+    parser.add_argument('--url', default='http://bbci.co.uk/', help="URL to run the domain query for.")
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8], help="Shard counts to try.")
+    args = parser.parse_args()
+
+    cdx_file = os.path.join(os.path.dirname(__file__), '..', 'test.cdx')
+    stub = outbackcdx(cdx_file, copies=args.copies, scan_cost=args.scan_cost, emit_cost=args.emit_cost, batch=args.batch, capacity=args.capacity)
+    run_in_thread(stub, CDX_PORT)
+    os.environ['CDX_SERVER'] = 'http://127.0.0.1:%i/cdx' % CDX_PORT
+    os.environ.setdefault('CDX_CACHE_TYPE', 'none')
+
+    from fastapi.testclient import TestClient
+    from ukwa_api.main import app
+    from ukwa_api.mementos import shards
+
+    expected = None
+    with TestClient(app) as client:
+        for n in args.shards:
+            shards.CDX_SHARDS = n
+            stub.state.scanned = 0
+            start = time.perf_counter()
+            r = client.get('/mementos/cdx', params={'url': args.url, 'matchType': 'domain'})
+            elapsed = time.perf_counter() - start
+            rows = r.text.splitlines()
+            expected = expected if expected is not None else rows
+            print("%2i shard(s): %6i rows in %6.2f s (%8.0f rows/s), %6i rows scanned upstream, same results: %s" % (
+                n, len(rows), elapsed, len(rows) / elapsed, stub.state.scanned, rows == expected))
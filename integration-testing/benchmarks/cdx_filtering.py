@@ -0,0 +1,101 @@
+"""
+Runs the CDX filter/collapse stage over the captures in integration-testing/test.cdx, checking the
+results against a simple line-splitting reference implementation, and reporting rows/sec and how
+much less data would be sent to the client.
+
+Run from the top-level folder:
+
+    $ python integration-testing/benchmarks/cdx_filtering.py --rows 500000
+"""
+import os
+import re
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from ukwa_api.mementos.filters import CdxFilter
+from ukwa_api.mementos.formats import CDX11_FIELDS
+
+CASES = [
+    dict(filters=['mimetype:text/html']),
+    dict(filters=['!statuscode:200']),
+    dict(filters=['~original:bbc', '=mimetype:text/css']),
+    dict(dedup=True),
+    dict(collapse='timestamp:10'),
+    dict(collapse='timestamp:8', collapse_last=True),
+    dict(filters=['statuscode:2'], dedup=True, collapse='urlkey'),
+]
+
+
+def load_lines(rows):
+    cdx_file = os.path.join(os.path.dirname(__file__), '..', 'test.cdx')
+    with open(cdx_file, 'rb') as f:
+        lines = [line for line in f if line.strip() and not line.startswith(b' CDX')]
+    # Repeat the captures in earlier years, like recrawls, and put them in key order like query results:
+    copies = []
+    for i in range(rows // len(lines) + 1):
+        copies.extend(b'%s %04d%s' % (line[:line.index(b' ')], 2019 - i, line[line.index(b' ')+5:]) for line in lines)
+    return sorted(copies[:rows])
+
+
+def reference(lines, filters=(), dedup=False, collapse=None, collapse_last=False):
+    out = []
+    seen = set()
+    previous = None
+    for line in lines:
+        row = dict(zip(CDX11_FIELDS, line.decode('utf-8').split()))
+        keep = True
+        for spec in filters:
+            invert = spec.startswith('!')
+            spec = spec.lstrip('!')
+            op = spec[0] if spec[0] in '=~' else None
+            name, value = spec.lstrip('=~').split(':', 1)
+            if op == '=':
+                matched = row[name] == value
+            elif op == '~':
+                matched = value in row[name]
+            else:
+                matched = re.match(value, row[name]) is not None
+            keep = keep and matched != invert
+        if not keep:
+            continue
+        if dedup and row['digest'] != '-':
+            if (row['urlkey'], row['digest']) in seen:
+                continue
+            seen.add((row['urlkey'], row['digest']))
+        if collapse:
+            name, _, length = collapse.partition(':')
+            group = row[name][:int(length)] if length else row[name]
+            if group == previous:
+                if collapse_last:
+                    out[-1] = line
+                continue
+            previous = group
+        out.append(line)
+    return out
+
+
+def run(lines, **kwargs):
+    stage = CdxFilter(**kwargs)
+    out = []
+    for line in lines:
+        out.extend(stage.feed(line))
+    out.extend(stage.flush())
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500000, help="Number of CDX lines to run through each case.")
+    args = parser.parse_args()
+
+    lines = load_lines(args.rows)
+    size = sum(map(len, lines))
+    for case in CASES:
+        start = time.perf_counter()
+        out = run(lines, **case)
+        elapsed = time.perf_counter() - start
+        ok = out == reference(lines, **case)
+        print("%-80s %10.0f rows/s, %6.2f%% of bytes kept, matches reference: %s" % (
+            case, len(lines) / elapsed, 100 * sum(map(len, out)) / size, ok))
@@ -0,0 +1,87 @@
+"""
+Compares the old minidom-based CDX XML parsing with the incremental parser, over a synthetic response.
+
+Run from the top-level folder:
+
+    $ python integration-testing/benchmarks/cdx_parsing.py --captures 100000
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+import xml.dom.minidom
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from ukwa_api.cdx import CdxXmlParser
+from stubs import make_cdx_xml
+
+
+def synthetic_response(n):
+    captures = [
+        ('%014i' % (19950101000000 + i*100), 'BL-%05i.warc.gz' % (i // 1000), i*1000, 1000)
+        for i in range(n)
+    ]
+    return make_cdx_xml(captures).encode('utf-8')
+
+
+def chunked(data, size=64*1024):
+    for i in range(0, len(data), size):
+        yield data[i:i+size]
+
+
+def parse_with_minidom(data):
+    # As list_from_cdx used to do it:
+    result_set = OrderedDict()
+    dom = xml.dom.minidom.parseString(data)
+    for result in dom.getElementsByTagName('result'):
+        warc_file = result.getElementsByTagName('file')[0].firstChild.nodeValue
+        compressed_offset = result.getElementsByTagName('compressedoffset')[0].firstChild.nodeValue
+        capture_date = result.getElementsByTagName('capturedate')[0].firstChild.nodeValue
+        compressed_end_offset_elem = result.getElementsByTagName('compressedendoffset')
+        if len(compressed_end_offset_elem) > 0:
+            compressed_end_offset = compressed_end_offset_elem[0].firstChild.nodeValue
+        else:
+            compressed_end_offset = None
+        result_set[capture_date] = warc_file, compressed_offset, compressed_end_offset
+    return len(result_set)
+
+
+def parse_incrementally(data):
+    # Streaming, keeping only a count, to show the parser's own memory use:
+    parser = CdxXmlParser()
+    count = 0
+    for chunk in chunked(data):
+        for capture in parser.feed(chunk):
+            count += 1
+    for capture in parser.close():
+        count += 1
+    return count
+
+
+def measure(label, fn, data):
+    # Run in a forked child, so the growth in peak RSS can be attributed to the parsing
+    # (this includes memory allocated by libxml2, which tracemalloc can't see):
+    pid = os.fork()
+    if pid == 0:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        count = fn(data)
+        elapsed = time.perf_counter() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+        print("%-12s %7i captures %8.3fs %10.0f captures/s peak RSS growth %8.1f MB" % (
+            label, count, elapsed, count / elapsed, peak / 1024), flush=True)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--captures', type=int, default=100000, help="Number of captures in the synthetic response.")
+    args = parser.parse_args()
+
+    data = synthetic_response(args.captures)
+    print("Response size: %.1f MB" % (len(data) / 1024 / 1024))
+    measure('minidom', parse_with_minidom, data)
+    measure('incremental', parse_incrementally, data)
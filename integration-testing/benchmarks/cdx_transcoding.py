@@ -0,0 +1,45 @@
+"""
+Measures the throughput of the CDX11 transcoder for each output format, in rows/sec, along with
+the batch parser against splitting lines one at a time.
+
+Run from the top-level folder:
+
+    $ python integration-testing/benchmarks/cdx_transcoding.py --rows 500000
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from ukwa_api.mementos.formats import parse_rows, transcode, MEDIA_TYPES, CDX_TRANSCODE_BATCH_ROWS
+
+
+def load_lines(rows):
+    cdx_file = os.path.join(os.path.dirname(__file__), '..', 'test.cdx')
+    with open(cdx_file, 'rb') as f:
+        lines = [line for line in f if line.strip() and not line.startswith(b' CDX')]
+    return (lines * (rows // len(lines) + 1))[:rows]
+
+
+def timed(label, fn, rows):
+    start = time.perf_counter()
+    size = fn()
+    elapsed = time.perf_counter() - start
+    print("%-24s %12.0f rows/s %s" % (label, rows / elapsed, "%10.1f MB" % (size / 1024 / 1024) if size else ""))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=500000, help="Number of CDX lines to transcode.")
+    args = parser.parse_args()
+
+    lines = load_lines(args.rows)
+    timed('parse, line by line', lambda: [line.decode('utf-8').split(' ') for line in lines] and None, args.rows)
+    timed('parse, in batches', lambda: [parse_rows(lines[i:i+CDX_TRANSCODE_BATCH_ROWS])
+        for i in range(0, len(lines), CDX_TRANSCODE_BATCH_ROWS)] and None, args.rows)
+    for output in MEDIA_TYPES:
+        try:
+            timed('output=%s' % output, lambda: sum(len(chunk) for chunk in transcode(lines, output)), args.rows)
+        except ImportError as e:
+            print("%-24s skipped (%s)" % ('output=%s' % output, e))
@@ -0,0 +1,77 @@
+"""
+Compares the old linear, strptime-per-capture closest-match resolution with the binary search
+over a CaptureIndex, and the memory used by each representation.
+
+Run from the top-level folder:
+
+    $ python integration-testing/benchmarks/closest_match.py --captures 100000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from ukwa_api.cdx import WAYBACK_TS_FORMAT
+from ukwa_api.captures import CaptureIndex
+
+
+def synthetic_matches(n):
+    start = datetime.datetime(1995, 1, 1)
+    matches = OrderedDict()
+    for i in range(n):
+        ts = (start + datetime.timedelta(hours=i*7, seconds=i)).strftime(WAYBACK_TS_FORMAT)
+        matches[ts] = ('BL-%05i.warc.gz' % (i // 1000), str(i*1000), '1000')
+    return matches
+
+
+def linear_match(matches, target_date):
+    # As lookup_in_cdx used to do it (minus the debug logging):
+    target_dt = datetime.datetime.strptime(target_date, WAYBACK_TS_FORMAT)
+    matched_date = None
+    matched_ts = None
+    for ts in matches:
+        wb_date = datetime.datetime.strptime(ts, WAYBACK_TS_FORMAT)
+        if matched_date is None or abs((wb_date-target_dt).total_seconds()) < \
+                abs((matched_date-target_dt).total_seconds()):
+            matched_date = wb_date
+            matched_ts = ts
+    return matches[matched_ts]
+
+
+def dict_nbytes(matches):
+    # The dictionary, plus its keys, value tuples and the strings in them:
+    size = sys.getsizeof(matches)
+    for ts, value in matches.items():
+        size += sys.getsizeof(ts) + sys.getsizeof(value) + sum(sys.getsizeof(v) for v in value)
+    return size
+
+
+def timed(label, fn, targets):
+    start = time.perf_counter()
+    results = [fn(target) for target in targets]
+    elapsed = time.perf_counter() - start
+    print("%-28s %10.3f ms/lookup" % (label, elapsed * 1000 / len(targets)))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--captures', type=int, default=100000, help="Number of captures to search.")
+    parser.add_argument('--lookups', type=int, default=20, help="Number of lookups to time.")
+    args = parser.parse_args()
+
+    matches = synthetic_matches(args.captures)
+    captures = CaptureIndex((ts, *value) for ts, value in matches.items())
+    timestamps = list(matches)
+    targets = [random.choice(timestamps)[:10] + '%02i%02i' % (random.randint(0, 59), random.randint(0, 59)) for i in range(args.lookups)]
+
+    old = timed('linear scan', lambda t: linear_match(matches, t), targets)
+    new = timed('CaptureIndex bisect', lambda t: captures.record(captures.closest(t)), targets)
+    print("Results agree: %s" % (old == [(f, str(o), str(l)) for (f, o, l) in new]))
+    print("Memory: dict %.1f MB, CaptureIndex %.1f MB (%.0f vs %.0f bytes per capture)" % (
+        dict_nbytes(matches) / 1024 / 1024, captures.nbytes() / 1024 / 1024,
+        dict_nbytes(matches) / len(matches), captures.nbytes() / len(captures)))
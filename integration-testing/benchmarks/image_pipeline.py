@@ -0,0 +1,130 @@
+"""
+Makes JPEGs from synthetic tall screenshots (e.g. 1366x20000 pixels), calling the image functions in
+screenshots.py directly on the event loop, and then via the process pool with different numbers of
+processes, reporting the throughput, the throughput per process, and the longest the event loop was
+held up for.
+
+Run from the top-level folder:
+
+    $ python integration-testing/benchmarks/image_pipeline.py --jobs 24 --processes 1 2 4
+"""
+import io
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+
+from PIL import Image, ImageDraw
+
+
+def make_screenshot(width, height, seed):
+    # Blocks of 'text', images and plain background, with a transparent corner, like a rendered web page:
+    rng = random.Random(seed)
+    img = Image.new('RGBA', (width, height), (255, 255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    y = 0
+    while y < height:
+        block = rng.randint(80, 600)
+        if rng.random() < 0.3:
+            colour = tuple(rng.randint(0, 255) for i in range(3))
+            draw.rectangle((40, y, width - 40, y + block), fill=colour + (255,))
+        else:
+            for line in range(y, y + block, 18):
+                x = 40
+                while x < width - 80:
+                    word = rng.randint(10, 70)
+                    draw.rectangle((x, line, x + word, line + 10), fill=(30, 30, 30, 255))
+                    x += word + 8
+        y += block + 20
+    draw.rectangle((0, 0, 200, 60), fill=(0, 0, 0, 0))
+    out = io.BytesIO()
+    img.save(out, 'PNG')
+    return out.getvalue()
+
+
+async def loop_lag(stop):
+    # Measures the longest the event loop was held up for:
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.005)
+        worst = max(worst, time.perf_counter() - start - 0.005)
+    return worst
+
+
+async def measure(work, screenshots, jobs, concurrency):
+    stop = asyncio.Event()
+    lag = asyncio.ensure_future(loop_lag(stop))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            return await work(screenshots[i % len(screenshots)])
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[one(i) for i in range(jobs)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    return elapsed, await lag, results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=24, help="Number of images to process in each run.")
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4], help="Process pool sizes to try.")
+    parser.add_argument('--sizes', nargs='+', default=['1366x20000', '1366x8000', '1280x3000'], help="Screenshot sizes.")
+    args = parser.parse_args()
+
+    from ukwa_api import screenshots
+
+    print("Making screenshots...")
+    images = [make_screenshot(*map(int, size.split('x')), seed=n) for n, size in enumerate(args.sizes)]
+    print("%s, %.1f MB of PNG, on %i CPUs" % (', '.join(args.sizes), sum(map(len, images)) / 1024 / 1024, os.cpu_count()))
+
+    async def inline_full(png):
+        return screenshots.full_and_thumb_jpegs(png)
+
+    async def inline_crop(png):
+        return screenshots.full_and_thumb_jpegs(png, crop=True)
+
+    async def pooled_full(png):
+        return await screenshots.full_and_thumb_jpegs_async(png)
+
+    async def pooled_crop(png):
+        return await screenshots.full_and_thumb_jpegs_async(png, crop=True)
+
+    async def pooled_thumb(png):
+        return await screenshots.thumb_jpeg_async(png, crop=True)
+
+    async def main():
+        # Same results whichever way they're made:
+        expected = [screenshots.full_and_thumb_jpegs(png) for png in images]
+        print("%-26s %8s %10s %13s %13s" % ('', 'jobs/s', 'src MPix/s', 'jobs/s/proc', 'max lag (s)'))
+        pixels = sum(w * h for w, h in map(screenshots.image_size, images)) / len(images)
+
+        runs = [('inline full+thumb', inline_full, None), ('inline cropped', inline_crop, None)]
+        for processes in args.processes:
+            runs += [
+                ('pool(%i) full+thumb' % processes, pooled_full, processes),
+                ('pool(%i) cropped' % processes, pooled_crop, processes),
+                ('pool(%i) cropped thumb' % processes, pooled_thumb, processes),
+            ]
+        for name, work, processes in runs:
+            if processes is not None and processes != screenshots.IMAGE_PROCESSES:
+                screenshots.close_pool()
+                screenshots.IMAGE_PROCESSES = processes
+            if processes is not None:
+                # Start the processes before timing anything:
+                await screenshots.run_image_job(1, screenshots.image_size, images[-1])
+            elapsed, lag, results = await measure(work, images, args.jobs, 2 * (processes or 1))
+            if work is pooled_full:
+                assert all(result == expected[i % len(images)] for i, result in enumerate(results))
+            print("%-26s %8.2f %10.1f %13.2f %13.3f" % (name, args.jobs / elapsed, args.jobs * pixels / elapsed / 1e6,
+                args.jobs / elapsed / (processes or 1), lag))
+        screenshots.close_pool()
+
+    asyncio.run(main())
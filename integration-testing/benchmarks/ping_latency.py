@@ -0,0 +1,75 @@
+"""
+Measures /ping latency while /mementos/warc calls hang on a slow local back-end.
+
+If any route blocks the event loop, /ping latency rises to match the back-end delay.
+With non-blocking back-end calls it should stay flat.
+
+Run from the top-level folder:
+
+    $ python integration-testing/benchmarks/ping_latency.py --delay 2 --concurrency 20
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+import httpx
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from stubs import slow_backend, run_in_thread
+
+STUB_PORT = 18765
+API_PORT = 18766
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values) * p / 100))]
+
+
+async def sample_ping(client, duration):
+    latencies = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        await client.get(f"http://127.0.0.1:{API_PORT}/ping")
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0.02)
+    return latencies
+
+
+async def fetch_warc(client):
+    r = await client.get(f"http://127.0.0.1:{API_PORT}/mementos/warc/20190101000000/http://example.org/")
+    return r.status_code
+
+
+async def run(args):
+    async with httpx.AsyncClient(timeout=60) as client:
+        idle = await sample_ping(client, 1.0)
+        warcs = [asyncio.create_task(fetch_warc(client)) for i in range(args.concurrency)]
+        loaded = await sample_ping(client, args.delay * 2)
+        statuses = await asyncio.gather(*warcs)
+    for label, latencies in (('idle', idle), ('under load', loaded)):
+        print("/ping %-10s n=%4i p50=%7.1fms p99=%7.1fms max=%7.1fms" % (
+            label, len(latencies),
+            statistics.median(latencies)*1000, percentile(latencies, 99)*1000, max(latencies)*1000))
+    print("/mementos/warc statuses: %s" % sorted(set(statuses)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--delay', type=float, default=2.0, help="Seconds each back-end call takes.")
+    parser.add_argument('--concurrency', type=int, default=20, help="Number of concurrent /mementos/warc calls.")
+    args = parser.parse_args()
+
+    # Point the API at the stub, before it gets imported:
+    os.environ['WAYBACK_SERVER'] = f"http://127.0.0.1:{STUB_PORT}/wayback/"
+    os.environ['CDX_SERVER'] = f"http://127.0.0.1:{STUB_PORT}/cdx"
+    os.environ['WEBHDFS_PREFIX'] = f"http://127.0.0.1:{STUB_PORT}/webhdfs/"
+    from ukwa_api.main import app
+
+    run_in_thread(slow_backend(args.delay), STUB_PORT)
+    run_in_thread(app, API_PORT)
+    asyncio.run(run(args))
@@ -0,0 +1,76 @@
+"""
+Makes many concurrent render_raw requests for the same screenshot, from several worker processes at
+once, against a slow stub webrender service, counting the renders it is asked to do.
+
+However many requests there are, there should only be one render, with the other requests in the same
+worker waiting for it, and those in other workers picking it up from the shared screenshot store.
+
+Run from the top-level folder:
+
+    $ python integration-testing/benchmarks/screenshot_renders.py --workers 4 --requests 20 --delay 2
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+sys.path.insert(0, os.path.dirname(__file__))
+from stubs import webrender, run_in_thread
+
+WEBRENDER_PORT = 18793
+PWID = 'urn:pwid:webarchive.org.uk:1995-04-18T15:56:00Z:page:http://portico.bl.uk/'
+
+
+def worker(requests, results):
+    # Each worker is a separate process, with its own copy of the API:
+    import httpx
+    from ukwa_api.main import app
+    from ukwa_api.screenshots import close_pool
+
+    async def main():
+        async with httpx.AsyncClient(app=app, base_url='http://api', timeout=60) as client:
+            responses = await asyncio.gather(*[
+                client.get('/iiif/render_raw', params={'pwid': PWID}) for i in range(requests)
+            ])
+        return [(r.status_code, r.content) for r in responses]
+
+    try:
+        results.put(asyncio.run(main()))
+    finally:
+        # The app's shutdown isn't run here, and the worker can't exit while the image processes are still going:
+        close_pool()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4, help="Number of worker processes.")
+    parser.add_argument('--requests', type=int, default=20, help="Number of concurrent requests from each worker.")
+    parser.add_argument('--delay', type=float, default=2.0, help="Time each render takes, in seconds.")
+    args = parser.parse_args()
+
+    stub = webrender(args.delay)
+    run_in_thread(stub, WEBRENDER_PORT)
+    os.environ['WEBRENDER_ARCHIVE_SERVER'] = 'http://127.0.0.1:%i/render' % WEBRENDER_PORT
+    os.environ['WAYBACK_SERVER'] = 'http://127.0.0.1:%i/wayback/' % WEBRENDER_PORT
+    os.environ['SCREENSHOT_CACHE_PATH'] = tempfile.mkdtemp(prefix='screenshot-renders-')
+
+    # Use fresh processes, so each picks up the settings above:
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    workers = [context.Process(target=worker, args=(args.requests, results)) for i in range(args.workers)]
+    start = time.perf_counter()
+    for p in workers:
+        p.start()
+    responses = [response for p in workers for response in results.get()]
+    elapsed = time.perf_counter() - start
+    for p in workers:
+        p.join()
+
+    ok = all(status_code == 200 for status_code, content in responses)
+    same = len(set(content for status_code, content in responses)) == 1
+    print("%i requests from %i workers: %i render(s), all OK: %s, all the same image: %s, in %.1fs"
+        % (len(responses), args.workers, stub.state.renders, ok, same, elapsed))
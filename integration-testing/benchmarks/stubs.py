@@ -0,0 +1,266 @@
+"""
+Local stand-ins for the back-end services, for benchmarking the API without the full Docker stack.
+
+Each stub is a small Starlette app that can be run in a background thread via run_in_thread().
+"""
+import io
+import os
+import time
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from warcio.warcwriter import WARCWriter
+from warcio.statusandheaders import StatusAndHeaders
+
+
+def make_warc_record(url='http://example.org/', payload=b'Hello, world!', content_type='text/html'):
+    """
+    Builds a single gzipped WARC response record.
+    """
+    out = io.BytesIO()
+    writer = WARCWriter(out, gzip=True)
+    http_headers = StatusAndHeaders('200 OK', [('Content-Type', content_type)], protocol='HTTP/1.1')
+    record = writer.create_warc_record(url, 'response', payload=io.BytesIO(payload), http_headers=http_headers)
+    writer.write_record(record)
+    return out.getvalue()
+
+
+def make_cdx_xml(captures):
+    """
+    Builds an OutbackCDX XML (type:urlquery) response for (timestamp, filename, offset, length) tuples.
+    """
+    results = "".join(
+        "<result><compressedoffset>%s</compressedoffset><compressedendoffset>%s</compressedendoffset>"
+        "<mimetype>text/html</mimetype><file>%s</file><redirecturl>-</redirecturl><urlkey>org,example)/</urlkey>"
+        "<digest>-</digest><httpresponsecode>200</httpresponsecode><robotflags>-</robotflags>"
+        "<url>http://example.org/</url><capturedate>%s</capturedate></result>" % (offset, length, filename, ts)
+        for (ts, filename, offset, length) in captures
+    )
+    return '<?xml version="1.0" encoding="UTF-8"?><wayback><request></request><results>%s</results></wayback>' % results
+
+
+def make_cdx11(captures):
+    """
+    Builds CDX11 lines for (timestamp, filename, offset, length) tuples.
+    """
+    return "".join(
+        "org,example)/ %s http://example.org/ text/html 200 - - - %s %s %s\n" % (ts, length, offset, filename)
+        for (ts, filename, offset, length) in captures
+    )
+
+
+def slow_backend(delay=2.0, record=None):
+    """
+    A stub Wayback, OutbackCDX and WebHDFS service where every call takes `delay` seconds.
+
+    Mount points: /wayback/..., /cdx, /webhdfs/...
+    """
+    record = record or make_warc_record()
+    captures = [('20190101000000', 'test.warc.gz', 0, len(record))]
+
+    async def wayback(request):
+        await asyncio.sleep(delay)
+        return Response("OK", media_type="text/html")
+
+    async def cdx_query(request):
+        await asyncio.sleep(delay)
+        if 'q' in request.query_params:
+            return Response(make_cdx_xml(captures), media_type="application/xml")
+        return Response(make_cdx11(captures), media_type="text/plain")
+
+    async def webhdfs(request):
+        await asyncio.sleep(delay)
+        offset = int(request.query_params.get('offset', 0))
+        length = int(request.query_params.get('length', len(record)))
+        return Response(record[offset:offset+length], media_type="application/octet-stream")
+
+    return Starlette(routes=[
+        Route('/wayback/{path:path}', wayback),
+        Route('/cdx', cdx_query),
+        Route('/webhdfs/{path:path}', webhdfs),
+    ])
+
+
+def surt_key(url):
+    """
+    A simplified SURT canonicalisation, enough for the stub, e.g. http://www.bl.uk/about -> uk,bl)/about
+    """
+    parts = urlsplit(url if '://' in url else 'http://' + url)
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    return ','.join(reversed(host.split('.'))) + ')' + path.lower()
+
+
+def outbackcdx(cdx_file, copies=1, scan_cost=0.0, emit_cost=0.0, batch=500, capacity=1):
+    """
+    A stub OutbackCDX, serving CDX11 query results from a CDX file, e.g. integration-testing/test.cdx.
+
+    `copies` makes the index bigger by repeating the captures in earlier years. To stand in for the real
+    thing, each row in the queried key range costs `scan_cost` seconds, whether or not it is within the
+    from/to dates (which are a filter over the scan, as in OutbackCDX), and each row returned costs a
+    further `emit_cost` seconds. Like a real server, it can only do `capacity` queries' worth of work at
+    once, so concurrent queries slow each other down rather than all getting the work done for free.
+
+    The number of rows scanned is kept in the app's `state.scanned`.
+
+    Supports url, matchType (including range, from the given urlkey to the end of the index), urlkey,
+    sort (default/reverse), limit, from and to.
+    """
+    lines = []
+    with open(cdx_file) as f:
+        for line in f:
+            if line.strip() and not line.startswith(' CDX'):
+                lines.append(line)
+    rows = []
+    for i in range(copies):
+        for line in lines:
+            urlkey, ts, rest = line.split(' ', 2)
+            ts = '%04d%s' % (int(ts[:4]) - i, ts[4:])
+            rows.append((urlkey, ts, '%s %s %s' % (urlkey, ts, rest)))
+    rows.sort()
+
+    def matches(urlkey, key, match_type):
+        if match_type == 'domain':
+            host = key.split(')', 1)[0]
+            return urlkey.startswith(host + ')') or urlkey.startswith(host + ',')
+        if match_type == 'host':
+            return urlkey.startswith(key.split(')', 1)[0] + ')')
+        if match_type == 'prefix':
+            return urlkey.startswith(key)
+        if match_type == 'range':
+            return urlkey >= key
+        return urlkey == key
+
+    server = asyncio.Semaphore(capacity)
+
+    async def work(seconds):
+        if seconds:
+            async with server:
+                await asyncio.sleep(seconds)
+
+    async def query(request):
+        q = request.query_params
+        match_type = q.get('matchType', 'exact')
+        key = q['urlkey'] if match_type == 'range' else surt_key(q['url'])
+        start = q.get('from', '').ljust(14, '0')
+        end = q.get('to', '').ljust(14, '9')
+        limit = int(q['limit']) if 'limit' in q else None
+        selected = [row for row in rows if matches(row[0], key, match_type)]
+        if q.get('sort') == 'reverse':
+            selected.reverse()
+
+        async def results():
+            emitted = 0
+            pending = []
+            for n, (urlkey, ts, line) in enumerate(selected):
+                if n % batch == 0:
+                    await work(scan_cost * min(batch, len(selected) - n))
+                    app.state.scanned += min(batch, len(selected) - n)
+                if not (start <= ts <= end):
+                    continue
+                pending.append(line)
+                emitted += 1
+                if len(pending) >= batch or emitted == limit:
+                    await work(emit_cost * len(pending))
+                    yield ''.join(pending)
+                    pending = []
+                if emitted == limit:
+                    return
+            await work(emit_cost * len(pending))
+            yield ''.join(pending)
+
+        return StreamingResponse(results(), media_type="text/plain")
+
+    app = Starlette(routes=[Route('/cdx', query)])
+    app.state.scanned = 0
+    return app
+
+
+def webhdfs(folder, latency=0.0):
+    """
+    A stub WebHDFS, serving byte ranges (op=OPEN with offset and length) of the files in a folder,
+    and also serving them as plain files, with support for Range headers.
+
+    Mount points: /webhdfs/..., /files/...
+
+    Each call takes `latency` seconds, and the number of calls made is kept in the app's `state.reads`.
+    """
+    def read(name, offset, length):
+        path = os.path.join(folder, os.path.basename(name))
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read() if length is None else f.read(length)
+
+    async def open_file(request):
+        await asyncio.sleep(latency)
+        request.app.state.reads += 1
+        offset = int(request.query_params.get('offset', 0))
+        length = int(request.query_params['length']) if 'length' in request.query_params else None
+        data = read(request.path_params['path'], offset, length)
+        if data is None:
+            return Response("File not found.", status_code=404)
+        return Response(data, media_type="application/octet-stream")
+
+    async def get_file(request):
+        await asyncio.sleep(latency)
+        request.app.state.reads += 1
+        first, _, last = request.headers.get('Range', 'bytes=0-').partition('=')[2].partition('-')
+        first = int(first)
+        data = read(request.path_params['path'], first, int(last) - first + 1 if last else None)
+        if data is None:
+            return Response("File not found.", status_code=404)
+        size = os.path.getsize(os.path.join(folder, os.path.basename(request.path_params['path'])))
+        return Response(data, status_code=206, media_type="application/octet-stream",
+            headers={'Content-Range': 'bytes %i-%i/%i' % (first, first + len(data) - 1, size)})
+
+    app = Starlette(routes=[Route('/webhdfs/{path:path}', open_file), Route('/files/{path:path}', get_file)])
+    app.state.reads = 0
+    return app
+
+
+def webrender(delay=2.0, size=(1280, 960)):
+    """
+    A stub webrender service, where every render takes `delay` seconds and returns the same PNG,
+    and an always-allowing Wayback for the access checks.
+
+    Mount points: /render, /wayback/...
+
+    The number of renders made is kept in the app's `state.renders`.
+    """
+    from PIL import Image
+    out = io.BytesIO()
+    Image.new('RGB', size, (200, 220, 240)).save(out, 'PNG')
+    image = out.getvalue()
+
+    async def render(request):
+        request.app.state.renders += 1
+        await asyncio.sleep(delay)
+        return Response(image, media_type="image/png")
+
+    async def wayback(request):
+        return Response("OK", media_type="text/html")
+
+    app = Starlette(routes=[Route('/render', render), Route('/wayback/{path:path}', wayback)])
+    app.state.renders = 0
+    return app
+
+
+def run_in_thread(app, port):
+    """
+    Runs an ASGI app on localhost:port in a daemon thread, returning once it is accepting requests.
+    """
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
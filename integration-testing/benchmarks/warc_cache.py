@@ -0,0 +1,90 @@
+"""
+Reads many small adjacent WARC records (like screenshot records) from a stub WebHDFS, directly and
+through the block cache, counting the calls to WebHDFS and checking the records come back intact.
+
+Run from the top-level folder:
+
+    $ python integration-testing/benchmarks/warc_cache.py --records 2000 --latency 0.005
+"""
+import io
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+sys.path.insert(0, os.path.dirname(__file__))
+from stubs import webhdfs, run_in_thread, make_warc_record
+
+WEBHDFS_PORT = 18791
+
+
+def make_warc(folder, records, size):
+    # Writes a WARC file of records with random payloads, returning the (offset, length) of each:
+    locations = []
+    with open(os.path.join(folder, 'test.warc.gz'), 'wb') as f:
+        for i in range(records):
+            record = make_warc_record('http://example.org/%i' % i, os.urandom(size), 'image/png')
+            locations.append((f.tell(), len(record)))
+            f.write(record)
+    return locations
+
+
+async def read_all(locations, concurrency):
+    from ukwa_api.cdx import open_warc_record_async
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def read(offset, length):
+        async with semaphore:
+            r = await open_warc_record_async('test.warc.gz', offset, length)
+            try:
+                return await r.aread()
+            finally:
+                await r.aclose()
+
+    return await asyncio.gather(*[read(*location) for location in locations])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=2000, help="Number of records to read.")
+    parser.add_argument('--size', type=int, default=20000, help="Payload size of each record.")
+    parser.add_argument('--latency', type=float, default=0.005, help="Seconds per call to the stub WebHDFS.")
+    parser.add_argument('--concurrency', type=int, default=20, help="Number of records to read at once.")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    locations = make_warc(folder, args.records, args.size)
+    with open(os.path.join(folder, 'test.warc.gz'), 'rb') as f:
+        data = f.read()
+    stub = webhdfs(folder, latency=args.latency)
+    run_in_thread(stub, WEBHDFS_PORT)
+    os.environ['WEBHDFS_PREFIX'] = 'http://127.0.0.1:%i/webhdfs/' % WEBHDFS_PORT
+    os.environ['WARC_CACHE_PATH'] = os.path.join(folder, 'warc_cache.sqlite')
+
+    from ukwa_api import cdx
+    from ukwa_api.warc_cache import WarcBlockCache, create_backend
+    from ukwa_api.warc_storage import warc_storage
+
+    async def main():
+        cases = [
+            ('direct', WarcBlockCache(create_backend('none'), warc_storage, max_read=0)),
+            ('coalesced, no cache', WarcBlockCache(create_backend('none'), warc_storage)),
+            ('cached, cold', WarcBlockCache(create_backend('sqlite'), warc_storage)),
+            ('cached, warm', None),
+        ]
+        for label, cache in cases:
+            cdx.warc_block_cache = cache or cdx.warc_block_cache
+            # Read in order, as a batch export or crawl-time screenshot sweep would, but with some jitter:
+            order = sorted(locations, key=lambda location: location[0] + random.randint(0, 4 * args.size))
+            stub.state.reads = 0
+            start = time.perf_counter()
+            records = await read_all(order, args.concurrency)
+            elapsed = time.perf_counter() - start
+            ok = all(record == data[offset:offset+length] for record, (offset, length) in zip(records, order))
+            print("%-20s %8.0f records/s, %6i WebHDFS calls, intact: %s" % (label, len(records) / elapsed, stub.state.reads, ok))
+
+    asyncio.run(main())
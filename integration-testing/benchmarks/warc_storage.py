@@ -0,0 +1,85 @@
+"""
+Reads every record listed in integration-testing/test.cdx from the WARCs under
+integration-testing/webarchive, via each WARC storage backend (WebHDFS and plain HTTP ranges via a
+stub server, and local files), checking the records come back intact.
+
+The block cache is turned off, to compare the backends themselves.
+
+Run from the top-level folder:
+
+    $ python integration-testing/benchmarks/warc_storage.py --repeat 20
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+sys.path.insert(0, os.path.dirname(__file__))
+from stubs import webhdfs, run_in_thread
+
+STORAGE_PORT = 18792
+WARC_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'webarchive', 'collections', 'test', 'archive'))
+
+
+def load_records():
+    # Fields: urlkey timestamp original mimetype statuscode digest redirecturl robotflags length offset filename
+    cdx_file = os.path.join(os.path.dirname(__file__), '..', 'test.cdx')
+    records = []
+    with open(cdx_file) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 11 and fields[9].isdigit():
+                records.append((fields[10], int(fields[9]), int(fields[8])))
+    return records
+
+
+async def read_all(records, concurrency):
+    from ukwa_api.cdx import open_warc_record_async
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def read(filename, offset, length):
+        async with semaphore:
+            r = await open_warc_record_async(filename, offset, length)
+            try:
+                return await r.aread()
+            finally:
+                await r.aclose()
+
+    return await asyncio.gather(*[read(*record) for record in records])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20, help="Number of times to read each record.")
+    parser.add_argument('--concurrency', type=int, default=20, help="Number of records to read at once.")
+    args = parser.parse_args()
+
+    run_in_thread(webhdfs(WARC_FOLDER), STORAGE_PORT)
+    os.environ['WEBHDFS_PREFIX'] = 'http://127.0.0.1:%i/webhdfs/' % STORAGE_PORT
+    os.environ['WARC_HTTP_PREFIX'] = 'http://127.0.0.1:%i/files/' % STORAGE_PORT
+    os.environ['WARC_PATHS'] = WARC_FOLDER
+
+    from ukwa_api import cdx
+    from ukwa_api.warc_storage import create_storage
+
+    records = load_records() * args.repeat
+    expected = {}
+    for filename, offset, length in records:
+        with open(os.path.join(WARC_FOLDER, filename), 'rb') as f:
+            f.seek(offset)
+            expected[(filename, offset)] = f.read(length)
+
+    async def main():
+        cdx.warc_block_cache.max_read = 0
+        for storage_type in ('webhdfs', 'http', 'file'):
+            cdx.warc_storage = create_storage(storage_type)
+            start = time.perf_counter()
+            results = await read_all(records, args.concurrency)
+            elapsed = time.perf_counter() - start
+            ok = all(result == expected[(filename, offset)] for result, (filename, offset, length) in zip(results, records))
+            size = sum(map(len, results))
+            print("%-8s %8.0f records/s, %7.1f MB/s, intact: %s" % (storage_type, len(records) / elapsed, size / elapsed / 1024 / 1024, ok))
+
+    asyncio.run(main())
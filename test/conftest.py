@@ -0,0 +1,145 @@
+"""
+Shared set-up for the tests.
+
+The API reads its settings from the environment when it is imported, so they are set here first,
+pointing the back-end services at local ports (see the stubs in integration-testing/benchmarks/stubs.py),
+and the caches at a temporary folder (or turned off).
+"""
+import io
+import os
+import sys
+import gzip
+import socket
+import tempfile
+
+import pytest
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+CDX_PORT = _free_port()
+WEBHDFS_PORT = _free_port()
+WAYBACK_PORT = _free_port()
+DATA_FOLDER = tempfile.mkdtemp(prefix='ukwa-api-test-')
+
+os.environ.update(
+    CDX_SERVER='http://127.0.0.1:%i/cdx' % CDX_PORT,
+    WEBHDFS_PREFIX='http://127.0.0.1:%i/webhdfs/' % WEBHDFS_PORT,
+    ACCESS_CHECK_SERVER='http://127.0.0.1:%i/wayback/' % WAYBACK_PORT,
+    CACHE_FOLDER=DATA_FOLDER,
+    ACCESS_CACHE_TYPE='none',
+    CDX_CACHE_TYPE='none',
+    WARC_CACHE_TYPE='none',
+)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'integration-testing', 'benchmarks'))
+
+
+# Some payloads to archive:
+PDF = bytes(range(256)) * 4000
+HTML = b'<html>' + b'hello world ' * 50000 + b'</html>'
+
+
+def _chunked(data, size=7000):
+    return b''.join(b'%x\r\n%s\r\n' % (len(data[i:i+size]), data[i:i+size]) for i in range(0, len(data), size)) + b'0\r\n\r\n'
+
+
+def build_archive(folder):
+    """
+    Writes a WARC file of test records into the folder, along with a CDX file for it.
+
+    :return: a dict mapping each URL to the (offset, length) of its record
+    """
+    from warcio.warcwriter import WARCWriter
+    from warcio.statusandheaders import StatusAndHeaders
+    from stubs import surt_key
+
+    out = io.BytesIO()
+    writer = WARCWriter(out, gzip=True)
+    records = {}
+    cdx = []
+
+    def add(record, timestamp, mime):
+        url = record.rec_headers.get_header('WARC-Target-URI')
+        record.rec_headers.replace_header('WARC-Date', '%s-%s-%sT%s:%s:%sZ' % (
+            timestamp[:4], timestamp[4:6], timestamp[6:8], timestamp[8:10], timestamp[10:12], timestamp[12:14]))
+        offset = out.tell()
+        writer.write_record(record)
+        records[url] = (offset, out.tell() - offset)
+        cdx.append('%s %s %s %s 200 - - - %i %i test.warc.gz\n' % (surt_key(url), timestamp, url, mime, out.tell() - offset, offset))
+        return record
+
+    headers = StatusAndHeaders('200 OK', [('Content-Type', 'application/pdf'), ('Content-Length', str(len(PDF)))], protocol='HTTP/1.1')
+    original = add(writer.create_warc_record('http://example.org/a.pdf', 'response', payload=io.BytesIO(PDF), http_headers=headers),
+        '20190325150501', 'application/pdf')
+    digest = original.rec_headers.get_header('WARC-Payload-Digest')
+
+    headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html; charset=utf-8'), ('Transfer-Encoding', 'chunked'),
+        ('Content-Encoding', 'gzip')], protocol='HTTP/1.1')
+    add(writer.create_warc_record('http://example.org/page', 'response', payload=io.BytesIO(_chunked(gzip.compress(HTML))), http_headers=headers),
+        '20190325150502', 'text/html')
+
+    headers = StatusAndHeaders('200 OK', [('Content-Type', 'application/pdf')], protocol='HTTP/1.1')
+    for name, revisit_digest in [('b.pdf', digest), ('c.pdf', 'sha1:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')]:
+        add(writer.create_revisit_record('http://example.org/' + name, digest=revisit_digest, refers_to_uri='http://example.org/a.pdf',
+            refers_to_date='2019-03-25T15:05:01Z', http_headers=headers), '20200101000000', 'warc/revisit')
+
+    with open(os.path.join(folder, 'test.warc.gz'), 'wb') as f:
+        f.write(out.getvalue())
+    with open(os.path.join(folder, 'test.cdx'), 'w') as f:
+        f.write(' CDX N b a m s k r M S V g\n')
+        f.writelines(sorted(cdx))
+    return records
+
+
+@pytest.fixture(scope='session')
+def archive():
+    """
+    The test WARC file, served by the stub OutbackCDX, WebHDFS and Wayback services.
+
+    :return: (the WARC file's bytes, a dict mapping each URL to the (offset, length) of its record)
+    """
+    from stubs import outbackcdx, webhdfs, webrender, run_in_thread
+
+    records = build_archive(DATA_FOLDER)
+    servers = [
+        run_in_thread(outbackcdx(os.path.join(DATA_FOLDER, 'test.cdx')), CDX_PORT),
+        run_in_thread(webhdfs(DATA_FOLDER), WEBHDFS_PORT),
+        run_in_thread(webrender(delay=0), WAYBACK_PORT),
+    ]
+    with open(os.path.join(DATA_FOLDER, 'test.warc.gz'), 'rb') as f:
+        yield f.read(), records
+    for server in servers:
+        server.should_exit = True
+
+
+@pytest.fixture(scope='session')
+def client():
+    from fastapi.testclient import TestClient
+    from ukwa_api.main import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def cdx_server(monkeypatch):
+    """
+    A stub OutbackCDX serving integration-testing/test.cdx, for the CDX query endpoint.
+
+    :return: the stub app, whose `state.scanned` counts the rows it has scanned
+    """
+    from stubs import outbackcdx, run_in_thread
+    from ukwa_api.mementos import router, shards
+
+    app = outbackcdx(os.path.join(os.path.dirname(__file__), '..', 'integration-testing', 'test.cdx'), batch=10)
+    port = _free_port()
+    server = run_in_thread(app, port)
+    for module in (router, shards):
+        monkeypatch.setattr(module, 'CDX_SERVER', 'http://127.0.0.1:%i/cdx' % port)
+    yield app
+    server.should_exit = True
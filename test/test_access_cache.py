@@ -0,0 +1,79 @@
+import asyncio
+
+from cachelib import FileSystemCache
+
+from ukwa_api.access_cache import AccessDecisionCache, LRUCache, canonical_url
+
+
+def _checker(decisions):
+    calls = []
+
+    async def check(url):
+        calls.append(url)
+        await asyncio.sleep(0.01)
+        return decisions[url]
+    return check, calls
+
+
+def test_canonical_url():
+    assert canonical_url('HTTP://Example.ORG:80/a?b#c') == 'http://example.org/a?b'
+    assert canonical_url('https://example.org:443') == 'https://example.org/'
+    assert canonical_url('http://example.org:8080/') == 'http://example.org:8080/'
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    # The least recently used goes first:
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+    cache.set('d', 4, timeout=-1)
+    assert cache.get('d') is None
+
+
+def test_lookup_cached():
+    check, calls = _checker({'http://example.org/': (200, 'OK')})
+    cache = AccessDecisionCache(LRUCache())
+
+    async def run():
+        first = await cache.lookup('http://example.org/', check)
+        second = await cache.lookup('http://EXAMPLE.org:80/', check)
+        return first, second
+    assert asyncio.run(run()) == ((200, 'OK'), (200, 'OK'))
+    assert len(calls) == 1
+
+
+def test_lookup_coalesced():
+    check, calls = _checker({'http://example.org/': (403, 'Forbidden')})
+    cache = AccessDecisionCache(LRUCache())
+
+    async def run():
+        return await asyncio.gather(*[cache.lookup('http://example.org/', check) for _ in range(10)])
+    assert asyncio.run(run()) == [(403, 'Forbidden')] * 10
+    assert len(calls) == 1
+
+
+def test_lookup_ttls():
+    check, calls = _checker({'http://allowed.org/': (200, 'OK'), 'http://denied.org/': (403, 'Forbidden'), 'http://broken.org/': (503, 'Unavailable')})
+    backend = LRUCache()
+    cache = AccessDecisionCache(backend, allow_ttl=100, deny_ttl=-1)
+
+    async def run():
+        for url in ['http://allowed.org/', 'http://denied.org/', 'http://broken.org/'] * 2:
+            await cache.lookup(url, check)
+    asyncio.run(run())
+    # Denials have expired straight away, and server errors are never cached:
+    assert calls == ['http://allowed.org/', 'http://denied.org/', 'http://broken.org/', 'http://denied.org/', 'http://broken.org/']
+
+
+def test_lookup_filesystem(tmp_path):
+    check, calls = _checker({'http://example.org/': (200, 'OK')})
+
+    async def run(cache):
+        return await cache.lookup('http://example.org/', check)
+    assert asyncio.run(run(AccessDecisionCache(FileSystemCache(str(tmp_path))))) == (200, 'OK')
+    # Shared with another instance, e.g. in another worker:
+    assert asyncio.run(run(AccessDecisionCache(FileSystemCache(str(tmp_path))))) == (200, 'OK')
+    assert len(calls) == 1
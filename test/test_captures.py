@@ -0,0 +1,74 @@
+from ukwa_api.captures import CaptureIndex, timestamp_seconds
+
+CAPTURES = [
+    ('20190101000000', 'a.warc.gz', '0', '100'),
+    ('20190601000000', 'a.warc.gz', '100', '100'),
+    ('20200101000000', 'b.warc.gz', '0', '-'),
+    ('20210101000000', 'b.warc.gz', '200', '300'),
+]
+
+
+def test_capture_index():
+    index = CaptureIndex(CAPTURES)
+    assert len(index) == 4
+    assert index[0] == ('20190101000000', 'a.warc.gz', 0, 100)
+    assert index[2] == ('20200101000000', 'b.warc.gz', 0, None)
+    assert index.record(3) == ('b.warc.gz', 200, 300)
+    # Filenames are only held once:
+    assert index.filenames == ['a.warc.gz', 'b.warc.gz']
+
+
+def test_capture_index_sorted():
+    index = CaptureIndex(reversed(CAPTURES))
+    assert [capture[0] for capture in index] == [capture[0] for capture in CAPTURES]
+    assert index.record(0) == ('a.warc.gz', 0, 100)
+
+
+def test_timestamp_seconds():
+    assert timestamp_seconds(19700101000000) == 0
+    assert timestamp_seconds(20000229123456) == 951827696
+
+
+def test_closest():
+    index = CaptureIndex(CAPTURES)
+    assert CaptureIndex().closest('20190101000000') is None
+    assert index.closest('19990101000000') == 0
+    assert index.closest('20190301000000') == 0
+    assert index.closest('20190401000000') == 1
+    assert index.closest('20200101000000') == 2
+    assert index.closest('20300101000000') == 3
+
+
+def test_closest_tie():
+    # Ties go to the earlier capture:
+    index = CaptureIndex([('20190101000000', 'a.warc.gz', 0, 1), ('20190103000000', 'a.warc.gz', 1, 1)])
+    assert index.closest('20190102000000') == 0
+
+
+def test_duplicate_timestamps():
+    # Captures sharing a timestamp are all kept, in the order given, but as when they were held in a
+    # dict keyed by timestamp, the closest match is the last of them, whichever side the target is on:
+    index = CaptureIndex([
+        ('20190101000000', 'a.warc.gz', '0', '100'),
+        ('20190101000000', 'b.warc.gz', '0', '100'),
+        ('20200101000000', 'c.warc.gz', '0', '100'),
+    ])
+    assert len(index) == 3
+    assert [capture[1] for capture in index] == ['a.warc.gz', 'b.warc.gz', 'c.warc.gz']
+    for target in ['20180101000000', '20190101000000', '20190301000000']:
+        assert index.record(index.closest(target)) == ('b.warc.gz', 0, 100)
+
+
+def test_range():
+    index = CaptureIndex(CAPTURES)
+    assert [capture[0] for capture in index.range('2019')] == [capture[0] for capture in CAPTURES]
+    assert [capture[0] for capture in index.range('2019', '2019')] == ['20190101000000', '20190601000000']
+    assert [capture[0] for capture in index.range('201906', '2020')] == ['20190601000000', '20200101000000']
+    assert [capture[0] for capture in index.range(to_ts='2018')] == []
+    assert index.range('2020').record(0) == ('b.warc.gz', 0, None)
+
+
+def test_collapse():
+    index = CaptureIndex(CAPTURES)
+    assert [capture[0] for capture in index.collapse(4)] == ['20190101000000', '20200101000000', '20210101000000']
+    assert [capture[0] for capture in index.collapse(4, last=True)] == ['20190601000000', '20200101000000', '20210101000000']
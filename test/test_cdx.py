@@ -0,0 +1,36 @@
+from ukwa_api.cdx import CdxXmlParser
+
+from stubs import make_cdx_xml
+
+
+def test_cdx_xml_parser():
+    xml = make_cdx_xml([('20190101000000', 'a.warc.gz', 0, 100), ('20200101000000', 'b.warc.gz', 100, 200)]).encode('utf-8')
+    parser = CdxXmlParser()
+    captures = list(parser.feed(xml)) + list(parser.close())
+    assert captures == [('20190101000000', 'a.warc.gz', '0', '100'), ('20200101000000', 'b.warc.gz', '100', '200')]
+
+
+def test_cdx_xml_parser_incremental():
+    captures = [('2019%010i' % i, 'a.warc.gz', i * 100, 100) for i in range(50)]
+    xml = make_cdx_xml(captures).encode('utf-8')
+    parser = CdxXmlParser()
+    parsed = []
+    # Feed it in small pieces, as it might arrive:
+    for i in range(0, len(xml), 37):
+        parsed.extend(parser.feed(xml[i:i+37]))
+        # Results are passed on once they are complete:
+        assert len(parsed) >= xml[:i].count(b'</result>') - 1
+    parsed.extend(parser.close())
+    assert parsed == [(ts, filename, str(offset), str(length)) for (ts, filename, offset, length) in captures]
+
+
+def test_cdx_xml_parser_no_results():
+    parser = CdxXmlParser()
+    assert list(parser.feed(make_cdx_xml([]).encode('utf-8'))) + list(parser.close()) == []
+
+
+def test_cdx_xml_parser_without_end_offset():
+    xml = (b'<wayback><results><result><compressedoffset>10</compressedoffset><file>a.warc.gz</file>'
+        b'<capturedate>20190101000000</capturedate></result></results></wayback>')
+    parser = CdxXmlParser()
+    assert list(parser.feed(xml)) + list(parser.close()) == [('20190101000000', 'a.warc.gz', '10', None)]
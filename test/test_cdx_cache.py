@@ -0,0 +1,116 @@
+import time
+import asyncio
+
+from ukwa_api.access_cache import LRUCache
+from ukwa_api.captures import CaptureIndex
+from ukwa_api.cdx_cache import CdxCache, SQLiteCache
+
+
+def _fetcher(value, delay=0.01):
+    calls = []
+
+    async def fetch():
+        calls.append(time.time())
+        await asyncio.sleep(delay)
+        return value
+    return fetch, calls
+
+
+def test_sqlite_cache(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite'))
+    captures = CaptureIndex([('20190101000000', 'a.warc.gz', '0', '100')])
+    cache.set('a', captures)
+    assert list(cache.get('a')) == list(captures)
+    assert cache.get('b') is None
+    assert cache.delete('a')
+    assert cache.get('a') is None
+    cache.set('c', 1, timeout=-1)
+    assert cache.get('c') is None
+
+
+def test_sqlite_cache_shared(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    SQLiteCache(path).set('a', 'value')
+    assert SQLiteCache(path).get('a') == 'value'
+
+
+def test_sqlite_cache_totals(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite'))
+    cache.set('a', b'x' * 100)
+    entries, size = cache.stats()
+    assert entries == 1
+    # Replacing an entry updates the totals rather than adding to them:
+    cache.set('a', b'x' * 200)
+    assert cache.stats() == (1, size + 100)
+    cache.delete('a')
+    assert cache.stats() == (0, 0)
+
+
+def test_sqlite_cache_evicts_least_recently_used(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite'), max_entries=10)
+    for i in range(10):
+        cache.set(str(i), i)
+        time.sleep(0.001)
+    cache.get('0')
+    cache.set('10', 10)
+    entries, size = cache.stats()
+    assert entries <= 10
+    assert cache.get('0') == 0
+    assert cache.get('1') is None
+    assert cache.get('10') == 10
+
+
+def test_sqlite_cache_max_bytes(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite'), max_bytes=10000)
+    for i in range(20):
+        cache.set(str(i), b'x' * 1000)
+    entries, size = cache.stats()
+    assert size <= 10000
+    assert cache.get('19') is not None
+
+
+def test_get_or_fetch():
+    fetch, calls = _fetcher('value')
+    cache = CdxCache(LRUCache())
+
+    async def run():
+        return [await cache.get_or_fetch('key', fetch) for _ in range(3)]
+    assert asyncio.run(run()) == ['value'] * 3
+    assert len(calls) == 1
+
+
+def test_get_or_fetch_coalesced():
+    fetch, calls = _fetcher('value')
+    cache = CdxCache(LRUCache())
+
+    async def run():
+        return await asyncio.gather(*[cache.get_or_fetch('key', fetch) for _ in range(10)])
+    assert asyncio.run(run()) == ['value'] * 10
+    assert len(calls) == 1
+
+
+def test_get_or_fetch_none_not_cached():
+    fetch, calls = _fetcher(None)
+    cache = CdxCache(LRUCache())
+
+    async def run():
+        return [await cache.get_or_fetch('key', fetch) for _ in range(2)]
+    assert asyncio.run(run()) == [None, None]
+    assert len(calls) == 2
+
+
+def test_get_or_fetch_stale(tmp_path):
+    values = iter(['old', 'new'])
+
+    async def fetch():
+        return next(values)
+    cache = CdxCache(SQLiteCache(str(tmp_path / 'cache.sqlite')), ttl=0, stale_ttl=60)
+
+    async def run():
+        first = await cache.get_or_fetch('key', fetch)
+        # Stale, so returned straight away, and refreshed in the background:
+        second = await cache.get_or_fetch('key', fetch)
+        await asyncio.sleep(0.1)
+        third = await cache.get_or_fetch('key', fetch)
+        return first, second, third
+    assert asyncio.run(run()) == ('old', 'old', 'new')
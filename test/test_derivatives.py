@@ -0,0 +1,88 @@
+import io
+import asyncio
+
+import pytest
+from PIL import Image
+
+from ukwa_api.iiif import derivatives
+from ukwa_api.iiif.derivatives import make_derivatives, build_derivatives, find_derivative, manifest_key
+from ukwa_api.screenshot_store import ScreenshotStore
+
+PWID = 'urn:pwid:webarchive.org.uk:2019-03-25T15:05:01Z:screenshot:http://example.org/'
+
+
+def _png(width, height):
+    img = Image.new('RGB', (width, height))
+    img.putdata([(x % 256, y % 256, 128) for y in range(height) for x in range(width)])
+    out = io.BytesIO()
+    img.save(out, 'PNG')
+    return out.getvalue()
+
+
+def _size(path):
+    with Image.open(path) as img:
+        return img.size
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = ScreenshotStore(str(tmp_path / 'store'))
+    monkeypatch.setattr(derivatives, 'screenshot_store', store)
+    return store
+
+
+def test_make_derivatives():
+    size, made = make_derivatives(_png(1000, 600), tile_size=256, tile_format='jpg', extras='0,0,500,500/100,/default.png', formats=())
+    assert size == (1000, 600)
+    made = {(box, size, format): payload for box, size, format, payload in made}
+    # 4x3 tiles at full size, 2x2 at half size, and one for the whole image, plus the thumbnail:
+    assert len(made) == 12 + 4 + 1 + 1
+    assert Image.open(io.BytesIO(made[(0, 0, 256, 256), (256, 256), 'jpg'])).size == (256, 256)
+    # The tiles at the edges are cut short:
+    assert Image.open(io.BytesIO(made[(768, 512, 232, 88), (232, 88), 'jpg'])).size == (232, 88)
+    assert Image.open(io.BytesIO(made[(512, 0, 488, 512), (244, 256), 'jpg'])).size == (244, 256)
+    assert Image.open(io.BytesIO(made[(0, 0, 1000, 600), (250, 150), 'jpg'])).size == (250, 150)
+    thumbnail = Image.open(io.BytesIO(made[(0, 0, 500, 500), (100, 100), 'png']))
+    assert (thumbnail.format, thumbnail.size) == ('PNG', (100, 100))
+
+
+def test_make_derivatives_formats():
+    size, made = make_derivatives(_png(100, 100), tile_size=256, tile_format='jpg', extras='', formats=('png',))
+    assert [(box, size, format) for box, size, format, payload in made] == [((0, 0, 100, 100), (100, 100), 'jpg'), ((0, 0, 100, 100), (100, 100), 'png')]
+
+
+def test_build_and_find_derivatives(store):
+    asyncio.run(build_derivatives(PWID, _png(1024, 1024)))
+    assert store.get(manifest_key(PWID)) is not None
+
+    def find(region, size, rotation=0, quality='default', format='png'):
+        return asyncio.run(find_derivative(PWID, region, size, rotation, quality, format))
+
+    path, content_type = find('0,0,1024,1024', '600,')
+    assert (_size(path), content_type) == ((600, 600), 'image/png')
+    # The same pixels, asked for in other ways:
+    assert find('full', '600,') == (path, content_type)
+    assert find('full', ',600') == (path, content_type)
+    assert find('pct:0,0,100,100', '600,600', quality='color') == (path, content_type)
+    # And the tiles:
+    path, content_type = find('512,0,512,512', '512,', format='jpg')
+    assert (_size(path), content_type) == ((512, 512), 'image/jpeg')
+    assert find('full', '512,', format='jpg') is not None
+
+    # But not anything else:
+    assert find('full', '601,') is None
+    assert find('full', '600,', rotation=90) is None
+    assert find('full', '600,', quality='gray') is None
+    assert find('full', '600,', format='gif') is None
+    assert find('0,0,2000,2000x', '600,') is None
+
+
+def test_find_derivative_missing(store):
+    assert asyncio.run(find_derivative(PWID, 'full', '600,', 0, 'default', 'png')) is None
+
+
+def test_build_derivatives_failure(store):
+    # A broken image is logged and skipped, and nothing stored:
+    asyncio.run(build_derivatives(PWID, b'not an image'))
+    assert store.get(manifest_key(PWID)) is None
+    assert store.stats()[0] == 0
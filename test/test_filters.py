@@ -0,0 +1,78 @@
+import pytest
+from fastapi import HTTPException
+
+from ukwa_api.mementos.filters import CdxFilter
+
+LINES = [
+    b'org,example)/ 20190101000000 http://example.org/ text/html 200 AAAA - - 100 0 a.warc.gz\n',
+    b'org,example)/ 20190601000000 http://example.org/ text/html 200 AAAA - - 100 100 a.warc.gz\n',
+    b'org,example)/ 20200101000000 http://example.org/ text/html 404 BBBB - - 100 200 a.warc.gz\n',
+    b'org,example)/a.pdf 20190101000000 http://example.org/a.pdf application/pdf 200 AAAA - - 100 300 a.warc.gz\n',
+    b'org,example)/a.pdf 20210101000000 http://example.org/a.pdf application/pdf 200 CCCC - - 100 400 a.warc.gz\n',
+]
+
+
+def _apply(cdx_filter, lines=LINES):
+    out = []
+    for line in lines:
+        out.extend(cdx_filter.feed(line))
+    out.extend(cdx_filter.flush())
+    return [LINES.index(line) for line in out]
+
+
+def test_no_filters():
+    cdx_filter = CdxFilter()
+    assert not cdx_filter
+    assert _apply(cdx_filter) == [0, 1, 2, 3, 4]
+
+
+def test_regex_filter():
+    assert _apply(CdxFilter(['mimetype:text/.*'])) == [0, 1, 2]
+    assert _apply(CdxFilter(['!mimetype:text/.*'])) == [3, 4]
+    # Regexes match from the start of the field:
+    assert _apply(CdxFilter(['mimetype:html'])) == []
+
+
+def test_exact_and_contains_filters():
+    assert _apply(CdxFilter(['=status:404'])) == [2]
+    assert _apply(CdxFilter(['!=statuscode:404'])) == [0, 1, 3, 4]
+    assert _apply(CdxFilter(['~url:pdf'])) == [3, 4]
+    # All the filters have to match:
+    assert _apply(CdxFilter(['=status:200', '~original:pdf'])) == [3, 4]
+
+
+def test_invalid_filters():
+    for spec in ['mimetype', 'nosuchfield:x', 'mimetype:(']:
+        with pytest.raises(HTTPException) as e:
+            CdxFilter([spec])
+        assert e.value.status_code == 400
+
+
+def test_dedup():
+    # Digests only count as duplicates for the same URL:
+    assert _apply(CdxFilter(dedup=True)) == [0, 2, 3, 4]
+
+
+def test_collapse():
+    assert _apply(CdxFilter(collapse='urlkey')) == [0, 3]
+    assert _apply(CdxFilter(collapse='urlkey', collapse_last=True)) == [2, 4]
+    assert _apply(CdxFilter(collapse='timestamp:4')) == [0, 2, 3, 4]
+    assert _apply(CdxFilter(collapse='timestamp:4', collapse_last=True)) == [1, 2, 3, 4]
+
+
+def test_cdx_filter_endpoint(client, cdx_server):
+    params = {'url': 'http://bbc.co.uk/', 'matchType': 'domain'}
+    everything = client.get('/mementos/cdx', params=params).text.splitlines()
+    r = client.get('/mementos/cdx', params=dict(params, filter=['mimetype:image/.*', '!=status:404'], collapseToLast='statuscode'))
+    assert r.status_code == 200
+    rows = r.text.splitlines()
+    assert rows
+    assert all(row.split(' ')[3].startswith('image/') for row in rows)
+    # No two consecutive rows share a status code:
+    assert all(a.split(' ')[4] != b.split(' ')[4] for a, b in zip(rows, rows[1:]))
+    assert set(rows) < set(everything)
+
+
+def test_cdx_filter_endpoint_invalid(client, cdx_server):
+    r = client.get('/mementos/cdx', params={'url': 'http://bbc.co.uk/', 'filter': 'nosuchfield:x'})
+    assert r.status_code == 400
@@ -0,0 +1,99 @@
+import io
+import csv
+import json
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from ukwa_api.mementos.formats import CDX11_FIELDS, parse_columns, parse_rows, transcode, atranscode, check_format
+
+LINES = [
+    b'org,example)/ 20190101000000 http://example.org/ text/html 200 AAAA - - 100 0 a.warc.gz\n',
+    b'org,example)/a 20190101000001 http://example.org/a image/png 200 BBBB - - 200 100 a.warc.gz\n',
+    b'org,example)/b 20190101000002 http://example.org/b text/html 301 CCCC http://example.org/ - 300 300 b.warc.gz\n',
+]
+
+
+def _transcode(output, lines=LINES, batch_rows=2):
+    return b''.join(transcode(lines, output, batch_rows=batch_rows))
+
+
+def test_parse_columns():
+    columns = parse_columns(LINES)
+    assert len(columns) == len(CDX11_FIELDS)
+    assert columns[1] == ['20190101000000', '20190101000001', '20190101000002']
+    assert columns[10] == ['a.warc.gz', 'a.warc.gz', 'b.warc.gz']
+    assert parse_rows(LINES)[2][6] == 'http://example.org/'
+
+
+def test_parse_columns_irregular():
+    # Short lines are padded, and spaces in the last field kept:
+    lines = [LINES[0], b'org,example)/c 20190101000003 http://example.org/c\n', b'org,example)/d 20190101000004 - - - - - - 1 2 a b.warc.gz\n']
+    rows = parse_rows(lines)
+    assert rows[0] == parse_rows(LINES[:1])[0]
+    assert rows[1] == ('org,example)/c', '20190101000003', 'http://example.org/c') + ('-',) * 8
+    assert rows[2][10] == 'a b.warc.gz'
+
+
+def test_transcode_cdx():
+    assert _transcode('cdx') == b''.join(LINES)
+
+
+def test_transcode_json():
+    rows = json.loads(_transcode('json'))
+    assert rows[0] == list(CDX11_FIELDS)
+    assert rows[1:] == [list(row) for row in parse_rows(LINES)]
+
+
+def test_transcode_ndjson():
+    rows = [json.loads(line) for line in _transcode('ndjson').splitlines()]
+    assert rows == [dict(zip(CDX11_FIELDS, row)) for row in parse_rows(LINES)]
+
+
+def test_transcode_csv():
+    rows = list(csv.reader(io.StringIO(_transcode('csv').decode('utf-8'))))
+    assert rows == [list(CDX11_FIELDS)] + [list(row) for row in parse_rows(LINES)]
+
+
+def test_transcode_columns():
+    batches = [json.loads(line) for line in _transcode('columns').splitlines()]
+    # One line per batch of rows:
+    assert [len(batch['urlkey']) for batch in batches] == [2, 1]
+    assert batches[0]['length'] == [100, 200]
+    assert batches[1]['offset'] == [300]
+    assert batches[1]['original'] == ['http://example.org/b']
+
+
+def test_transcode_arrow():
+    pa = pytest.importorskip('pyarrow')
+    table = pa.ipc.open_stream(_transcode('arrow')).read_all()
+    assert table.num_rows == 3
+    assert table.column('offset').to_pylist() == [0, 100, 300]
+    assert table.column('statuscode').to_pylist() == ['200', '200', '301']
+
+
+@pytest.mark.parametrize('output, ending', [
+    ('cdx', b'\nKEY\n'),
+    ('json', b',\n[],\n["KEY"]]\n'),
+    ('ndjson', b'{"cursor": "KEY"}\n'),
+    ('columns', b'{"cursor": "KEY"}\n'),
+])
+def test_atranscode_resume_key(output, ending):
+    async def batches():
+        yield LINES[:2]
+        yield LINES[2:]
+
+    async def run(resume_key):
+        return b''.join([chunk async for chunk in atranscode(batches(), output, resume_key=resume_key)])
+
+    assert asyncio.run(run(lambda: 'KEY')).endswith(ending)
+    # Without one, it's the same as transcoding in one go:
+    assert asyncio.run(run(lambda: None)) == asyncio.run(run(None)) == _transcode(output)
+
+
+def test_check_format():
+    check_format('csv')
+    with pytest.raises(HTTPException) as e:
+        check_format('xml')
+    assert e.value.status_code == 400
@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ukwa_api.iiif import router
+
+from conftest import _free_port
+from stubs import webrender, run_in_thread
+
+
+@pytest.fixture
+def renderer(monkeypatch):
+    """
+    A slow stub webrender service, whose `state.renders` counts the renders it has made.
+    """
+    app = webrender(delay=0.5)
+    port = _free_port()
+    server = run_in_thread(app, port)
+    monkeypatch.setattr(router, 'WEBRENDER_ARCHIVE_SERVER', 'http://127.0.0.1:%i/render' % port)
+    yield app
+    server.should_exit = True
+
+
+def test_render_raw_single_flight(client, archive, renderer):
+    pwid = 'urn:pwid:webarchive.org.uk:2019-03-25T15:05:01Z:page:http://example.org/single-flight'
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(pool.map(lambda i: client.get('/iiif/render_raw', params={'pwid': pwid}), range(8)))
+    assert [r.status_code for r in responses] == [200] * 8
+    assert len(set(r.content for r in responses)) == 1
+    assert responses[0].headers['content-type'] == 'image/png'
+    # However many asked for it, it was only rendered once:
+    assert renderer.state.renders == 1
+
+    r = client.get('/iiif/render_raw', params={'pwid': pwid})
+    assert r.content == responses[0].content
+    assert renderer.state.renders == 1
@@ -0,0 +1,50 @@
+import pytest
+
+from ukwa_api.iiif import image_api
+from ukwa_api.iiif.image_api import parse_region, parse_size, negotiate
+
+
+def test_parse_region():
+    assert parse_region('full', 400, 300) == (0, 0, 400, 300)
+    assert parse_region('square', 400, 300) == (50, 0, 300, 300)
+    assert parse_region('square', 300, 400) == (0, 50, 300, 300)
+    assert parse_region('10,20,100,50', 400, 300) == (10, 20, 100, 50)
+    assert parse_region('pct:10,10,50,50', 400, 300) == (40, 30, 200, 150)
+
+
+def test_parse_region_clipped():
+    assert parse_region('300,200,200,200', 400, 300) == (300, 200, 100, 100)
+
+
+@pytest.mark.parametrize('region', ['400,0,10,10', '0,300,10,10', '0,0,0,10', 'pct:0,0,0,0'])
+def test_parse_region_outside(region):
+    with pytest.raises(ValueError):
+        parse_region(region, 400, 300)
+
+
+def test_parse_size():
+    assert parse_size('full', 400, 300) == (400, 300)
+    assert parse_size('max', 400, 300) == (400, 300)
+    assert parse_size('200,', 400, 300) == (200, 150)
+    assert parse_size(',150', 400, 300) == (200, 150)
+    assert parse_size('100,100', 400, 300) == (100, 100)
+    assert parse_size('!100,100', 400, 300) == (100, 75)
+    assert parse_size('pct:25', 400, 300) == (100, 75)
+
+
+@pytest.mark.parametrize('size', [',', '0,', 'pct:0', 'big'])
+def test_parse_size_invalid(size):
+    with pytest.raises(ValueError):
+        parse_size(size, 400, 300)
+
+
+def test_negotiate(monkeypatch):
+    monkeypatch.setattr(image_api, 'IIIF_NEGOTIATED_FORMATS', ['avif', 'webp'])
+    monkeypatch.setitem(image_api.FORMATS, 'avif', ('AVIF', 'image/avif'))
+    assert negotiate('jpg', None) == 'jpg'
+    assert negotiate('jpg', 'image/*') == 'jpg'
+    assert negotiate('jpg', 'image/webp,image/*') == 'webp'
+    assert negotiate('png', 'image/avif, image/webp;q=0.9') == 'avif'
+    assert negotiate('jpg', 'image/avif;q=0, image/webp') == 'webp'
+    # Only jpg and png requests are negotiated:
+    assert negotiate('webp', 'image/avif') == 'webp'
@@ -0,0 +1,154 @@
+import io
+import gzip
+
+from warcio.archiveiterator import ArchiveIterator
+
+from ukwa_api.clients import UPSTREAM_REQUESTS
+from ukwa_api.mementos.batch import Record, Span, plan_reads
+
+from conftest import PDF, HTML
+
+
+def _record(archive, url):
+    data, records = archive
+    offset, length = records[url]
+    return data[offset:offset+length]
+
+
+def _raw(response):
+    # The bytes as sent, without undoing any Content-Encoding:
+    return b''.join(response.iter_raw())
+
+
+def test_warc_gzip_pass_through(client, archive):
+    member = _record(archive, 'http://example.org/a.pdf')
+    with client.stream('GET', '/mementos/warc/20190325150501/http://example.org/a.pdf', headers={'Accept-Encoding': 'gzip'}) as r:
+        assert r.status_code == 200
+        assert r.headers['content-encoding'] == 'gzip'
+        assert r.headers['content-length'] == str(len(member))
+        assert _raw(r) == member
+
+
+def test_warc_decompressed(client, archive):
+    r = client.get('/mementos/warc/20190325150501/http://example.org/a.pdf', headers={'Accept-Encoding': 'identity'})
+    assert r.status_code == 200
+    assert 'content-encoding' not in r.headers
+    assert r.content == gzip.decompress(_record(archive, 'http://example.org/a.pdf'))
+    assert r.headers['content-length'] == str(len(r.content))
+
+
+def test_warc_range(client, archive):
+    record = gzip.decompress(_record(archive, 'http://example.org/a.pdf'))
+    r = client.get('/mementos/warc/20190325150501/http://example.org/a.pdf', headers={'Accept-Encoding': 'identity', 'Range': 'bytes=0-7'})
+    assert r.status_code == 206
+    assert r.content == b'WARC/1.0'
+    assert r.headers['content-range'] == 'bytes 0-7/%i' % len(record)
+
+    r = client.get('/mementos/warc/20190325150501/http://example.org/a.pdf', headers={'Accept-Encoding': 'identity', 'Range': 'bytes=-100'})
+    assert r.status_code == 206
+    assert r.content == record[-100:]
+
+
+def test_warc_range_compressed(client, archive):
+    member = _record(archive, 'http://example.org/a.pdf')
+    headers = {'Accept-Encoding': 'gzip', 'Range': 'bytes=10-1009'}
+    with client.stream('GET', '/mementos/warc/20190325150501/http://example.org/a.pdf', headers=headers) as r:
+        assert r.status_code == 206
+        assert r.headers['content-range'] == 'bytes 10-1009/%i' % len(member)
+        assert _raw(r) == member[10:1010]
+
+
+def test_warc_range_not_satisfiable(client, archive):
+    streaming = UPSTREAM_REQUESTS.labels('backend', 'streaming')
+    before = streaming._value.get()
+    r = client.get('/mementos/warc/20190325150501/http://example.org/a.pdf', headers={'Accept-Encoding': 'identity', 'Range': 'bytes=99999999-'})
+    assert r.status_code == 416
+    # The upstream record has been closed:
+    assert streaming._value.get() == before
+
+
+def test_warc_not_found(client, archive):
+    r = client.get('/mementos/warc/20190325150501/http://example.org/missing')
+    assert r.status_code == 404
+
+
+def test_raw(client, archive):
+    r = client.get('/mementos/raw/20190101000000/http://example.org/a.pdf')
+    assert r.status_code == 200
+    assert r.headers['content-type'] == 'application/pdf'
+    assert r.headers['content-length'] == str(len(PDF))
+    assert r.content == PDF
+
+
+def test_raw_range(client, archive):
+    r = client.get('/mementos/raw/20190101000000/http://example.org/a.pdf', headers={'Range': 'bytes=100-199'})
+    assert r.status_code == 206
+    assert r.headers['content-range'] == 'bytes 100-199/%i' % len(PDF)
+    assert r.content == PDF[100:200]
+
+
+def test_raw_decoded(client, archive):
+    # The payload is chunked and gzipped, so its size is only known once it has been decoded:
+    r = client.get('/mementos/raw/20190101000000/http://example.org/page')
+    assert r.status_code == 200
+    assert r.content == HTML
+
+    r = client.get('/mementos/raw/20190101000000/http://example.org/page', headers={'Range': 'bytes=0-9'})
+    assert r.status_code == 206
+    assert r.headers['content-range'] == 'bytes 0-9/*'
+    assert r.content == HTML[:10]
+
+    r = client.get('/mementos/raw/20190101000000/http://example.org/page', headers={'Range': 'bytes=%i-%i' % (len(HTML) - 5, len(HTML) + 100)})
+    assert r.status_code == 206
+    assert r.headers['content-range'] == 'bytes %i-%i/%i' % (len(HTML) - 5, len(HTML) - 1, len(HTML))
+    assert r.content == HTML[-5:]
+
+
+def test_raw_revisit(client, archive):
+    r = client.get('/mementos/raw/20200101000000/http://example.org/b.pdf')
+    assert r.status_code == 200
+    assert r.content == PDF
+
+
+def test_raw_revisit_digest_mismatch(client, archive):
+    r = client.get('/mementos/raw/20200101000000/http://example.org/c.pdf')
+    assert r.status_code == 404
+
+
+def test_plan_reads():
+    a = Record('http://a/', '2019', 'a.warc.gz', 0, 100)
+    b = Record('http://b/', '2019', 'a.warc.gz', 150, 100)
+    c = Record('http://c/', '2019', 'a.warc.gz', 10000, 100)
+    d = Record('http://d/', '2019', 'b.warc.gz', 0, None)
+    # Close records share a read, duplicates are only read once, and records of unknown length are read alone:
+    assert plan_reads([c, b, a, d, a], max_gap=100, max_span=1000) == [
+        Span('a.warc.gz', 0, 250, [a, b]),
+        Span('a.warc.gz', 10000, 10100, [c]),
+        Span('b.warc.gz', 0, None, [d]),
+    ]
+    # Reads are kept within the maximum span:
+    assert plan_reads([a, b], max_gap=100, max_span=200) == [Span('a.warc.gz', 0, 100, [a]), Span('a.warc.gz', 150, 250, [b])]
+
+
+def test_warc_batch(client, archive):
+    r = client.post('/mementos/warc', json={'captures': [
+        {'url': 'http://example.org/page', 'timestamp': '20190325150502'},
+        {'url': 'http://example.org/a.pdf', 'timestamp': '20190325150501'},
+        {'url': 'http://example.org/missing', 'timestamp': '20190325150501'},
+    ]})
+    assert r.status_code == 200
+    # Records come in the order they are in the WARC file, and missing ones are left out:
+    urls = [record.rec_headers.get_header('WARC-Target-URI') for record in ArchiveIterator(io.BytesIO(r.content))]
+    assert urls == ['http://example.org/a.pdf', 'http://example.org/page']
+
+
+def test_warc_batch_query(client, archive):
+    r = client.post('/mementos/warc', json={'query': {'url': 'http://example.org/', 'matchType': 'prefix', 'filter': ['mimetype:application/pdf']}})
+    assert r.status_code == 200
+    urls = [record.rec_headers.get_header('WARC-Target-URI') for record in ArchiveIterator(io.BytesIO(r.content))]
+    assert urls == ['http://example.org/a.pdf']
+
+
+def test_warc_batch_needs_captures_or_query(client, archive):
+    r = client.post('/mementos/warc', json={})
+    assert r.status_code == 400
@@ -0,0 +1,209 @@
+import asyncio
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from fastapi import HTTPException
+
+from ukwa_api.mementos import router
+from ukwa_api.mementos.paging import Cursor, Page, aiter_lines, key_scope, within_scope
+
+# Keys aren't unique, so some rows share one:
+LINES = [b'%s %s rest %i\n' % (urlkey, ts, n) for n, (urlkey, ts) in enumerate([
+    (b'org,example)/', b'20190101000000'),
+    (b'org,example)/', b'20190101000000'),
+    (b'org,example)/', b'20190101000000'),
+    (b'org,example)/', b'20200101000000'),
+    (b'org,example)/a', b'20190101000000'),
+    (b'org,example)/a', b'20190101000000'),
+    (b'org,example)/b', b'20190101000000'),
+])]
+
+
+async def _lines(lines):
+    for line in lines:
+        yield line
+
+
+def _page(lines, cursor=None, **kwargs):
+    async def read():
+        page = Page(_lines(lines), cursor, **kwargs)
+        return [line async for line in page], page.next_cursor
+    return asyncio.run(read())
+
+
+def _all_pages(lines, cursor=None, **kwargs):
+    # Resumes each page by running the whole query again:
+    rows, pages = [], 0
+    while True:
+        page, cursor = _page(lines, cursor, **kwargs)
+        rows.extend(page)
+        pages += 1
+        if cursor is None:
+            return rows, pages
+        cursor = Cursor.decode(cursor.encode())
+
+
+def test_cursor_round_trip():
+    cursor = Cursor.decode(Cursor(b'org,example)/ 20190101000000', 2, 10, 3).encode())
+    assert cursor.key == b'org,example)/ 20190101000000'
+    assert (cursor.skip, cursor.remaining, cursor.urlkey_rows) == (2, 10, 3)
+    assert cursor.urlkey() == b'org,example)/'
+    assert cursor.timestamp() == '20190101000000'
+
+    cursor = Cursor.decode(Cursor(None, 5).encode())
+    assert cursor.key is None and cursor.skip == 5 and cursor.remaining is None
+    assert cursor.urlkey() is None and cursor.timestamp() is None
+
+
+def test_cursor_invalid():
+    with pytest.raises(HTTPException) as e:
+        Cursor.decode('not a cursor')
+    assert e.value.status_code == 400
+
+
+def test_single_page():
+    assert _page(LINES) == (LINES, None)
+
+
+@pytest.mark.parametrize('max_rows', [1, 2, 3, 4, 6])
+def test_pages(max_rows):
+    # Every row comes back once, however the pages split up rows that share a key:
+    rows, pages = _all_pages(LINES, max_rows=max_rows)
+    assert rows == LINES
+    assert pages == -(-len(LINES) // max_rows)
+
+
+def test_pages_reverse():
+    lines = list(reversed(LINES))
+    rows, pages = _all_pages(lines, sort='reverse', max_rows=2)
+    assert rows == lines
+
+
+def test_pages_closest():
+    rows, pages = _all_pages(LINES, sort='closest', max_rows=3)
+    assert rows == LINES
+    assert pages == 3
+
+
+def test_page_cursor():
+    rows, cursor = _page(LINES, max_rows=2)
+    assert rows == LINES[:2]
+    assert cursor.key == b'org,example)/ 20190101000000'
+    assert cursor.skip == 2
+    assert cursor.urlkey_rows == 2
+
+    rows, cursor = _page(LINES, cursor, max_rows=3)
+    assert rows == LINES[2:5]
+    assert cursor.key == b'org,example)/a 20190101000000'
+    assert cursor.skip == 1
+    assert cursor.urlkey_rows == 1
+
+
+def test_page_max_bytes():
+    # Each page gets at least one row, however big:
+    rows, pages = _all_pages(LINES, max_bytes=1)
+    assert rows == LINES
+    assert pages == len(LINES)
+
+
+def test_page_limit():
+    rows, pages = _all_pages(LINES, Cursor(remaining=5), max_rows=2)
+    assert rows == LINES[:5]
+    assert pages == 3
+
+
+def test_batches():
+    async def read():
+        return [batch async for batch in Page(_lines(LINES)).batches(3)]
+    assert asyncio.run(read()) == [LINES[:3], LINES[3:6], LINES[6:]]
+
+
+def test_aiter_lines():
+    async def read(chunks):
+        return [line async for line in aiter_lines(_lines(chunks))]
+    assert asyncio.run(read([b'a b\nc', b' d\n', b'e\nf'])) == [b'a b\n', b'c d\n', b'e\n', b'f']
+
+
+def test_key_scope():
+    assert key_scope('http://example.org/', 'exact') is None
+    assert key_scope('http://www.Example.org/a', 'host') == (b'org,example)',)
+    assert key_scope('http://example.org:8080/', 'host') == (b'org,example:8080)',)
+    assert key_scope('https://example.org:443/', 'host') == (b'org,example)',)
+    assert key_scope('http://example.org/', 'domain') == (b'org,example)', b'org,example,')
+    assert key_scope('http://www2.example.org/A/b?C=d', 'prefix') == (b'org,example)/a/b?c=d',)
+
+
+def test_within_scope():
+    lines = [b'org,example)/ x\n', b'org,example,www)/ x\n', b'org,examples)/ x\n', b'org,example)/z x\n']
+
+    async def read(prefixes):
+        return [line async for line in within_scope(_lines(lines), prefixes)]
+    assert asyncio.run(read((b'org,example)', b'org,example,'))) == lines[:2]
+    assert asyncio.run(read((b'org,example)',))) == lines[:1]
+
+
+def _query(client, **params):
+    return client.get('/mementos/cdx', params=dict({'url': 'http://bbc.co.uk/', 'matchType': 'domain'}, **params))
+
+
+def _next_cursor(response):
+    link = response.headers.get('link')
+    if link is None:
+        return None
+    url = link[link.index('<')+1:link.index('>')]
+    assert link.endswith('; rel="next"')
+    return parse_qs(urlsplit(url).query)['cursor'][0]
+
+
+def test_cdx_link_paging(client, cdx_server, monkeypatch):
+    whole = _query(client)
+    assert whole.status_code == 200
+    assert 'link' not in whole.headers
+    expected = whole.text.splitlines()
+
+    monkeypatch.setattr(router, 'CDX_PAGE_MAX_ROWS', 7)
+    rows, cursor, pages = [], None, 0
+    while True:
+        r = _query(client, cursor=cursor) if cursor else _query(client)
+        assert r.status_code == 200
+        page = r.text.splitlines()
+        # The body is plain CDX11, with no resume key:
+        assert 0 < len(page) <= 7 and all(len(line.split(' ')) == 11 for line in page)
+        rows.extend(page)
+        pages += 1
+        cursor = _next_cursor(r)
+        if cursor is None:
+            break
+    assert rows == expected
+    assert pages == -(-len(expected) // 7)
+
+
+def test_cdx_resume_key(client, cdx_server, monkeypatch):
+    expected = _query(client, output='json').json()[1:]
+
+    monkeypatch.setattr(router, 'CDX_PAGE_MAX_ROWS', 7)
+    rows, cursor = [], None
+    while True:
+        params = {'output': 'json', 'showResumeKey': 'true'}
+        r = _query(client, cursor=cursor, **params) if cursor else _query(client, **params)
+        assert 'link' not in r.headers
+        page = r.json()[1:]
+        if len(page) > 2 and page[-2] == []:
+            # An empty row, then the resume key:
+            rows.extend(page[:-2])
+            cursor = page[-1][0]
+        else:
+            rows.extend(page)
+            break
+    assert rows == expected
+
+
+def test_cdx_resume_key_cdx(client, cdx_server, monkeypatch):
+    expected = _query(client).text.splitlines()
+    monkeypatch.setattr(router, 'CDX_PAGE_MAX_ROWS', 7)
+    r = _query(client, showResumeKey='true')
+    lines = r.text.split('\n')
+    # The rows, a blank line, then the resume key:
+    assert len(lines) == 10 and lines[7] == '' and lines[9] == ''
+    assert lines[:7] == expected[:7]
+    assert _query(client, cursor=lines[8]).text.splitlines() == expected[7:14]
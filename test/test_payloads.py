@@ -0,0 +1,36 @@
+import asyncio
+
+from ukwa_api.payloads import dechunk
+
+
+async def _chunks(data, size=7):
+    for i in range(0, len(data), size):
+        yield data[i:i+size]
+
+
+def _dechunk(data, size=7):
+    async def read():
+        return b''.join([chunk async for chunk in dechunk(_chunks(data, size))])
+    return asyncio.run(read())
+
+
+def test_dechunk():
+    data = b'5\r\nHello\r\n8;ext=1\r\n, world!\r\n0\r\n\r\n'
+    assert _dechunk(data) == b'Hello, world!'
+    assert _dechunk(data, size=1) == b'Hello, world!'
+    assert _dechunk(data, size=1000) == b'Hello, world!'
+
+
+def test_dechunk_with_trailers():
+    assert _dechunk(b'3\r\nabc\r\n0\r\nExpires: never\r\n\r\n') == b'abc'
+
+
+def test_dechunk_not_chunked():
+    # Passed on as-is:
+    assert _dechunk(b'<html>Not chunked</html>') == b'<html>Not chunked</html>'
+    assert _dechunk(b'') == b''
+
+
+def test_dechunk_truncated():
+    # Passes on what there is:
+    assert _dechunk(b'a\r\nHello') == b'Hello'
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from ukwa_api.ranges import parse_range, range_headers, slice_stream, open_slice
+
+
+async def _chunks(data, size=10):
+    for i in range(0, len(data), size):
+        yield data[i:i+size]
+
+
+async def _read(chunks):
+    return b''.join([chunk async for chunk in chunks])
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range('bytes=0-9', 100) == (0, 9)
+    assert parse_range('bytes=10-', 100) == (10, 99)
+    assert parse_range('bytes=-10', 100) == (90, 99)
+    assert parse_range('bytes=-1000', 100) == (0, 99)
+    assert parse_range('bytes=90-1000', 100) == (90, 99)
+
+
+def test_parse_range_ignored():
+    # Anything other than a single, valid byte range gets the whole thing:
+    assert parse_range('bytes=0-9,20-29', 100) is None
+    assert parse_range('items=0-9', 100) is None
+    assert parse_range('bytes=-', 100) is None
+    assert parse_range('bytes=9-0', 100) is None
+
+
+def test_parse_range_unknown_size():
+    assert parse_range('bytes=0-9', None) == (0, 9)
+    assert parse_range('bytes=10-', None) is None
+    assert parse_range('bytes=-10', None) is None
+
+
+def test_parse_range_not_satisfiable():
+    with pytest.raises(HTTPException) as e:
+        parse_range('bytes=100-', 100)
+    assert e.value.status_code == 416
+    assert e.value.headers['Content-Range'] == 'bytes */100'
+
+
+def test_range_headers():
+    assert range_headers((10, 19), 100) == {'Content-Range': 'bytes 10-19/100', 'Content-Length': '10'}
+    assert range_headers((10, 19), None) == {'Content-Range': 'bytes 10-19/*'}
+
+
+def test_slice_stream():
+    data = bytes(range(100))
+    assert asyncio.run(_read(slice_stream(_chunks(data), 15, 44))) == data[15:45]
+    assert asyncio.run(_read(slice_stream(_chunks(data), 0, 0))) == data[:1]
+    assert asyncio.run(_read(slice_stream(_chunks(data), 95, 200))) == data[95:]
+
+
+def test_open_slice():
+    data = bytes(range(100))
+
+    async def run(first, last, read_ahead):
+        chunks, byte_range, size, length = await open_slice(_chunks(data), first, last, read_ahead=read_ahead)
+        return await _read(chunks), byte_range, size, length
+
+    # Within the read-ahead, so the length is known:
+    assert asyncio.run(run(10, 19, 50)) == (data[10:20], (10, 19), None, 10)
+    # Running off the end of the data, so the range is cut short, and the size is known:
+    assert asyncio.run(run(90, 199, 50)) == (data[90:], (90, 99), 100, 10)
+    # Beyond the read-ahead, so neither is known:
+    assert asyncio.run(run(0, 79, 50)) == (data[:80], (0, 79), None, None)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(run(100, 199, 50))
+    assert e.value.status_code == 416
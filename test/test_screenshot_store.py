@@ -0,0 +1,174 @@
+import os
+import time
+import asyncio
+
+import pytest
+
+from ukwa_api.screenshot_store import ScreenshotStore
+
+
+def _store(tmp_path, **kwargs):
+    kwargs.setdefault('poll_interval', 0.01)
+    return ScreenshotStore(str(tmp_path / 'store'), **kwargs)
+
+
+def _files(store):
+    return sorted(name for (folder, dirs, files) in os.walk(store.objects) for name in files)
+
+
+def _totals(store):
+    # The totals, worked out from scratch:
+    db = store._db()
+    entries, = db.execute("SELECT COUNT(*) FROM entries").fetchone()
+    images, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects").fetchone()
+    return entries, images, size
+
+
+def test_store(tmp_path):
+    store = _store(tmp_path)
+    path = store.set('a', b'image', 'image/png')
+    assert store.get('a') == (path, 'image/png')
+    with open(path, 'rb') as f:
+        assert f.read() == b'image'
+    assert store.get('b') is None
+    assert store.stats() == (1, 1, 5)
+
+
+def test_store_shared_images(tmp_path):
+    store = _store(tmp_path)
+    # The same image is only stored once:
+    assert store.set('a', b'image', 'image/png') == store.set('b', b'image', 'image/png')
+    assert store.stats() == (2, 1, 5)
+    # And only deleted once nothing uses it:
+    store.set('a', b'other', 'image/png')
+    store.set('b', b'other', 'image/png')
+    assert store.stats() == _totals(store) == (2, 1, 5)
+    assert len(_files(store)) == 1
+
+
+def test_store_expiry(tmp_path):
+    store = _store(tmp_path)
+    store.set('a', b'image', 'image/png', timeout=-1)
+    assert store.get('a') is None
+    # Expired entries stay until the space is needed:
+    assert store.stats() == (1, 1, 5)
+
+
+def test_store_missing_image(tmp_path):
+    store = _store(tmp_path)
+    os.unlink(store.set('a', b'image', 'image/png'))
+    assert store.get('a') is None
+    store.set('b', b'other', 'image/png')
+    assert store.stats() == _totals(store) == (1, 1, 5)
+
+
+@pytest.mark.parametrize('eviction, evicted', [('lru', 'b'), ('lfu', 'c')])
+def test_store_eviction(tmp_path, eviction, evicted):
+    store = _store(tmp_path, max_bytes=3000, eviction=eviction)
+    store.set('a', b'a' * 1000, 'image/png')
+    store.set('b', b'b' * 1000, 'image/png')
+    time.sleep(0.01)
+    store.get('b')
+    time.sleep(0.01)
+    store.get('a')
+    store.get('a')
+    store.set('c', b'c' * 1000, 'image/png')
+    assert store.stats() == (3, 3, 3000)
+    store.set('d', b'd' * 1000, 'image/png')
+    assert store.get(evicted) is None
+    assert store.get('d') is not None
+    assert store.stats() == _totals(store) == (3, 3, 3000)
+    assert len(_files(store)) == 3
+
+
+def test_store_evicts_expired_first(tmp_path):
+    store = _store(tmp_path, max_bytes=2500)
+    store.set('a', b'a' * 1000, 'image/png')
+    store.set('b', b'b' * 1000, 'image/png', timeout=-1)
+    store.set('c', b'c' * 1000, 'image/png')
+    assert store.get('a') is not None
+    assert store.stats() == _totals(store) == (2, 2, 2000)
+
+
+def test_store_set_many(tmp_path):
+    store = _store(tmp_path, max_bytes=2500)
+    store.set('a', b'a' * 1000, 'image/png')
+    paths = store.set_many([('b', b'b' * 1000, 'image/png'), ('c', b'c' * 1000, 'image/jpeg')])
+    assert [store.get(key) for key in 'bc'] == [(paths[0], 'image/png'), (paths[1], 'image/jpeg')]
+    # Making room for them all evicts older entries, but none of the new ones:
+    assert store.get('a') is None
+    assert store.stats() == _totals(store) == (2, 2, 2000)
+
+
+def test_store_existing_index(tmp_path):
+    store = _store(tmp_path)
+    store.set('a', b'image', 'image/png')
+    store.set('b', b'other', 'image/png')
+    db = store._db()
+    db.execute("DELETE FROM entries WHERE key = 'b'")
+    db.execute("DROP TABLE totals")
+    db.execute("DROP TABLE orphans")
+    # The totals are worked out when the index is opened again, and the unused image cleared up:
+    store = _store(tmp_path)
+    assert store.stats() == (1, 2, 10)
+    store.set('c', b'image', 'image/png')
+    assert store.stats() == _totals(store) == (2, 1, 5)
+    assert len(_files(store)) == 1
+
+
+def test_get_or_create(tmp_path):
+    store = _store(tmp_path)
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return b'image', 'image/png'
+
+    async def run():
+        return await asyncio.gather(*[store.get_or_create('a', create) for i in range(5)])
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert results == [(None, b'image', 'image/png')] * 5
+    # After which it comes from the store:
+    path, image, content_type = asyncio.run(store.get_or_create('a', create))
+    assert (image, content_type) == (None, 'image/png')
+    assert len(calls) == 1
+
+
+def test_get_or_create_across_workers(tmp_path):
+    # Two stores on the same folder stand in for two workers:
+    first, second = _store(tmp_path), _store(tmp_path)
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return b'image', 'image/png'
+
+    async def run():
+        made = asyncio.ensure_future(first.get_or_create('a', create))
+        await asyncio.sleep(0.02)
+        assert first.creating() == 1
+        shared = await second.get_or_create('a', create)
+        return await made, shared
+
+    made, shared = asyncio.run(run())
+    assert len(calls) == 1
+    assert made == (None, b'image', 'image/png')
+    assert shared == (first.get('a')[0], None, 'image/png')
+    assert first.creating() == 0
+
+
+def test_get_or_create_failure(tmp_path):
+    store = _store(tmp_path)
+
+    async def create():
+        raise IOError("render failed")
+
+    with pytest.raises(IOError):
+        asyncio.run(store.get_or_create('a', create))
+    # The lock is released, so it can be tried again:
+    assert store.creating() == 0
+    assert asyncio.run(store.get_or_create('a', lambda: asyncio.sleep(0, (b'image', 'image/png'))))[1] == b'image'
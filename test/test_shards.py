@@ -0,0 +1,78 @@
+import pytest
+
+from ukwa_api.mementos import router, shards
+from ukwa_api.mementos.shards import split_keys, plan_shards
+
+
+def test_split_keys():
+    assert split_keys((b'uk,co,bbc)',), 4) == [b'uk,co,bbc)/g', b'uk,co,bbc)/n', b'uk,co,bbc)/t']
+    assert split_keys((b'uk,co,bbc)', b'uk,co,bbc,'), 4) == [b'uk,co,bbc)/n', b'uk,co,bbc,', b'uk,co,bbc,n']
+    assert split_keys((b'uk,co,bbc)/news/',), 2) == [b'uk,co,bbc)/news/n']
+
+
+def test_plan_shards():
+    assert plan_shards((b'uk,co,bbc)',), shards=1) is None
+    assert plan_shards(None, shards=4) is None
+    assert plan_shards((b'uk,co,bbc)',), shards=4) == [
+        (b'uk,co,bbc)', b'uk,co,bbc)/g'),
+        (b'uk,co,bbc)/g', b'uk,co,bbc)/n'),
+        (b'uk,co,bbc)/n', b'uk,co,bbc)/t'),
+        (b'uk,co,bbc)/t', None),
+    ]
+    # Resuming part way through:
+    assert plan_shards((b'uk,co,bbc)',), b'uk,co,bbc)/news', shards=4) == [
+        (b'uk,co,bbc)/news', b'uk,co,bbc)/t'),
+        (b'uk,co,bbc)/t', None),
+    ]
+    assert plan_shards((b'uk,co,bbc)',), b'uk,co,bbc)/z', shards=4) is None
+
+
+def _query(client, **params):
+    return client.get('/mementos/cdx', params=params).text.splitlines()
+
+
+@pytest.mark.parametrize('url, match_type', [
+    ('http://bbci.co.uk/', 'domain'),
+    ('http://bbc.co.uk/', 'domain'),
+    ('http://www.bbc.co.uk/', 'host'),
+    ('http://www.bbc.co.uk/news', 'prefix'),
+    ('http://static.bbci.co.uk/', 'prefix'),
+    ('http://acid.matkelly.com/', 'domain'),
+])
+def test_sharded_query(client, cdx_server, monkeypatch, url, match_type):
+    monkeypatch.setattr(shards, 'CDX_SHARDS', 1)
+    expected = _query(client, url=url, matchType=match_type)
+    assert expected
+
+    monkeypatch.setattr(router, 'CDX_SHARD_MIN_ROWS', 0)
+    for n in (2, 4, 8, 16):
+        monkeypatch.setattr(shards, 'CDX_SHARDS', n)
+        assert _query(client, url=url, matchType=match_type) == expected
+        assert _query(client, url=url, matchType=match_type, **{'from': '2019'}) == [line for line in expected if line.split(' ')[1] >= '2019']
+
+
+def test_sharded_pages(client, cdx_server, monkeypatch):
+    expected = _query(client, url='http://bbci.co.uk/', matchType='domain')
+
+    monkeypatch.setattr(router, 'CDX_SHARD_MIN_ROWS', 0)
+    monkeypatch.setattr(router, 'CDX_PAGE_MAX_ROWS', 25)
+    monkeypatch.setattr(shards, 'CDX_SHARD_CONCURRENCY', 2)
+    monkeypatch.setattr(shards, 'CDX_SHARD_BUFFER', 5)
+    rows, pages = [], 0
+    r = client.get('/mementos/cdx', params={'url': 'http://bbci.co.uk/', 'matchType': 'domain'})
+    while True:
+        rows.extend(r.text.splitlines())
+        pages += 1
+        if 'link' not in r.headers:
+            break
+        r = client.get(r.headers['link'][1:r.headers['link'].index('>')])
+    assert rows == expected
+    assert pages == -(-len(expected) // 25)
+
+
+
+def test_sharded_query_failure(client, monkeypatch):
+    monkeypatch.setattr(router, 'CDX_SHARD_MIN_ROWS', 0)
+    monkeypatch.setattr(shards, 'CDX_SERVER', 'http://127.0.0.1:1/cdx')
+    r = client.get('/mementos/cdx', params={'url': 'http://bbci.co.uk/', 'matchType': 'domain'})
+    assert r.status_code == 502
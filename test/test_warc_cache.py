@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+
+from ukwa_api.access_cache import LRUCache
+from ukwa_api.warc_cache import WarcBlockCache
+from ukwa_api.warc_storage import FileStorage, WarcReadError
+
+DATA = bytes(range(256)) * 40
+
+
+class CountingStorage(FileStorage):
+    """
+    Local storage that keeps a list of the reads made from it.
+    """
+
+    def __init__(self, paths):
+        super().__init__(paths)
+        self.reads = []
+
+    async def read(self, filename, offset, length):
+        self.reads.append((filename, offset, length))
+        return await super().read(filename, offset, length)
+
+
+def _cache(tmp_path, data=DATA, **kwargs):
+    (tmp_path / 'a.warc.gz').write_bytes(data)
+    storage = CountingStorage(str(tmp_path))
+    kwargs.setdefault('prefetch', 0)
+    kwargs.setdefault('coalesce_delay', 0.001)
+    return WarcBlockCache(LRUCache(maxsize=100), storage, block_size=1000, **kwargs), storage
+
+
+async def _read(cache, offset, length, filename='a.warc.gz'):
+    r = await cache.open(filename, offset, length)
+    try:
+        return await r.aread()
+    finally:
+        await r.aclose()
+
+
+def test_block_cache_read(tmp_path):
+    cache, storage = _cache(tmp_path)
+
+    async def run():
+        return [await _read(cache, offset, length) for offset, length in [(0, 10), (990, 20), (1500, 3000), (9990, 100)]]
+
+    assert asyncio.run(run()) == [DATA[:10], DATA[990:1010], DATA[1500:4500], DATA[9990:10090]]
+
+
+def test_block_cache_hit(tmp_path):
+    cache, storage = _cache(tmp_path)
+
+    async def run():
+        await _read(cache, 100, 10)
+        await _read(cache, 200, 10)
+        return await _read(cache, 900, 200)
+
+    assert asyncio.run(run()) == DATA[900:1100]
+    assert storage.reads == [('a.warc.gz', 0, 1000), ('a.warc.gz', 1000, 1000)]
+
+
+def test_block_cache_coalescing(tmp_path):
+    cache, storage = _cache(tmp_path, coalesce_delay=0.1)
+
+    async def run():
+        return await asyncio.gather(_read(cache, 100, 10), _read(cache, 200, 10), _read(cache, 2500, 10), _read(cache, 1500, 10))
+
+    assert asyncio.run(run()) == [DATA[100:110], DATA[200:210], DATA[2500:2510], DATA[1500:1510]]
+    # The same block is only fetched once, and adjacent blocks are fetched together:
+    assert storage.reads == [('a.warc.gz', 0, 3000)]
+
+
+def test_block_cache_prefetch(tmp_path):
+    cache, storage = _cache(tmp_path, prefetch=1)
+
+    async def run():
+        await _read(cache, 0, 10)
+        await _read(cache, 500, 1000)
+        # Let the prefetch finish:
+        await asyncio.sleep(0.05)
+        return await _read(cache, 2100, 10)
+
+    assert asyncio.run(run()) == DATA[2100:2110]
+    # The block after the second read was fetched along with it:
+    assert storage.reads[:2] == [('a.warc.gz', 0, 1000), ('a.warc.gz', 1000, 2000)]
+
+
+def test_block_cache_partial_block(tmp_path, monkeypatch):
+    cache, storage = _cache(tmp_path, data=DATA[:1500], partial_ttl=60)
+    now = [1000.0]
+    monkeypatch.setattr('ukwa_api.access_cache.time.time', lambda: now[0])
+
+    async def run():
+        reads = [await _read(cache, 1200, 1000)]
+        # Let the fetch finish storing the blocks:
+        await asyncio.sleep(0.05)
+        reads.append(await _read(cache, 1200, 1000))
+        # The file grows, which is only seen once the short block has expired:
+        (tmp_path / 'a.warc.gz').write_bytes(DATA[:2500])
+        reads.append(await _read(cache, 1200, 1000))
+        now[0] += 61
+        reads.append(await _read(cache, 1200, 1000))
+        await asyncio.sleep(0.05)
+        return reads
+
+    assert asyncio.run(run()) == [DATA[1200:1500]] * 3 + [DATA[1200:2200]]
+    assert len(storage.reads) == 2
+    # But the whole block is kept:
+    assert cache.backend.get('a.warc.gz:1') == DATA[1000:2000]
+
+
+def test_block_cache_partial_block_not_cached(tmp_path):
+    cache, storage = _cache(tmp_path, data=DATA[:1500], partial_ttl=0)
+
+    async def run():
+        await _read(cache, 1200, 100)
+        await _read(cache, 1200, 100)
+
+    asyncio.run(run())
+    assert storage.reads == [('a.warc.gz', 1000, 1000), ('a.warc.gz', 1000, 1000)]
+
+
+def test_block_cache_error(tmp_path):
+    cache, storage = _cache(tmp_path)
+    with pytest.raises(WarcReadError) as e:
+        asyncio.run(_read(cache, 0, 10, filename='missing.warc.gz'))
+    assert e.value.status_code == 404
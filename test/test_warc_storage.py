@@ -0,0 +1,132 @@
+import asyncio
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route
+
+from ukwa_api import warc_storage
+from ukwa_api.warc_storage import FileStorage, HttpRangeStorage, WarcReadError
+
+from conftest import _free_port
+from stubs import webhdfs, run_in_thread
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def folder(tmp_path):
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'a.warc.gz').write_bytes(DATA)
+    (tmp_path / 'empty.warc.gz').write_bytes(b'')
+    return tmp_path
+
+
+def _serve(app):
+    port = _free_port()
+    server = run_in_thread(app, port)
+    return server, 'http://127.0.0.1:%i/' % port
+
+
+@pytest.fixture
+def files(folder):
+    # A file server that supports Range requests:
+    server, url = _serve(webhdfs(str(folder / 'sub')))
+    yield url + 'files/'
+    server.should_exit = True
+
+
+@pytest.fixture
+def no_ranges():
+    # A file server that ignores Range requests, and one that sends the wrong range:
+    async def whole_file(request):
+        return Response(DATA, media_type='application/octet-stream')
+
+    async def wrong_range(request):
+        return Response(DATA[:100], status_code=206, headers={'Content-Range': 'bytes 0-99/%i' % len(DATA)})
+
+    server, url = _serve(Starlette(routes=[Route('/whole/{path:path}', whole_file), Route('/wrong/{path:path}', wrong_range)]))
+    yield url
+    server.should_exit = True
+
+
+def _run(monkeypatch, call):
+    # Each test runs in its own event loop, so needs a client of its own:
+    async def run():
+        async with httpx.AsyncClient() as client:
+            monkeypatch.setattr(warc_storage, 'get_client', lambda: client)
+            return await call()
+    return asyncio.run(run())
+
+
+async def _read_all(storage, filename, offset, length=None):
+    r = await storage.open(filename, offset, length)
+    try:
+        return r.status_code, await r.aread()
+    finally:
+        await r.aclose()
+
+
+def test_file_storage_locate(folder):
+    storage = FileStorage('%s:%s' % (folder, folder / 'sub'))
+    assert storage.locate('sub/a.warc.gz') == str(folder / 'sub' / 'a.warc.gz')
+    # Files are also found by name:
+    assert storage.locate('/heritrix/output/a.warc.gz') == str(folder / 'sub' / 'a.warc.gz')
+    assert storage.locate('missing.warc.gz') is None
+    # But not outside the folders:
+    assert FileStorage(str(folder / 'sub')).locate('../empty.warc.gz') is None
+
+
+def test_file_storage_read(folder):
+    storage = FileStorage(str(folder / 'sub'), chunk_size=1000)
+    assert asyncio.run(storage.read('a.warc.gz', 1500, 100)) == DATA[1500:1600]
+    assert asyncio.run(_read_all(storage, 'a.warc.gz', 1500, 3000)) == (206, DATA[1500:4500])
+    assert asyncio.run(_read_all(storage, 'a.warc.gz', 0)) == (200, DATA)
+    assert asyncio.run(_read_all(storage, 'a.warc.gz', 10000, 1000)) == (206, DATA[10000:])
+    assert asyncio.run(_read_all(storage, 'missing.warc.gz', 0, 10)) == (404, b'')
+    with pytest.raises(WarcReadError):
+        asyncio.run(storage.read('missing.warc.gz', 0, 10))
+
+
+def test_file_storage_empty(folder):
+    storage = FileStorage(str(folder))
+    assert asyncio.run(_read_all(storage, 'empty.warc.gz', 0, 10)) == (206, b'')
+    assert asyncio.run(storage.read('empty.warc.gz', 0, 10)) == b''
+
+
+def test_http_range_storage(files, monkeypatch):
+    storage = HttpRangeStorage(files)
+
+    async def run():
+        return [
+            await storage.read('a.warc.gz', 1500, 100),
+            await _read_all(storage, 'a.warc.gz', 1500, 3000),
+            await _read_all(storage, 'a.warc.gz', 10000),
+            await _read_all(storage, 'missing.warc.gz', 0, 10),
+        ]
+
+    assert _run(monkeypatch, run) == [DATA[1500:1600], (206, DATA[1500:4500]), (206, DATA[10000:]), (404, b'File not found.')]
+
+
+def test_http_range_storage_ranges_ignored(no_ranges, monkeypatch):
+    storage = HttpRangeStorage(no_ranges + 'whole/')
+
+    async def run():
+        return [
+            # Only what was asked for is passed on:
+            await storage.read('a.warc.gz', 0, 100),
+            await _read_all(storage, 'a.warc.gz', 0, 1000),
+            # Which can't be done for ranges further on:
+            await _read_all(storage, 'a.warc.gz', 1500, 100),
+        ]
+
+    assert _run(monkeypatch, run) == [DATA[:100], (200, DATA[:1000]), (501, b'')]
+
+
+def test_http_range_storage_wrong_range(no_ranges, monkeypatch):
+    storage = HttpRangeStorage(no_ranges + 'wrong/')
+    assert _run(monkeypatch, lambda: _read_all(storage, 'a.warc.gz', 1500, 100)) == (502, b'')
+    with pytest.raises(WarcReadError) as e:
+        _run(monkeypatch, lambda: storage.read('a.warc.gz', 1500, 100))
+    assert e.value.status_code == 502
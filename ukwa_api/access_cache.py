@@ -0,0 +1,168 @@
+"""
+Caching of access decisions, so repeated checks for the same URL (e.g. every tile of an IIIF
+viewer session) don't each make a call to the Wayback service.
+
+Decisions are cached by canonical URL, with separate time-to-live settings for allowed and denied
+URLs. Concurrent lookups for the same URL are coalesced, so only one upstream check runs at a time.
+
+The storage is pluggable, using the cachelib interface. ACCESS_CACHE_TYPE can be:
+
+- 'memory' for an in-process LRU cache (the default),
+- 'filesystem' to share decisions across all the workers via files under CACHE_FOLDER,
+- 'redis' to share decisions via Redis (requires the 'redis' package),
+- 'none' to disable caching.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from urllib.parse import urlsplit, urlunsplit
+
+import anyio
+import cachetools
+from cachelib import BaseCache, NullCache, FileSystemCache, RedisCache
+from prometheus_client import Counter
+
+ACCESS_CACHE_TYPE = os.environ.get("ACCESS_CACHE_TYPE", "memory")
+ACCESS_CACHE_SIZE = int(os.environ.get("ACCESS_CACHE_SIZE", 10000))
+ACCESS_CACHE_ALLOW_TTL = int(os.environ.get("ACCESS_CACHE_ALLOW_TTL", 10*60))
+ACCESS_CACHE_DENY_TTL = int(os.environ.get("ACCESS_CACHE_DENY_TTL", 60))
+ACCESS_CACHE_REDIS_HOST = os.environ.get("ACCESS_CACHE_REDIS_HOST", "localhost")
+ACCESS_CACHE_REDIS_PORT = int(os.environ.get("ACCESS_CACHE_REDIS_PORT", 6379))
+CACHE_FOLDER = os.environ.get("CACHE_FOLDER", ".")
+
+# Create a logger, beneath the Uvicorn error logger:
+logger = logging.getLogger(f"uvicorn.error.{__name__}")
+
+# Cache metrics:
+ACCESS_CACHE_LOOKUPS = Counter('ukwa_api_access_cache_lookups', 'Access decision cache lookups, by result (hit, miss or coalesced).',
+    labelnames=('result',))
+
+
+class LRUCache(BaseCache):
+    """
+    In-process, size-bounded LRU cache, with per-item timeouts.
+
+    It can be used from several threads at once (e.g. via anyio.to_thread).
+    """
+
+    def __init__(self, maxsize=ACCESS_CACHE_SIZE, default_timeout=300):
+        super().__init__(default_timeout)
+        self._cache = cachetools.LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires and expires < time.time():
+                self._cache.pop(key, None)
+                return None
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        with self._lock:
+            self._cache[key] = (time.time() + timeout if timeout else 0, value)
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+        return True
+
+
+def canonical_url(url):
+    """
+    Normalises a URL for use as a cache key: lower-case scheme and host, no default port, no fragment.
+    """
+    parts = urlsplit(str(url).strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def create_backend(cache_type=ACCESS_CACHE_TYPE):
+    """
+    Sets up the configured cache backend.
+    """
+    if cache_type == 'memory':
+        return LRUCache()
+    elif cache_type == 'filesystem':
+        return FileSystemCache(os.path.join(CACHE_FOLDER, 'access_cache'), threshold=ACCESS_CACHE_SIZE)
+    elif cache_type == 'redis':
+        return RedisCache(host=ACCESS_CACHE_REDIS_HOST, port=ACCESS_CACHE_REDIS_PORT, key_prefix='access:')
+    elif cache_type == 'none':
+        return NullCache()
+    raise ValueError(f"Unknown ACCESS_CACHE_TYPE: {cache_type}")
+
+
+class AccessDecisionCache:
+    """
+    Caches (status_code, reason) access decisions, coalescing concurrent lookups.
+    """
+
+    def __init__(self, backend, allow_ttl=ACCESS_CACHE_ALLOW_TTL, deny_ttl=ACCESS_CACHE_DENY_TTL):
+        self.backend = backend
+        self.allow_ttl = allow_ttl
+        self.deny_ttl = deny_ttl
+        self._inflight = {}
+
+    async def lookup(self, url, check):
+        """
+        Returns the cached decision for the URL, or awaits check(url) to make one.
+        """
+        key = canonical_url(url)
+        decision = await self._run(self.backend.get, key)
+        if decision is not None:
+            ACCESS_CACHE_LOOKUPS.labels('hit').inc()
+            return tuple(decision)
+
+        # If there's already a check running for this URL, wait for that instead.
+        # The check is shielded, so one caller giving up doesn't cancel it for the others:
+        task = self._inflight.get(key)
+        if task is not None:
+            ACCESS_CACHE_LOOKUPS.labels('coalesced').inc()
+            return await asyncio.shield(task)
+
+        ACCESS_CACHE_LOOKUPS.labels('miss').inc()
+        task = asyncio.ensure_future(self._check(key, url, check))
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _check(self, key, url, check):
+        status_code, reason = await check(url)
+        if 200 <= status_code < 400:
+            await self._run(self.backend.set, key, (status_code, reason), self.allow_ttl)
+        elif status_code < 500:
+            # Negative caching of denials, but not of server errors, which may be transient:
+            await self._run(self.backend.set, key, (status_code, reason), self.deny_ttl)
+        return status_code, reason
+
+    async def _run(self, call, *args):
+        # Backends other than the in-process ones may do disk or network I/O, so keep them off the event loop:
+        if isinstance(self.backend, (LRUCache, NullCache)):
+            return call(*args)
+        return await anyio.to_thread.run_sync(call, *args)
+
+
+# The shared cache:
+access_cache = AccessDecisionCache(create_backend())
@@ -0,0 +1,184 @@
+"""
+Compact, array-backed index of the captures of a URL.
+
+Rather than a dictionary of timestamp strings mapping to tuples of strings (hundreds of bytes per
+capture), captures are held in typed columns: packed integer timestamps, integer offsets and
+lengths, and an index into a list of distinct WARC filenames. That's under 30 bytes per capture,
+which makes holding many URLs' captures in a cache reasonable.
+
+The captures are kept sorted by timestamp, so closest-match and date range operations are
+binary searches.
+"""
+import bisect
+import calendar
+from array import array
+
+# Length used when a capture has no known record length:
+NO_LENGTH = -1
+
+
+def timestamp_seconds(ts):
+    """
+    Converts a 14-digit integer timestamp to seconds since the epoch, without string parsing.
+    """
+    year, rest = divmod(ts, 10**10)
+    month, rest = divmod(rest, 10**8)
+    day, rest = divmod(rest, 10**6)
+    hour, rest = divmod(rest, 10**4)
+    minute, second = divmod(rest, 100)
+    return calendar.timegm((year, max(month, 1), max(day, 1), hour, minute, second, 0, 0, 0))
+
+
+def lower_bound(partial_ts):
+    """
+    Earliest 14-digit integer timestamp matching a partial timestamp, e.g. 2019 -> 20190000000000.
+    """
+    return int(str(partial_ts).ljust(14, '0'))
+
+
+def upper_bound(partial_ts):
+    """
+    Latest 14-digit integer timestamp matching a partial timestamp, e.g. 2019 -> 20199999999999.
+    """
+    return int(str(partial_ts).ljust(14, '9'))
+
+
+class CaptureIndex:
+    """
+    The captures of a URL, as (timestamp, warc_file, offset, length) columns sorted by timestamp.
+    """
+    __slots__ = ('timestamps', 'files', 'offsets', 'lengths', 'filenames', '_file_ids')
+
+    def __init__(self, captures=()):
+        """
+        :param captures: (capture_date, warc_file, compressed_offset, compressed_end_offset) tuples
+        """
+        self.timestamps = array('Q')
+        self.files = array('I')
+        self.offsets = array('Q')
+        self.lengths = array('q')
+        self.filenames = []
+        self._file_ids = {}
+        for capture in captures:
+            self.append(*capture)
+        self.sort()
+
+    def append(self, timestamp, warc_file, offset, length=None):
+        """
+        Adds a capture. This does not keep the index sorted, so call sort() once all the captures have been added.
+        """
+        file_id = self._file_ids.get(warc_file)
+        if file_id is None:
+            file_id = len(self.filenames)
+            self.filenames.append(warc_file)
+            self._file_ids[warc_file] = file_id
+        self.timestamps.append(int(timestamp))
+        self.files.append(file_id)
+        self.offsets.append(int(offset))
+        self.lengths.append(int(length) if length not in (None, '-') else NO_LENGTH)
+
+    def sort(self):
+        """
+        Puts the captures in timestamp order. CDX results usually come in order, so this is usually just a check.
+        """
+        ts = self.timestamps
+        if all(ts[i] <= ts[i+1] for i in range(len(ts) - 1)):
+            return
+        order = sorted(range(len(ts)), key=ts.__getitem__)
+        self.timestamps = array('Q', (ts[i] for i in order))
+        self.files = array('I', (self.files[i] for i in order))
+        self.offsets = array('Q', (self.offsets[i] for i in order))
+        self.lengths = array('q', (self.lengths[i] for i in order))
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, i):
+        """
+        :return: the capture as a (capture_date, warc_file, compressed_offset, compressed_end_offset) tuple
+        """
+        return '%014d' % self.timestamps[i], self.filenames[self.files[i]], self.offsets[i], self.length(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def length(self, i):
+        length = self.lengths[i]
+        return length if length != NO_LENGTH else None
+
+    def record(self, i):
+        """
+        :return: where to find the capture, as a (warc_file, compressed_offset, compressed_end_offset) tuple
+        """
+        return self.filenames[self.files[i]], self.offsets[i], self.length(i)
+
+    def nbytes(self):
+        """
+        Approximate memory used by the columns, not including the filenames.
+        """
+        return sum(column.itemsize * len(column) for column in (self.timestamps, self.files, self.offsets, self.lengths))
+
+    def _subset(self, selection):
+        subset = CaptureIndex()
+        if isinstance(selection, slice):
+            subset.timestamps = self.timestamps[selection]
+            subset.files = self.files[selection]
+            subset.offsets = self.offsets[selection]
+            subset.lengths = self.lengths[selection]
+        else:
+            subset.timestamps = array('Q', (self.timestamps[i] for i in selection))
+            subset.files = array('I', (self.files[i] for i in selection))
+            subset.offsets = array('Q', (self.offsets[i] for i in selection))
+            subset.lengths = array('q', (self.lengths[i] for i in selection))
+        # The file ids still refer to the same names:
+        subset.filenames = list(self.filenames)
+        subset._file_ids = dict(self._file_ids)
+        return subset
+
+    def closest(self, target_ts):
+        """
+        Finds the capture closest in time to the target timestamp, by binary search.
+
+        Only the neighbours of the insertion point need comparing, and ties go to the earlier capture.
+        Of several captures with the same timestamp, the last one in the CDX results is used, as it was
+        when the captures were held in a dict keyed by timestamp.
+
+        :return: the position of the closest capture, or None if there are no captures
+        """
+        if len(self) == 0:
+            return None
+        target = int(target_ts)
+        i = bisect.bisect_left(self.timestamps, target)
+        target_seconds = timestamp_seconds(target)
+        matched, matched_delta = None, None
+        for j in range(max(0, i-1), min(i+1, len(self))):
+            delta = abs(timestamp_seconds(self.timestamps[j]) - target_seconds)
+            if matched_delta is None or delta < matched_delta:
+                matched, matched_delta = j, delta
+        return bisect.bisect_right(self.timestamps, self.timestamps[matched]) - 1
+
+    def range(self, from_ts=None, to_ts=None):
+        """
+        Selects the captures between two (possibly partial, e.g. YYYYMM) timestamps, inclusive.
+        """
+        start = bisect.bisect_left(self.timestamps, lower_bound(from_ts)) if from_ts else 0
+        end = bisect.bisect_right(self.timestamps, upper_bound(to_ts)) if to_ts else len(self)
+        return self._subset(slice(start, end))
+
+    def collapse(self, digits, last=False):
+        """
+        Keeps only the first (or last) of each run of captures that share the first `digits` digits
+        of their timestamp, like the CDX API's collapseToFirst/collapseToLast=timestamp:N.
+        """
+        divisor = 10 ** (14 - int(digits))
+        keep = []
+        previous = None
+        for i, ts in enumerate(self.timestamps):
+            key = ts // divisor
+            if key != previous:
+                keep.append(i)
+                previous = key
+            elif last:
+                keep[-1] = i
+        return self._subset(keep)
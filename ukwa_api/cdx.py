@@ -1,10 +1,14 @@
+import io
 import os
+import re
+import sys
+import zlib
 import logging
 import datetime
 import requests
-import xml.dom.minidom
 
 from fastapi import HTTPException
+from lxml import etree
 
 from requests.utils import quote
 from collections import OrderedDict
@@ -12,16 +16,32 @@ from collections import OrderedDict
 from warcio.recordloader import ArcWarcRecordLoader
 from warcio.bufferedreaders import DecompressingBufferedReader
 
+from .clients import get_client
+from .access_cache import access_cache
+from .captures import CaptureIndex
+from .cdx_cache import cdx_cache
+from .warc_storage import WarcReadError, warc_storage, webhdfs_url
+from .warc_cache import warc_block_cache
+
 # Get the Wayback endpoint to check for access rights:
 # (default to OA one so we don't do the wrong thing if this is unset)
 WAYBACK_SERVER = os.environ.get("WAYBACK_SERVER", "https://www.webarchive.org.uk/wayback/archive/")
 
+# Optionally, use a dedicated endpoint for access checks (the URL is appended to this prefix),
+# and the HTTP method to use (falls back to GET if HEAD is not supported):
+ACCESS_CHECK_SERVER = os.environ.get("ACCESS_CHECK_SERVER", WAYBACK_SERVER)
+ACCESS_CHECK_METHOD = os.environ.get("ACCESS_CHECK_METHOD", "HEAD")
+
 # Get the location of the CDX server:
 CDX_SERVER = os.environ.get("CDX_SERVER", "http://cdx.api.wa.bl.uk/data-heritrix")
 
-# Get the WebHDFS service:
-WEBHDFS_PREFIX = os.environ.get('WEBHDFS_PREFIX', 'http://warc-server.api.wa.bl.uk/webhdfs/v1/by-filename/')
-WEBHDFS_USER = os.environ.get('WEBHDFS_USER', 'access')
+# How many captures to ask the CDX server for when looking for the closest one (0 to list them all):
+CDX_CLOSEST_LIMIT = int(os.environ.get("CDX_CLOSEST_LIMIT", 10))
+
+# Size of the chunks to read CDX responses in:
+CDX_CHUNK_SIZE = 64*1024
+# The most that a WARC record's headers are expected to take up:
+WARC_MAX_HEADER_SIZE = 64*1024
 
 # Formats
 WAYBACK_TS_FORMAT = '%Y%m%d%H%M%S'
@@ -40,12 +60,58 @@ def can_access(url):
     """
     qurl = "%s%s" %(WAYBACK_SERVER, url)
     logger.info("Checking access at %s" % qurl)
-    #with httpx.AsyncClient() as client: ???
     r = requests.get(qurl)
-    if r.status_code < 200 or r.status_code >= 400:
-        logger.warn("Got %i %s" % (r.status_code, r.reason) )
-        if r.status_code != None:
-            raise HTTPException(status_code=r.status_code, detail=r.reason)
+    return _check_access_status(r.status_code, r.reason)
+
+
+async def can_access_async(url):
+    """
+    Checks if access to this URL is allowed, without blocking the event loop.
+
+    Decisions are cached, and concurrent checks for the same URL are coalesced.
+
+    :return: True/False
+    """
+    status_code, reason = await access_cache.lookup(url, access_checker)
+    return _check_access_status(status_code, reason)
+
+
+class AccessChecker:
+    """
+    Asks the access service about URLs, falling back on GET if it turns out not to support the configured method.
+    """
+
+    def __init__(self, server=ACCESS_CHECK_SERVER, method=ACCESS_CHECK_METHOD):
+        self.server = server
+        self.method = method
+
+    async def __call__(self, url):
+        """
+        :return: the (status_code, reason) of the access service's response
+        """
+        qurl = "%s%s" %(self.server, url)
+        logger.info("Checking access at %s" % qurl)
+        method = self.method
+        # Only the status is needed, so don't read the body, but follow redirects as requests.get does:
+        async with get_client().stream(method, qurl, follow_redirects=True) as r:
+            status_code, reason = r.status_code, r.reason_phrase
+        # Fall back on GET if HEAD is not supported:
+        if status_code in (405, 501) and method != 'GET':
+            logger.warning("Access check using %s not supported, switching to GET." % method)
+            self.method = 'GET'
+            return await self(url)
+        return status_code, reason
+
+
+# The shared access checker:
+access_checker = AccessChecker()
+
+
+def _check_access_status(status_code, reason):
+    if status_code < 200 or status_code >= 400:
+        logger.warn("Got %i %s" % (status_code, reason) )
+        if status_code != None:
+            raise HTTPException(status_code=status_code, detail=reason)
         else:
             raise HTTPException(status_code=500)
 
@@ -58,37 +124,139 @@ def lookup_in_cdx(qurl, target_date=None):
 
     :return:
     """
-    matches = list_from_cdx(qurl)
-    if len(matches) == 0:
-        return None, None, None
+    target_ts = _target_timestamp(target_date)
+    captures = None
+    if CDX_CLOSEST_LIMIT > 0:
+        captures = list_closest_from_cdx(qurl, target_ts)
+    if captures is None:
+        captures = index_from_cdx(qurl)
+    return _closest_match(captures, target_ts)
+
+
+async def lookup_in_cdx_async(qurl, target_date=None):
+    """
+    Checks if a resource is in the CDX index, closest to a specific date, without blocking the event loop.
+
+    :return:
+    """
+    target_ts = _target_timestamp(target_date)
+    captures = None
+    if CDX_CLOSEST_LIMIT > 0:
+        captures = await list_closest_from_cdx_async(qurl, target_ts)
+    if captures is None:
+        captures = await index_from_cdx_async(qurl)
+    return _closest_match(captures, target_ts)
 
-    # Set up default:
+
+def _target_timestamp(target_date=None):
+    # Default to now, and allow ISO date format, or 14-digit format:
     if target_date is None:
-        target_dt = datetime.datetime.now()
-    else:
-        # Allow ISO date format, or 14-digit format:
-        try:
-            target_dt = datetime.datetime.strptime(target_date, ISO_TS_FORMAT)
-        except:
-            target_dt = datetime.datetime.strptime(target_date, WAYBACK_TS_FORMAT)
-
-    # Go through looking for the closest match:
-    matched_date = None
-    matched_ts = None
-    for ts in matches:
-        wb_date = datetime.datetime.strptime(ts, WAYBACK_TS_FORMAT)
-        logger.debug("MATCHING: %s %s %s %s" %(matched_date, target_dt, wb_date, ts))
-        logger.debug("DELTA:THIS: %i" %(wb_date-target_dt).total_seconds())
-        if matched_date:
-            logger.debug("DELTA:MATCH: %i" % (matched_date-target_dt).total_seconds())
-        if matched_date is None or abs((wb_date-target_dt).total_seconds()) < \
-                abs((matched_date-target_dt).total_seconds()):
-            matched_date = wb_date
-            matched_ts = ts
-            logger.debug("MATCHED: %s %s" %(matched_date, ts))
-        logger.debug("FINAL MATCH: %s %s" %(matched_date, ts))
-
-    return matches[matched_ts]
+        return datetime.datetime.now().strftime(WAYBACK_TS_FORMAT)
+    try:
+        return datetime.datetime.strptime(target_date, ISO_TS_FORMAT).strftime(WAYBACK_TS_FORMAT)
+    except ValueError:
+        return datetime.datetime.strptime(target_date, WAYBACK_TS_FORMAT).strftime(WAYBACK_TS_FORMAT)
+
+
+def _closest_match(captures, target_ts):
+    if len(captures) == 0:
+        return None, None, None
+
+    i = captures.closest(target_ts)
+    logger.debug("MATCHED: %s for target %s" % (captures[i][0], target_ts))
+
+    return captures.record(i)
+
+
+def list_closest_from_cdx(qurl, target_ts, limit=None):
+    """
+    Asks the CDX server for just the captures closest to the target timestamp.
+
+    :return: a CaptureIndex, or None if the CDX server could not handle the query
+    """
+    params = _closest_params(qurl, target_ts, limit)
+    r = requests.get(CDX_SERVER, params=params)
+    logger.debug("Closest query response: %d" % r.status_code)
+    if r.status_code != 200:
+        return None
+    return CaptureIndex(_iter_cdx11(r.text))
+
+
+async def list_closest_from_cdx_async(qurl, target_ts, limit=None):
+    """
+    Asks the CDX server for just the captures closest to the target timestamp, without blocking the event loop.
+
+    Results are cached across workers.
+
+    :return: a CaptureIndex, or None if the CDX server could not handle the query
+    """
+    params = _closest_params(qurl, target_ts, limit)
+    key = "closest:%s:%s:%s" % (params['limit'], target_ts, qurl)
+    return await cdx_cache.get_or_fetch(key, lambda: _fetch_closest(params))
+
+
+async def _fetch_closest(params):
+    r = await get_client().get(CDX_SERVER, params=params)
+    logger.debug("Closest query response: %d" % r.status_code)
+    if r.status_code != 200:
+        return None
+    return CaptureIndex(_iter_cdx11(r.text))
+
+
+def _closest_params(qurl, target_ts, limit=None):
+    return {
+        'url': qurl,
+        'sort': 'closest',
+        'closest': target_ts,
+        'limit': limit or CDX_CLOSEST_LIMIT,
+    }
+
+
+def _iter_cdx11(text):
+    # Fields: urlkey timestamp original mimetype statuscode digest redirecturl robotflags length offset filename
+    for line in text.splitlines():
+        fields = line.split(' ')
+        if len(fields) < 11:
+            continue
+        yield fields[1], fields[10], fields[9], fields[8]
+
+
+def index_from_cdx(qurl):
+    """
+    Checks if a resource is in the CDX index.
+
+    :return: a CaptureIndex of the matches
+    """
+    try:
+        return CaptureIndex(iter_from_cdx(qurl))
+    except Exception as e:
+        logger.error("Lookup failed for %s!" % qurl)
+        logger.exception(e)
+        return CaptureIndex()
+
+
+async def index_from_cdx_async(qurl):
+    """
+    Checks if a resource is in the CDX index, without blocking the event loop.
+
+    Results are cached across workers.
+
+    :return: a CaptureIndex of the matches
+    """
+    try:
+        return await cdx_cache.get_or_fetch("index:%s" % qurl, lambda: _fetch_index(qurl))
+    except Exception as e:
+        logger.error("Lookup failed for %s!" % qurl)
+        logger.exception(e)
+        return CaptureIndex()
+
+
+async def _fetch_index(qurl):
+    captures = CaptureIndex()
+    async for capture in iter_from_cdx_async(qurl):
+        captures.append(*capture)
+    captures.sort()
+    return captures
 
 
 def list_from_cdx(qurl):
@@ -97,31 +265,120 @@ def list_from_cdx(qurl):
 
     :return: a list of matches by timestamp
     """
+    result_set = OrderedDict()
+    try:
+        for capture_date, warc_file, compressed_offset, compressed_end_offset in iter_from_cdx(qurl):
+            result_set[capture_date] = warc_file, compressed_offset, compressed_end_offset
+    except Exception as e:
+        logger.error("Lookup failed for %s!" % qurl)
+        logger.exception(e)
+
+    return result_set
+
+
+async def list_from_cdx_async(qurl):
+    """
+    Checks if a resource is in the CDX index, without blocking the event loop.
+
+    :return: a list of matches by timestamp
+    """
+    result_set = OrderedDict()
+    try:
+        async for capture_date, warc_file, compressed_offset, compressed_end_offset in iter_from_cdx_async(qurl):
+            result_set[capture_date] = warc_file, compressed_offset, compressed_end_offset
+    except Exception as e:
+        logger.error("Lookup failed for %s!" % qurl)
+        logger.exception(e)
+
+    return result_set
+
+
+def iter_from_cdx(qurl):
+    """
+    Streams the captures of a resource from the CDX index, parsing them as they arrive.
+
+    :return: an iterator of (capture_date, warc_file, compressed_offset, compressed_end_offset) tuples
+    """
     query = "%s?q=type:urlquery+url:%s" % (CDX_SERVER, quote(qurl))
     logger.debug("Querying: %s" % query)
-    r = requests.get(query)
-    logger.debug("Availability response: %d" % r.status_code)
-    result_set = OrderedDict()
-    # Is it known, with a matching timestamp?
-    if r.status_code == 200:
-        try:
-            dom = xml.dom.minidom.parseString(r.text)
-            for result in dom.getElementsByTagName('result'):
-                warc_file = result.getElementsByTagName('file')[0].firstChild.nodeValue
-                compressed_offset = result.getElementsByTagName('compressedoffset')[0].firstChild.nodeValue
-                capture_date = result.getElementsByTagName('capturedate')[0].firstChild.nodeValue
+    with requests.get(query, stream=True) as r:
+        logger.debug("Availability response: %d" % r.status_code)
+        # Is it known, with a matching timestamp?
+        if r.status_code == 200:
+            parser = CdxXmlParser()
+            for chunk in r.iter_content(chunk_size=CDX_CHUNK_SIZE):
+                yield from parser.feed(chunk)
+            yield from parser.close()
+
+
+async def iter_from_cdx_async(qurl):
+    """
+    Streams the captures of a resource from the CDX index, parsing them as they arrive, without blocking the event loop.
+
+    :return: an async iterator of (capture_date, warc_file, compressed_offset, compressed_end_offset) tuples
+    """
+    query = "%s?q=type:urlquery+url:%s" % (CDX_SERVER, quote(qurl))
+    logger.debug("Querying: %s" % query)
+    async with get_client().stream('GET', query) as r:
+        logger.debug("Availability response: %d" % r.status_code)
+        # Is it known, with a matching timestamp?
+        if r.status_code == 200:
+            parser = CdxXmlParser()
+            async for chunk in r.aiter_bytes(CDX_CHUNK_SIZE):
+                for capture in parser.feed(chunk):
+                    yield capture
+            for capture in parser.close():
+                yield capture
+
+
+class CdxXmlParser:
+    """
+    Incremental parser for the XML (type:urlquery) output of the CDX server.
+
+    Data can be fed in as it arrives. Each <result> element is turned into a compact
+    (capture_date, warc_file, compressed_offset, compressed_end_offset) tuple and then
+    discarded, so memory use does not grow with the number of captures.
+    """
+
+    def __init__(self):
+        self._parser = etree.XMLPullParser(events=('end',), tag='result')
+
+    def feed(self, data):
+        """
+        Adds some data, returning an iterator of any captures that are now complete.
+        """
+        self._parser.feed(data)
+        return self._captures()
+
+    def close(self):
+        """
+        Marks the end of the data, returning an iterator of any remaining captures.
+        """
+        self._parser.close()
+        return self._captures()
+
+    def _captures(self):
+        for event, result in self._parser.read_events():
+            warc_file, compressed_offset, capture_date, compressed_end_offset = None, None, None, None
+            for field in result:
+                if field.tag == 'file':
+                    # Many captures share a WARC file, so only keep one copy of each name:
+                    warc_file = sys.intern(field.text)
+                elif field.tag == 'compressedoffset':
+                    compressed_offset = field.text
+                elif field.tag == 'capturedate':
+                    capture_date = field.text
                 # Support compressed record length if present:
-                compressed_end_offset_elem = result.getElementsByTagName('compressedendoffset')
-                if len(compressed_end_offset_elem) > 0:
-                    compressed_end_offset = compressed_end_offset_elem[0].firstChild.nodeValue
-                else:
-                    compressed_end_offset = None
-                result_set[capture_date] = warc_file, compressed_offset, compressed_end_offset
-        except Exception as e:
-            logger.error("Lookup failed for %s!" % qurl)
-            logger.exception(e)
+                elif field.tag == 'compressedendoffset':
+                    compressed_end_offset = field.text
+            yield capture_date, warc_file, compressed_offset, compressed_end_offset
+
+            # Drop the parsed elements so the tree does not grow:
+            result.clear()
+            parent = result.getparent()
+            while result.getprevious() is not None:
+                del parent[0]
 
-    return result_set
 
 def get_warc_stream(warc_filename, warc_offset, compressedendoffset, payload_only=True):
     """
@@ -132,9 +389,7 @@ def get_warc_stream(warc_filename, warc_offset, compressedendoffset, payload_onl
         return None, None
 
     # Grab the payload from the WARC and return it.
-    url = "%s%s?op=OPEN&user.name=%s&offset=%s" % (WEBHDFS_PREFIX, warc_filename, WEBHDFS_USER, warc_offset)
-    if compressedendoffset and int(compressedendoffset) > 0:
-        url = "%s&length=%s" % (url, compressedendoffset)
+    url = webhdfs_url(warc_filename, warc_offset, compressedendoffset)
     r = requests.get(url, stream=True)
     # We handle decoding etc.
     r.raw.decode_content = False
@@ -154,3 +409,115 @@ def get_warc_stream(warc_filename, warc_offset, compressedendoffset, payload_onl
         return s, 'application/warc'
 
 
+async def open_warc_record_async(warc_filename, warc_offset, compressedendoffset, first=0, last=None):
+    """
+    Opens a streaming read of the raw (usually compressed) bytes of a WARC record, from the configured storage.
+
+    If first and/or last are given, only those bytes of the record (inclusive) are requested.
+
+    :return: the httpx (or httpx-like) streaming response, which the caller must close
+    """
+    length = int(compressedendoffset) if compressedendoffset and int(compressedendoffset) > 0 else None
+    if last is not None:
+        length = last - first + 1
+    elif length is not None:
+        length = length - first
+    offset = int(warc_offset) + first
+    # Read remote storage through the block cache where possible, falling back on a direct read if that fails, to report the error:
+    if warc_storage.remote and warc_block_cache.cacheable(length):
+        try:
+            return await warc_block_cache.open(warc_filename, offset, length)
+        except WarcReadError as e:
+            logger.warning("Reading %s via the block cache failed: %s" % (warc_filename, e))
+    r = await warc_storage.open(warc_filename, offset, length)
+    logger.info("Loading from: %s" % r.url)
+    logger.info("Got status code %s" % r.status_code)
+    return r
+
+
+async def get_warc_stream_async(warc_filename, warc_offset, compressedendoffset, payload_only=True):
+    """
+    Grabs a resource, without blocking the event loop.
+
+    If payload_only is False, the stream is an async iterator over the (decompressed) WARC record.
+    Otherwise, the record is read in and parsed, and the stream is a file-like object for the payload.
+    """
+    # If not found, say so:
+    if warc_filename is None:
+        return None, None
+
+    # Open a streaming read of the record:
+    r = await open_warc_record_async(warc_filename, warc_offset, compressedendoffset)
+    record_stream = aiter_first_member(r)
+
+    # Return the payload, or the record:
+    if payload_only:
+        # Read the record in and parse it, returning the payload:
+        buffer = io.BytesIO()
+        async for chunk in record_stream:
+            buffer.write(chunk)
+        buffer.seek(0)
+        rl = ArcWarcRecordLoader()
+        record = rl.parse_record_stream(DecompressingBufferedReader(stream=buffer, decomp_type=None))
+        return record.content_stream(), record.content_type
+    else:
+        return record_stream, 'application/warc'
+
+
+async def peek_record_size(chunks):
+    """
+    Works out the size of an uncompressed WARC record from its headers, by reading the start of it.
+
+    :return: (size, or None if it can't be worked out, and an async iterator over all of the record)
+    """
+    head = b''
+    async for chunk in chunks:
+        head += chunk
+        if b'\r\n\r\n' in head or len(head) > WARC_MAX_HEADER_SIZE:
+            break
+
+    size = None
+    end = head.find(b'\r\n\r\n')
+    if head.startswith(b'WARC/') and end >= 0:
+        match = re.search(rb'(?im)^content-length:[ \t]*(\d+)[ \t]*$', head[:end])
+        if match:
+            # The headers, the blank line, the content and the two line breaks that end the record:
+            size = end + 4 + int(match.group(1)) + 4
+
+    async def replay():
+        yield head
+        async for chunk in chunks:
+            yield chunk
+
+    return size, replay()
+
+
+async def aiter_first_member(r, strict=False):
+    """
+    Iterates over the decompressed bytes of the first GZip member of a streaming response,
+    passing the data through unchanged if it is not compressed.
+
+    If `strict` is set, raises an IOError if the response ends part-way through the member.
+    """
+    try:
+        decompressor = None
+        async for chunk in r.aiter_raw():
+            if decompressor is None:
+                if chunk[:2] == b'\x1f\x8b':
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    decompressor = False
+            if decompressor:
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+                # This makes sure we only get the first GZip chunk:
+                if decompressor.eof:
+                    break
+            else:
+                yield chunk
+        else:
+            if strict and decompressor and not decompressor.eof:
+                raise IOError("Response ended part-way through a GZip member.")
+    finally:
+        await r.aclose()
@@ -0,0 +1,244 @@
+"""
+Caching of CDX lookup results, shared across all the gunicorn workers.
+
+Results (CaptureIndex objects) are held for CDX_CACHE_TTL seconds. After that, for up to a further
+CDX_CACHE_STALE_TTL seconds, the stale result is returned straight away while a fresh one is fetched
+in the background (stale-while-revalidate). Concurrent fetches of the same key are coalesced.
+
+The storage is pluggable, using the cachelib interface. CDX_CACHE_TYPE can be:
+
+- 'sqlite' for a size-bounded LRU cache in a local SQLite file shared by all workers (the default),
+- 'memory' for an in-process LRU cache,
+- 'redis' to use Redis or anything compatible with it (requires the 'redis' package),
+- 'none' to disable caching.
+"""
+import os
+import time
+import pickle
+import sqlite3
+import asyncio
+import logging
+import threading
+
+import anyio
+from cachelib import BaseCache, NullCache, RedisCache
+from prometheus_client import Gauge
+
+from .access_cache import LRUCache
+
+CACHE_FOLDER = os.environ.get("CACHE_FOLDER", ".")
+CDX_CACHE_TYPE = os.environ.get("CDX_CACHE_TYPE", "sqlite")
+CDX_CACHE_PATH = os.environ.get("CDX_CACHE_PATH", os.path.join(CACHE_FOLDER, 'cdx_cache.sqlite'))
+CDX_CACHE_TTL = int(os.environ.get("CDX_CACHE_TTL", 10*60))
+CDX_CACHE_STALE_TTL = int(os.environ.get("CDX_CACHE_STALE_TTL", 60*60))
+CDX_CACHE_MAX_ENTRIES = int(os.environ.get("CDX_CACHE_MAX_ENTRIES", 100000))
+CDX_CACHE_MAX_BYTES = int(os.environ.get("CDX_CACHE_MAX_BYTES", 256*1024*1024))
+CDX_CACHE_REDIS_HOST = os.environ.get("CDX_CACHE_REDIS_HOST", "localhost")
+CDX_CACHE_REDIS_PORT = int(os.environ.get("CDX_CACHE_REDIS_PORT", 6379))
+
+# The cache table, plus a single-row table of its totals, kept up to date by triggers.
+# The totals are worked out from scratch when the table is first added (e.g. to an existing cache file),
+# all in one transaction, so other processes can't make changes in the meantime:
+SQLITE_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL, size INTEGER);
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), entries INTEGER, size INTEGER);
+INSERT OR IGNORE INTO totals SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM cache;
+CREATE TRIGGER IF NOT EXISTS cache_insert AFTER INSERT ON cache BEGIN
+    UPDATE totals SET entries = entries + 1, size = size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_update AFTER UPDATE OF size ON cache BEGIN
+    UPDATE totals SET size = size - old.size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_delete AFTER DELETE ON cache BEGIN
+    UPDATE totals SET entries = entries - 1, size = size - old.size;
+END;
+COMMIT;
+"""
+
+# Create a logger, beneath the Uvicorn error logger:
+logger = logging.getLogger(f"uvicorn.error.{__name__}")
+
+# Cache metrics. These are reported per worker (the pid is added when using the Prometheus multiprocess mode):
+CDX_CACHE_LOOKUPS = Gauge('ukwa_api_cdx_cache_lookups', 'CDX cache lookups handled by this worker, by result (hit, stale, miss or coalesced).',
+    labelnames=('result',), multiprocess_mode='liveall')
+CDX_CACHE_SIZE = Gauge('ukwa_api_cdx_cache_size', 'Size of the shared CDX cache, as last seen by this worker, in entries or bytes.',
+    labelnames=('unit',), multiprocess_mode='liveall')
+
+
+class SQLiteCache(BaseCache):
+    """
+    LRU cache in a local SQLite file, which can be shared safely between processes.
+
+    Entries are evicted least-recently-used first, once there are more than max_entries or they add up
+    to more than max_bytes. The totals are kept up to date by triggers, so checking them is cheap, and
+    correct whichever process made the changes.
+    """
+
+    def __init__(self, path, max_entries=CDX_CACHE_MAX_ENTRIES, max_bytes=CDX_CACHE_MAX_BYTES, default_timeout=300):
+        super().__init__(default_timeout)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def _db(self):
+        # Connections must not be shared across a fork, so open one per process:
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            try:
+                self._connection.executescript(SQLITE_SCHEMA)
+            except sqlite3.Error:
+                if self._connection.in_transaction:
+                    self._connection.execute("ROLLBACK")
+                raise
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] and row[1] < now:
+                db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            db.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        now = time.time()
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            db = self._db()
+            # An upsert rather than a replace, so the totals triggers see it as an update:
+            db.execute("INSERT INTO cache (key, value, expires, accessed, size) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires, "
+                "accessed = excluded.accessed, size = excluded.size",
+                (key, data, now + timeout if timeout else 0, now, len(data)))
+            self._evict(db)
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def _evict(self, db):
+        entries, size = self._stats(db)
+        while entries > self.max_entries or size > self.max_bytes:
+            # Drop the least recently used tenth of the entries beyond the limits, plus one:
+            excess = max(entries - self.max_entries, 0) + entries // 10 + 1
+            db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)", (excess,))
+            entries, size = self._stats(db)
+
+    def _stats(self, db):
+        entries, size = db.execute("SELECT entries, size FROM totals").fetchone()
+        return entries, size
+
+    def stats(self):
+        """
+        :return: (entries, bytes) currently in the cache
+        """
+        with self._lock:
+            return self._stats(self._db())
+
+    def delete(self, key):
+        with self._lock:
+            return self._db().execute("DELETE FROM cache WHERE key = ?", (key,)).rowcount > 0
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._db().execute("DELETE FROM cache")
+        return True
+
+
+def create_backend(cache_type=CDX_CACHE_TYPE):
+    """
+    Sets up the configured cache backend.
+    """
+    if cache_type == 'sqlite':
+        return SQLiteCache(CDX_CACHE_PATH)
+    elif cache_type == 'memory':
+        return LRUCache(maxsize=CDX_CACHE_MAX_ENTRIES)
+    elif cache_type == 'redis':
+        return RedisCache(host=CDX_CACHE_REDIS_HOST, port=CDX_CACHE_REDIS_PORT, key_prefix='cdx:')
+    elif cache_type == 'none':
+        return NullCache()
+    raise ValueError(f"Unknown CDX_CACHE_TYPE: {cache_type}")
+
+
+class CdxCache:
+    """
+    Caches CDX lookup results, serving stale results while revalidating, and coalescing concurrent fetches.
+    """
+
+    def __init__(self, backend, ttl=CDX_CACHE_TTL, stale_ttl=CDX_CACHE_STALE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._inflight = {}
+
+    async def get_or_fetch(self, key, fetch):
+        """
+        Returns the cached result for the key, or awaits fetch() to get one.
+
+        Results of None are not cached.
+        """
+        # The backend may do disk or network I/O, so keep it off the event loop:
+        entry = await anyio.to_thread.run_sync(self.backend.get, key)
+        if entry is not None:
+            stored, value = entry
+            if time.time() - stored < self.ttl:
+                CDX_CACHE_LOOKUPS.labels('hit').inc()
+            else:
+                # Return the stale value now, and refresh it in the background:
+                CDX_CACHE_LOOKUPS.labels('stale').inc()
+                self._refresh(key, fetch)
+            return value
+
+        if key in self._inflight:
+            CDX_CACHE_LOOKUPS.labels('coalesced').inc()
+        else:
+            CDX_CACHE_LOOKUPS.labels('miss').inc()
+        # The fetch is shielded, so one caller giving up doesn't cancel it for the others:
+        return await asyncio.shield(self._refresh(key, fetch))
+
+    def _refresh(self, key, fetch):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._fetched(key, t))
+        return task
+
+    def _fetched(self, key, task):
+        self._inflight.pop(key, None)
+        # Make sure failed background refreshes get logged:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Fetching %s for the CDX cache failed: %s" % (key, task.exception()))
+
+    async def _fetch(self, key, fetch):
+        value = await fetch()
+        if value is not None:
+            await anyio.to_thread.run_sync(lambda: self.backend.set(key, (time.time(), value), timeout=self.ttl + self.stale_ttl))
+            if hasattr(self.backend, 'stats'):
+                entries, size = await anyio.to_thread.run_sync(self.backend.stats)
+                CDX_CACHE_SIZE.labels('entries').set(entries)
+                CDX_CACHE_SIZE.labels('bytes').set(size)
+        return value
+
+
+# The shared cache:
+cdx_cache = CdxCache(create_backend())
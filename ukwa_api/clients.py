@@ -0,0 +1,226 @@
+"""
+Shared, pooled HTTP clients for calling the back-end services.
+
+Each worker process holds one httpx.AsyncClient per upstream, so connections are kept alive
+and re-used across requests rather than being set up afresh every time (e.g. for every IIIF tile).
+Giving each upstream its own client means each gets its own connection limits, so a slow
+renderer can't use up all the connections needed to talk to the IIIF server.
+
+The clients are opened when the application starts up and closed when it shuts down, and are
+created lazily if used outside of that lifecycle (e.g. from scripts).
+
+The limits for each upstream can be configured via environment variables, e.g. for 'iiif':
+
+    IIIF_MAX_CONNECTIONS, IIIF_MAX_KEEPALIVE_CONNECTIONS, IIIF_KEEPALIVE_EXPIRY, IIIF_TIMEOUT
+
+which default to the corresponding HTTP_* settings.
+
+Requests in progress to each upstream are counted as they go through the client's transport, from
+being sent until the response has been closed. Requests sent via an HTTP proxy configured in the
+environment go through httpx's own proxy transports instead, so are not counted.
+"""
+import os
+import logging
+
+import anyio
+import httpx
+from prometheus_client import Gauge
+
+# Whether to negotiate HTTP/2 where the upstream supports it (requires the 'h2' package):
+HTTP2 = os.environ.get("HTTP2", "true").lower() in ("true", "1", "yes")
+
+# Default pool sizing and timeouts:
+MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 100))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 30.0))
+TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 5.0*60))
+
+# Default size of the chunks to pass streamed responses on in:
+STREAM_CHUNK_SIZE = 64*1024
+# How many chunks to pass on between checks for the client having gone away:
+DISCONNECT_CHECK_INTERVAL = 16
+
+# The upstreams, and whether to honour any HTTP proxy set in the environment:
+UPSTREAMS = {
+    # Wayback, OutbackCDX and WebHDFS:
+    'backend': { 'trust_env': True },
+    # The IIIF server is always an internal service:
+    'iiif': { 'trust_env': False },
+    # The web rendering service:
+    'webrender': { 'trust_env': True },
+}
+
+# Headers that only apply to a single connection, so must not be passed on by a proxy (RFC 7230 section 6.1):
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade',
+}
+
+# Create a logger, beneath the Uvicorn error logger:
+logger = logging.getLogger(f"uvicorn.error.{__name__}")
+
+# The per-worker clients:
+_clients = {}
+
+# Upstream usage metrics:
+UPSTREAM_REQUESTS = Gauge('ukwa_api_http_upstream_requests', 'Requests in progress to upstream services, by state (waiting for a response, or streaming one).',
+    labelnames=('upstream', 'state'), multiprocess_mode='livesum')
+
+
+def _setting(upstream, name, default, cast):
+    return cast(os.environ.get(f"{upstream.upper()}_{name}", default))
+
+
+class CountedStream(httpx.AsyncByteStream):
+    """
+    A response body that counts as streaming until it is closed.
+    """
+
+    def __init__(self, stream, gauge):
+        self._stream = stream
+        self._gauge = gauge
+        self._closed = False
+        gauge.inc()
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._gauge.dec()
+        # Shielded, as the pool only lets go of the request once this is done, and httpx may call it from within a read that is being cancelled:
+        with anyio.CancelScope(shield=True):
+            await self._stream.aclose()
+
+
+class CountingTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps a transport, keeping count of the requests in progress through it.
+    """
+
+    def __init__(self, transport, upstream):
+        self._transport = transport
+        self._waiting = UPSTREAM_REQUESTS.labels(upstream, 'waiting')
+        self._streaming = UPSTREAM_REQUESTS.labels(upstream, 'streaming')
+
+    async def handle_async_request(self, request):
+        # Waiting covers queueing for a pooled connection as well as the upstream working out its response:
+        self._waiting.inc()
+        try:
+            response = await self._transport.handle_async_request(request)
+        finally:
+            self._waiting.dec()
+        return httpx.Response(status_code=response.status_code, headers=response.headers,
+            stream=CountedStream(response.stream, self._streaming), extensions=response.extensions)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def _create_client(upstream):
+    max_connections = _setting(upstream, 'MAX_CONNECTIONS', MAX_CONNECTIONS, int)
+    logger.info("Creating HTTP client for %s (http2=%s, max_connections=%i)" % (upstream, HTTP2, max_connections))
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=_setting(upstream, 'MAX_KEEPALIVE_CONNECTIONS', MAX_KEEPALIVE_CONNECTIONS, int),
+        keepalive_expiry=_setting(upstream, 'KEEPALIVE_EXPIRY', KEEPALIVE_EXPIRY, float),
+    )
+    trust_env = UPSTREAMS[upstream]['trust_env']
+    return httpx.AsyncClient(
+        http2=HTTP2,
+        limits=limits,
+        timeout=_setting(upstream, 'TIMEOUT', TIMEOUT, float),
+        trust_env=trust_env,
+        transport=CountingTransport(httpx.AsyncHTTPTransport(http2=HTTP2, limits=limits, trust_env=trust_env), upstream),
+    )
+
+
+def get_client(upstream='backend'):
+    """
+    Returns the shared client for the given upstream, creating it if needed.
+    """
+    client = _clients.get(upstream)
+    if client is None or client.is_closed:
+        client = _create_client(upstream)
+        _clients[upstream] = client
+    return client
+
+
+async def open_clients():
+    """
+    Sets up the clients for all the upstreams.
+    """
+    for upstream in UPSTREAMS:
+        get_client(upstream)
+
+
+async def close_clients():
+    """
+    Closes all the clients.
+    """
+    for upstream in list(_clients):
+        await _clients.pop(upstream).aclose()
+
+
+def end_to_end_headers(headers, exclude=()):
+    """
+    Filters out hop-by-hop headers (including any named in the Connection header), plus any others in `exclude`.
+
+    :return: a list of (name, value) pairs
+    """
+    drop = set(HOP_BY_HOP_HEADERS) | {name.lower() for name in exclude}
+    for value in headers.get('connection', '').split(','):
+        drop.add(value.strip().lower())
+    return [(name, value) for (name, value) in headers.items() if name.lower() not in drop]
+
+
+async def grow_chunks(chunks, chunk_size, max_chunk_size):
+    """
+    Gathers an async iterator of byte chunks into ever larger chunks, doubling in size from
+    chunk_size up to max_chunk_size, so big downloads get passed on in fewer, larger writes.
+    """
+    pending, pending_size = [], 0
+    async for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= chunk_size:
+            yield pending[0] if len(pending) == 1 else b''.join(pending)
+            pending, pending_size = [], 0
+            chunk_size = min(chunk_size * 2, max_chunk_size)
+    if pending:
+        yield b''.join(pending)
+
+
+async def stream_upstream(r, request, chunk_size=STREAM_CHUNK_SIZE, raw=False, max_chunk_size=None, chunks=None):
+    """
+    Passes a streaming upstream response on, chunk by chunk, decoded unless `raw` is set.
+
+    The next chunk is only read once the previous one has been sent, so a slow client slows the
+    upstream query down rather than the data piling up here. If the client goes away, the response
+    is cancelled, and the upstream response is closed, which cancels the query. As a fallback, this
+    also checks for the client having gone every DISCONNECT_CHECK_INTERVAL chunks.
+
+    If max_chunk_size is set, the chunks grow from chunk_size up to that size as the download goes on.
+    To pass on something derived from the response (e.g. decompressed) instead, set `chunks` to an async
+    iterator over it.
+    """
+    if chunks is None and max_chunk_size:
+        chunks = r.aiter_raw() if raw else r.aiter_bytes()
+    elif chunks is None:
+        chunks = r.aiter_raw(chunk_size) if raw else r.aiter_bytes(chunk_size)
+    if max_chunk_size:
+        chunks = grow_chunks(chunks, chunk_size, max_chunk_size)
+    try:
+        sent = 0
+        async for chunk in chunks:
+            sent += 1
+            if sent % DISCONNECT_CHECK_INTERVAL == 0 and await request.is_disconnected():
+                logger.info("Client disconnected, cancelling upstream request to %s" % r.url)
+                break
+            yield chunk
+    finally:
+        # This may run as the response is being cancelled, so shield the close to make sure it happens:
+        with anyio.CancelScope(shield=True):
+            await r.aclose()
@@ -0,0 +1,143 @@
+"""
+Pre-computed derivatives of screenshots, so common IIIF Image API requests don't need the IIIF server
+to decode and rescale the full-page image every time.
+
+When a screenshot is made, a pyramid of tiles is built from it: IIIF_TILE_SIZE square tiles at scale
+factors 1, 2, 4, ... down to the level where the whole image fits in one tile, as IIIF_TILE_FORMAT images.
+Any other IIIF_DERIVATIVES (space-separated '{region}/{size}/{quality}.{format}' requests, e.g. the '600,'
+thumbnail the /mementos/screenshot redirect uses) are made at the same time, from the same decoded image.
+Each is also saved in the IIIF_NEGOTIATED_FORMATS, for clients that accept them.
+
+They are all kept in the shared screenshot store, alongside a small manifest recording the image size,
+so they are evicted along with everything else. Requests are matched on the pixels they ask for rather
+than how they are written, so e.g. 'full' and '0,0,1280,3000' are the same region of a 1280x3000 pixel
+screenshot. Anything else is passed on to the IIIF server.
+"""
+import os
+import json
+import math
+import logging
+
+import anyio
+from PIL import Image
+from prometheus_client import Counter
+
+from ..screenshots import open_image, to_rgb, encode, image_size, run_image_job
+from ..screenshot_store import screenshot_store
+from .image_api import FORMATS, IIIF_NEGOTIATED_FORMATS, parse_region, parse_size
+
+IIIF_TILE_SIZE = int(os.environ.get("IIIF_TILE_SIZE", 512))
+IIIF_TILE_FORMAT = os.environ.get("IIIF_TILE_FORMAT", "jpg")
+IIIF_DERIVATIVES = os.environ.get("IIIF_DERIVATIVES", "0,0,1024,1024/600,/default.png")
+IIIF_DERIVATIVE_JPEG_QUALITY = int(os.environ.get("IIIF_DERIVATIVE_JPEG_QUALITY", 95))
+
+# Create a logger, beneath the Uvicorn error logger:
+logger = logging.getLogger(f"uvicorn.error.{__name__}")
+
+IIIF_DERIVATIVE_REQUESTS = Counter('ukwa_api_iiif_derivative_requests', 'IIIF image requests, by whether a pre-computed derivative was used (hit) or not (miss).',
+    labelnames=('result',))
+IIIF_DERIVATIVES_BUILT = Counter('ukwa_api_iiif_derivatives_built', 'Pre-computed derivative images made.')
+
+
+def derivative_key(pwid, box, size, format):
+    """
+    The key a derivative is stored under, in terms of the pixels it covers, so equivalent requests match.
+    """
+    return "%s/%s/%s/default.%s" % (pwid, ','.join(map(str, box)), ','.join(map(str, size)), format)
+
+
+def manifest_key(pwid):
+    return "%s/derivatives" % pwid
+
+
+def make_derivatives(image, tile_size=IIIF_TILE_SIZE, tile_format=IIIF_TILE_FORMAT, extras=IIIF_DERIVATIVES,
+        formats=IIIF_NEGOTIATED_FORMATS):
+    """
+    Builds the tile pyramid and other derivatives of an image, each in its own format and in the given
+    formats that clients may be sent instead (see image_api.negotiate).
+
+    :return: (width, height) of the image, and a list of (box, size, format, payload) derivatives
+    """
+    img = to_rgb(open_image(image))
+    width, height = img.size
+    derivatives = []
+
+    def add(box, im, format, size=None):
+        # Tiles are asked for by width, so are stored under the size that asks for:
+        size = size or parse_size('%i,' % im.width, box[2], box[3])
+        for f in dict.fromkeys([format] + list(formats)):
+            derivatives.append((box, size, f, encode(im, f, IIIF_DERIVATIVE_JPEG_QUALITY)))
+
+    # Each level of the pyramid is made by halving the one before, averaging each 2x2 block of pixels:
+    levels = [img]
+    while True:
+        level, scale = levels[-1], 2 ** (len(levels) - 1)
+        for y in range(0, level.height, tile_size):
+            for x in range(0, level.width, tile_size):
+                tile = level.crop((x, y, min(x + tile_size, level.width), min(y + tile_size, level.height)))
+                box = (x * scale, y * scale, min(tile_size * scale, width - x * scale), min(tile_size * scale, height - y * scale))
+                add(box, tile, tile_format)
+        if level.width <= tile_size and level.height <= tile_size:
+            break
+        levels.append(level.reduce(2))
+
+    for extra in extras.split():
+        region, size, filename = extra.split('/')
+        format = filename.rsplit('.', 1)[1]
+        x, y, w, h = box = parse_region(region, width, height)
+        size = parse_size(size, w, h)
+        # Start from the smallest level still at least twice the size wanted, rather than the full image:
+        level = 0
+        while level + 1 < len(levels) and w >> (level + 1) >= 2 * size[0] and h >> (level + 1) >= 2 * size[1]:
+            level += 1
+        source, scale = levels[level], 2 ** level
+        crop = source.crop((x // scale, y // scale, min(math.ceil((x + w) / scale), source.width), min(math.ceil((y + h) / scale), source.height)))
+        add(box, crop.resize(size, Image.LANCZOS, reducing_gap=2.0), format, size)
+
+    return (width, height), derivatives
+
+
+async def build_derivatives(pwid, image):
+    """
+    Builds and stores the derivatives of a screenshot, which is stored under the given PWID.
+    """
+    try:
+        width, height = image_size(image)
+        (width, height), derivatives = await run_image_job(width * height, make_derivatives, image)
+    except Exception as e:
+        logger.warning("Could not make derivatives of %s: %s" % (pwid, e))
+        return
+    items = [(derivative_key(pwid, box, size, format), payload, FORMATS[format][1]) for box, size, format, payload in derivatives]
+    # They're stored in one go, along with the manifest, so derivatives are only looked for once they're all there:
+    manifest = json.dumps({'width': width, 'height': height}).encode('utf-8')
+    items.append((manifest_key(pwid), manifest, 'application/json'))
+    await anyio.to_thread.run_sync(screenshot_store.set_many, items)
+    IIIF_DERIVATIVES_BUILT.inc(len(derivatives))
+    logger.info("Made %i derivatives of %s" % (len(derivatives), pwid))
+
+
+def _read_manifest(pwid):
+    manifest = screenshot_store.get(manifest_key(pwid))
+    if manifest is None:
+        return None
+    with open(manifest[0]) as f:
+        return json.load(f)
+
+
+async def find_derivative(pwid, region, size, rotation, quality, format):
+    """
+    Looks for a pre-computed derivative matching an IIIF image request, reading the store from a worker thread.
+
+    :return: (path, content type), or None if there isn't one
+    """
+    if str(rotation) != '0' or quality not in ('default', 'color') or format not in FORMATS:
+        return None
+    manifest = await anyio.to_thread.run_sync(_read_manifest, pwid)
+    if manifest is None:
+        return None
+    try:
+        box = parse_region(region, manifest['width'], manifest['height'])
+        size = parse_size(size, box[2], box[3])
+    except ValueError:
+        return None
+    return await anyio.to_thread.run_sync(screenshot_store.get, derivative_key(pwid, box, size, format))
@@ -0,0 +1,195 @@
+"""
+A minimal, in-process implementation of the IIIF Image API 2.1, using Pillow, for the screenshots in the
+screenshot store, so the IIIF server is not needed for the usual requests.
+
+It supports:
+
+- regions: full, square, x,y,w,h and pct:x,y,w,h
+- sizes: full, max, w,, ,h, w,h, !w,h and pct:n
+- rotations: 0, 90, 180 and 270, optionally mirrored (!)
+- qualities: default, color and gray (or grey)
+- formats: jpg, png and webp, and avif where Pillow supports it
+
+Requests for anything else raise NotImplementedError, and invalid requests raise ValueError.
+
+Clients asking for a jpg or png can be sent one of IIIF_NEGOTIATED_FORMATS instead, if their Accept
+header says they can take it (see negotiate()), as those are much smaller for the same quality.
+
+The image work is done in the image process pool (see screenshots.py), so this module is kept light.
+"""
+import os
+
+from PIL import Image, ImageOps
+
+from ..screenshots import FORMATS, open_image, limit_rows, to_rgb, encode
+
+IIIF_JPEG_QUALITY = int(os.environ.get("IIIF_JPEG_QUALITY", 95))
+# Formats to send instead of jpg or png, in order of preference, where the client accepts them:
+IIIF_NEGOTIATED_FORMATS = [format for format in os.environ.get("IIIF_NEGOTIATED_FORMATS", "avif webp").split()
+    if format in FORMATS]
+
+QUALITIES = ('default', 'color', 'gray', 'grey')
+
+# Rotating clockwise, the IIIF way:
+ROTATIONS = {
+    0: None,
+    90: Image.Transpose.ROTATE_270,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_90,
+}
+
+
+def parse_region(region, width, height):
+    """
+    Interprets an IIIF Image API 2.1 region, for an image of the given size.
+
+    :return: the (x, y, w, h) box, clipped to the image
+    """
+    if region == 'full':
+        return 0, 0, width, height
+    if region == 'square':
+        side = min(width, height)
+        return (width - side) // 2, (height - side) // 2, side, side
+    if region.startswith('pct:'):
+        x, y, w, h = [float(v) for v in region[4:].split(',')]
+        x, y, w, h = round(x * width / 100), round(y * height / 100), round(w * width / 100), round(h * height / 100)
+    else:
+        x, y, w, h = [int(v) for v in region.split(',')]
+    if w <= 0 or h <= 0 or x >= width or y >= height:
+        raise ValueError(f"Region {region} is outside the image")
+    return x, y, min(w, width - x), min(h, height - y)
+
+
+def parse_size(size, width, height):
+    """
+    Interprets an IIIF Image API 2.1 size, for a region of the given size.
+
+    :return: the (w, h) to scale it to
+    """
+    if size in ('full', 'max'):
+        return width, height
+    if size.startswith('pct:'):
+        scale = float(size[4:]) / 100
+        w, h = round(width * scale), round(height * scale)
+    elif size.startswith('!'):
+        w, h = [int(v) for v in size[1:].split(',')]
+        scale = min(w / width, h / height)
+        w, h = round(width * scale), round(height * scale)
+    else:
+        w, h = size.split(',')
+        if w and h:
+            w, h = int(w), int(h)
+        elif w:
+            w = int(w)
+            h = round(height * w / width)
+        elif h:
+            h = int(h)
+            w = round(width * h / height)
+        else:
+            raise ValueError(f"Invalid size {size}")
+    if w <= 0 or h <= 0:
+        raise ValueError(f"Size {size} is empty")
+    return w, h
+
+
+def parse_rotation(rotation):
+    """
+    :return: (whether to mirror the image, degrees to rotate it clockwise)
+    """
+    rotation = str(rotation)
+    mirror = rotation.startswith('!')
+    degrees = float(rotation.lstrip('!'))
+    if degrees % 90 or not 0 <= degrees < 360:
+        raise NotImplementedError(f"Rotation by {rotation} degrees is not supported")
+    return mirror, int(degrees)
+
+
+def check_request(region, size, rotation, quality, format):
+    """
+    Checks an image request is one that can be handled here, raising NotImplementedError if not.
+    """
+    parse_rotation(rotation)
+    if quality not in QUALITIES:
+        raise NotImplementedError(f"Quality {quality} is not supported")
+    if format not in FORMATS:
+        raise NotImplementedError(f"Format {format} is not supported")
+
+
+def negotiate(format, accept):
+    """
+    Picks the format to send for a jpg or png request, given the request's Accept header. Only formats
+    the client names explicitly count, as e.g. image/* doesn't really mean it can display AVIF.
+
+    :return: the best of IIIF_NEGOTIATED_FORMATS the client accepts, or else the format asked for
+    """
+    if format not in ('jpg', 'png') or not accept:
+        return format
+    accepted = set()
+    for item in accept.split(','):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    pass
+        if q > 0:
+            accepted.add(media_type.lower())
+    for negotiated in IIIF_NEGOTIATED_FORMATS:
+        if FORMATS[negotiated][1] in accepted:
+            return negotiated
+    return format
+
+
+def process_image(source, region, size, rotation, quality, format):
+    """
+    Carries out an IIIF image request on an image, from a file path or bytes.
+
+    :return: the resulting image, in the requested format
+    """
+    check_request(region, size, rotation, quality, format)
+    with open_image(source) as im:
+        x, y, w, h = parse_region(region, *im.size)
+        # There's no need to decode anything below the region:
+        limit_rows(im, y + h)
+        out = to_rgb(im.crop((x, y, x + w, y + h)))
+    width, height = parse_size(size, w, h)
+    if (width, height) != out.size:
+        # Shrinks by whole factors first, then resamples the rest of the way:
+        out = out.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+    mirror, degrees = parse_rotation(rotation)
+    if mirror:
+        out = ImageOps.mirror(out)
+    if ROTATIONS[degrees] is not None:
+        out = out.transpose(ROTATIONS[degrees])
+    if quality in ('gray', 'grey'):
+        out = out.convert('L')
+    return encode(out, format, IIIF_JPEG_QUALITY)
+
+
+def image_info(id, width, height, tile_size):
+    """
+    Describes an image, as an IIIF Image API 2.1 info.json, with tiles at the given size.
+    """
+    scale_factors = [1]
+    while max(width, height) > tile_size * scale_factors[-1]:
+        scale_factors.append(scale_factors[-1] * 2)
+    return {
+        '@context': 'http://iiif.io/api/image/2/context.json',
+        '@id': id,
+        'protocol': 'http://iiif.io/api/image',
+        'width': width,
+        'height': height,
+        'tiles': [{ 'width': tile_size, 'height': tile_size, 'scaleFactors': scale_factors }],
+        'profile': [
+            'http://iiif.io/api/image/2/level1.json',
+            {
+                'formats': list(FORMATS),
+                'qualities': ['default', 'color', 'gray'],
+                'supports': ['mirroring', 'regionByPct', 'regionSquare', 'rotationBy90s', 'sizeByConfinedWh',
+                    'sizeByDistortedWh', 'sizeByH', 'sizeByPct', 'sizeByW', 'sizeByWh'],
+            },
+        ],
+    }
@@ -3,7 +3,6 @@
 This file declares the routes for the IIIF module.
 """
 import os
-import io
 import re
 import logging
 from enum import Enum
@@ -12,17 +11,21 @@ from xml.etree.ElementInclude import include
 
 from fastapi import Depends, FastAPI, HTTPException, APIRouter, status, Request, Response, Query, Path
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse, StreamingResponse, Response
+from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse, StreamingResponse, Response, FileResponse
 
 from pydantic import AnyHttpUrl
-
-from cachelib import FileSystemCache
-import httpx
+import anyio
+from starlette.background import BackgroundTask
 
 #from ..cdx import lookup_in_cdx, list_from_cdx, can_access, CDX_SERVER, get_warc_stream
 from ..mementos.schemas import path_ts, path_url
-from ..cdx import can_access
+from ..cdx import can_access_async, lookup_in_cdx_async, get_warc_stream_async
 from ..pwid import gen_pwid, parse_pwid
+from ..clients import get_client, end_to_end_headers, stream_upstream
+from ..screenshot_store import screenshot_store
+from .derivatives import build_derivatives, find_derivative, IIIF_DERIVATIVE_REQUESTS, IIIF_TILE_SIZE
+from ..screenshots import image_size, run_image_job
+from . import image_api
 
 #from . import schemas
 
@@ -37,41 +40,55 @@ router = APIRouter(
     prefix='/iiif'
 )
 
-# Set up a persistent cache for screenshots etc.
-CACHE_FOLDER = os.environ.get("CACHE_FOLDER", ".")
-screenshot_cache = FileSystemCache(os.path.join(CACHE_FOLDER, 'screenshot_cache'), threshold=0, default_timeout=0)
-
 # Get the location of the web rendering server:
 WEBRENDER_ARCHIVE_SERVER = os.environ.get("WEBRENDER_ARCHIVE_SERVER", "http://webrender:8010/render")
 
 # Get the location of the IIIF server:
 IIIF_SERVER= os.environ.get("IIIF_SERVER", "http://iiif:8182")
 
+# Whether to handle IIIF requests here where possible, rather than passing them to the IIIF server.
+# If IIIF_SERVER is set to '', requests that can't be handled here are refused:
+IIIF_LOCAL = os.environ.get("IIIF_LOCAL", "false").lower() in ("true", "1", "yes")
+
 #
 #
 #
 
 async def proxy_call(iiif_url, request):
-    # Is always an internal service:
-    proxies = {
-        "http://": None,
-        "https://": None,
-    }
-
-    # Proxy requests to IIIF server:
+    # Proxy requests to IIIF server, using the pooled client:
     logger.info(f"Getting iiif_url {iiif_url}")
-    async with httpx.AsyncClient(proxies=proxies) as client:
-        r = await client.get(
+    client = get_client('iiif')
+    r = await client.send(
+        client.build_request(
+            'GET',
             url=iiif_url,
-            headers={key: value for (key, value) in request.headers.items() if key != 'Host'},
+            headers=end_to_end_headers(request.headers, exclude=['Host']),
             timeout=TIMEOUT,
-            )
-    # Grab the headers:
-    headers = [(name, value) for (name, value) in r.headers.items()]
+        ),
+        stream=True,
+    )
 
-    # Just pass the response back:
-    response = Response(content=r.content, status_code=r.status_code, headers=r.headers)
-    return response
+    # Stream the response back as it arrives, rather than buffering the whole image.
+    # The raw bytes are passed through, so any Content-Encoding/Length still applies:
+    return StreamingResponse(
+        stream_upstream(r, request, raw=True),
+        status_code=r.status_code,
+        headers=dict(end_to_end_headers(r.headers)),
+        background=BackgroundTask(r.aclose),
+    )
+
+
+async def local_screenshot(pwid):
+    """
+    Gets the screenshot for a PWID from the screenshot store, rendering it here if it's not there yet.
+
+    :return: (the path to the image or the image itself, a task to run after responding or None)
+    """
+    key, url, target_date = screenshot_target(pwid)
+    path, image, content_type = await screenshot_store.get_or_create(key, lambda: render_archived_screenshot(url, target_date))
+    if image is not None:
+        return image, BackgroundTask(build_derivatives, key, image)
+    return path, None
 
 #
 #
@@ -134,7 +151,14 @@ async def iiif_info(
     logger.debug(f"PWID: archive={archive}, timestamp={target_date}, scope={scope}, url={url}")
 
     # Check with a Wayback service to see if this URL is allowed:
-    can_access(url)
+    await can_access_async(url)
+
+    # Describe the image here, from the screenshot itself:
+    if IIIF_LOCAL:
+        source, background = await local_screenshot(pwid)
+        width, height = await anyio.to_thread.run_sync(image_size, source)
+        info = image_api.image_info(str(request.url).rsplit('/info.json', 1)[0], width, height, IIIF_TILE_SIZE)
+        return JSONResponse(info, background=background)
 
     # Escape any forward-slashes in the PWID:
     pwid = pwid.replace('/', '%2F')
@@ -202,7 +226,46 @@ async def iiif_renderer(
     logger.debug(f"PWID: archive={archive}, timestamp={target_date}, scope={scope}, url={url}")
 
     # Check with a Wayback service to see if this URL is allowed:
-    can_access(url)
+    await can_access_async(url)
+
+    # Send a smaller format than the jpg or png asked for, if the client can take it:
+    negotiated = image_api.negotiate(format, request.headers.get('accept'))
+    headers = {'Vary': 'Accept'} if format in ('jpg', 'png') and image_api.IIIF_NEGOTIATED_FORMATS else {}
+
+    # Send a pre-computed derivative if there is one:
+    derivative = None
+    try:
+        key, _, _ = screenshot_target(pwid)
+        for candidate in dict.fromkeys((negotiated, format)):
+            derivative = await find_derivative(key, region, size, rotation, quality, candidate)
+            if derivative is not None:
+                break
+    except Exception as e:
+        logger.debug(f"No derivative for {pwid}: {e}")
+    if derivative is not None:
+        IIIF_DERIVATIVE_REQUESTS.labels('hit').inc()
+        path, content_type = derivative
+        return FileResponse(path, media_type=content_type, headers=headers)
+    IIIF_DERIVATIVE_REQUESTS.labels('miss').inc()
+
+    # Or make the image here, if possible:
+    if IIIF_LOCAL:
+        try:
+            image_api.check_request(region, size, rotation, quality, format)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except NotImplementedError as e:
+            # Pass it on to the IIIF server, if there is one:
+            if not IIIF_SERVER:
+                raise HTTPException(status_code=501, detail=str(e))
+        else:
+            source, background = await local_screenshot(pwid)
+            width, height = await anyio.to_thread.run_sync(image_size, source)
+            try:
+                image = await run_image_job(width * height, image_api.process_image, source, region, size, rotation, quality, negotiated)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            return Response(image, media_type=image_api.FORMATS[negotiated][1], headers=headers, background=background)
 
     # Escape any forward-slashes in the PWID:
     pwid = pwid.replace('/', '%2F')
@@ -263,6 +326,55 @@ async def iiif_image_api_fallback(
 # Raw site renderer to be called by the IIIF server:
 #
 
+def screenshot_target(pwid):
+    """
+    Checks the PWID is one that screenshots can be made for.
+
+    :return: (the PWID to store the screenshot under, the URL, the target date)
+    """
+    # Must have a pwid:
+    if not pwid:
+        raise HTTPException(status_code=400, detail='Must specify a PWID')
+
+    archive, target_date, scope, url = parse_pwid(pwid)
+
+    # Not all archives...
+    if archive != 'webarchive.org.uk':
+        raise HTTPException(status_code=400, detail=f'Only webarchive.org.uk PWIDs are supported.')
+
+    # Not all scopes...
+    if scope != 'page':
+        raise HTTPException(status_code=400, detail=f'Only page scope PWIDs are supported.')
+
+    # Convert https to http as the screenshotter doesn't like it with pywb it seems:
+    if url.startswith('https:'):
+        url = url.replace('https', 'http', 1)
+
+    # Rebuild the PWID:
+    pwid = gen_pwid(target_date, url)
+    logger.debug("Generated PWID: %s" % pwid)
+
+    return pwid, url, target_date
+
+
+async def render_archived_screenshot(url, target_date):
+    """
+    Gets a screenshot of the archived web page from the web rendering service.
+
+    :return: (the PNG image, its content type)
+    """
+    logger.info("Requesting screenshot...")
+    r = await get_client('webrender').get(WEBRENDER_ARCHIVE_SERVER,
+                    params={ 'url': url, 'show_screenshot': True, 'target_date': target_date },
+                    timeout=TIMEOUT)
+
+    if r.status_code != 200:
+        raise HTTPException(status_code=r.status_code, detail=r.reason_phrase)
+
+    logger.info("Renderer responded 200 OK!")
+    return r.content, "image/png"
+
+
 @router.get('/render_raw', include_in_schema=False)
 async def render_raw(
     pwid: str,
@@ -287,66 +399,35 @@ async def render_raw(
 
     """
 
-    # Must have a pwid:
-    if not pwid:
-        raise HTTPException(status_code=400, detail='Must specify a PWID')
-
-    archive, target_date, scope, url = parse_pwid(pwid)
+    pwid, url, target_date = screenshot_target(pwid)
 
-    # Not all archives...
-    if archive != 'webarchive.org.uk':
-        raise HTTPException(status_code=400, detail=f'Only webarchive.org.uk PWIDs are supported.')
+    # Check with a Wayback service to see if this URL is allowed:
+    await can_access_async(url)
 
-    # Not all scopes...
-    if scope != 'page':
-        raise HTTPException(status_code=400, detail=f'Only page scope PWIDs are supported.')
+    async def render():
+        # For originals:
+        if source == 'original':
+            # Query CDX Server for the item
+            qurl = "%s:%s" % (type, url)
+            (warc_filename, warc_offset, compressed_end_offset) = await lookup_in_cdx_async(qurl, target_date)
 
-    # Convert https to http as the screenshotter doesn't like it with pywb it seems:
-    if url.startswith('https:'):
-        url = url.replace('https', 'http', 1)
+            # If not found, say so:
+            if warc_filename is None:
+                raise HTTPException(status_code=404, detail='Not found')
 
-    # Check with a Wayback service to see if this URL is allowed:
-    can_access(url)
+            # Grab the payload from the WARC and return it.
+            stream, content_type = await get_warc_stream_async(warc_filename, warc_offset, compressed_end_offset)
+            return stream.read(), content_type
 
-    # Rebuild the PWID:
-    pwid = gen_pwid(target_date, url)
-    logger.debug("Generated PWID: %s" % pwid)
+        # Get rendered version from internal API
+        return await render_archived_screenshot(url, target_date)
 
-    # Use cached value if there is one, using pwid as key:
-    result = screenshot_cache.get(pwid)
-    if result is not None:
+    # Use cached value if there is one, using pwid as key, sending it straight from disk.
+    # Otherwise render it, just once however many requests for it come in at the same time:
+    path, image_file, content_type = await screenshot_store.get_or_create(pwid, render)
+    if path is not None:
         logger.debug("Found in cache: %s" % pwid)
-        #logger.info(result)
-        return StreamingResponse(io.BytesIO(result['payload']), media_type=result['content_type'])
-
-    # For originals:
-    if source == 'original':
-        # Query CDX Server for the item
-        qurl = "%s:%s" % (type, url)
-        (warc_filename, warc_offset, compressed_end_offset) = lookup_in_cdx(qurl, target_date)
-
-        # If not found, say so:
-        if warc_filename is None:
-            raise HTTPException(status_code=404, detail='Not found')
-
-        # Grab the payload from the WARC and return it.
-        stream, content_type = get_rendered_original_stream(warc_filename,warc_offset, compressed_end_offset)
-    else:
-        # Get rendered version from internal API
-        logger.info("Requesting screenshot...")
-        async with httpx.AsyncClient() as client:
-            r = await client.get(WEBRENDER_ARCHIVE_SERVER,
-                            params={ 'url': url, 'show_screenshot': True, 'target_date': target_date },
-                            timeout=TIMEOUT)
-        
-        if r.status_code != 200:
-            raise HTTPException(status_code=r.status_code, detail=r.reason_phrase)
-
-        logger.info("Renderer responded 200 OK!")
-        stream = io.BytesIO(r.content)
-        content_type = "image/png"
-
-    # And return
-    image_file = stream.read()
-    screenshot_cache.set(pwid, {'payload': image_file, 'content_type': content_type}, timeout=60*60)
-    return StreamingResponse(io.BytesIO(image_file), media_type=content_type)
+        return FileResponse(path, media_type=content_type)
+
+    # And return, making the derivatives of the new image once it's been sent:
+    return Response(image_file, media_type=content_type, background=BackgroundTask(build_derivatives, pwid, image_file))
@@ -9,6 +9,8 @@ from starlette.config import Config
 from prometheus_fastapi_instrumentator import Instrumentator
 
 from .dependencies import get_db
+from .clients import open_clients, close_clients
+from .screenshots import close_pool
 from .nominations import router as nominations
 from .mementos import router as mementos
 from .iiif import router as iiif
@@ -138,6 +140,18 @@ app.include_router(
 #    dependencies=[Depends(get_db)],
 #)
 
+#
+# Set up pooled connections to upstream services when the worker starts, and release them (and any image processes) when it shuts down:
+#
+@app.on_event("startup")
+async def startup():
+    await open_clients()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_clients()
+    close_pool()
+
 # Just an endpoint for checking the service is up:
 @app.get("/ping", include_in_schema=False)
 async def root():
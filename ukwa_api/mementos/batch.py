@@ -0,0 +1,280 @@
+"""
+Batch export of WARC records.
+
+A batch is either a list of (url, timestamp) pairs, each resolved to its closest capture, or a CDX
+query, whose results are taken as they are. The lookups and access checks run concurrently, and then
+the records are grouped by WARC file and sorted by offset, so that records lying close together in a
+file can be fetched from WebHDFS in a single read. The records are sent on as one stream of
+concatenated GZip members, i.e. a single valid .warc.gz file.
+
+Records that turn out to be unavailable (not found, not allowed, or failing to load) are left out,
+so the output may hold fewer records than were asked for. The exception is a record big enough to be
+streamed on its own that fails part-way through, in which case the response is cut off, so the
+client sees an error rather than a .warc.gz with a broken record in it.
+"""
+import os
+import zlib
+import asyncio
+import logging
+from collections import namedtuple, deque
+
+import anyio
+from fastapi import HTTPException
+
+from ..clients import get_client
+from ..cdx import CDX_SERVER, can_access_async, lookup_in_cdx_async, open_warc_record_async, aiter_first_member
+from .paging import aiter_lines
+
+# Maximum number of records in a batch:
+WARC_BATCH_MAX_RECORDS = int(os.environ.get("WARC_BATCH_MAX_RECORDS", 10000))
+# Number of lookups and access checks to run at once:
+WARC_BATCH_CONCURRENCY = int(os.environ.get("WARC_BATCH_CONCURRENCY", 16))
+# Records no further apart than this in a WARC file get fetched in one read...
+WARC_BATCH_MAX_GAP = int(os.environ.get("WARC_BATCH_MAX_GAP", 64*1024))
+# ...as long as the read is no bigger than this. Larger records are streamed on their own:
+WARC_BATCH_MAX_SPAN = int(os.environ.get("WARC_BATCH_MAX_SPAN", 8*1024*1024))
+# Number of reads to run ahead of the one being sent:
+WARC_BATCH_READ_AHEAD = int(os.environ.get("WARC_BATCH_READ_AHEAD", 4))
+# Size of the chunks to pass streamed records on in:
+WARC_BATCH_CHUNK_SIZE = int(os.environ.get("WARC_BATCH_CHUNK_SIZE", 64*1024))
+
+# Create a logger, beneath the Uvicorn error logger:
+logger = logging.getLogger(f"uvicorn.error.{__name__}")
+
+# A record to export, with its location (the length is None if not known):
+Record = namedtuple('Record', 'url timestamp filename offset length')
+# A run of records from one WARC file, to fetch in one read from start up to (but not including) end:
+Span = namedtuple('Span', 'filename start end records')
+
+
+async def _gather_limited(calls, concurrency):
+    # Runs the calls (functions returning coroutines), no more than `concurrency` at a time:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(call):
+        async with semaphore:
+            return await call()
+
+    return await asyncio.gather(*[limited(call) for call in calls])
+
+
+async def _allowed(url):
+    try:
+        return await can_access_async(url)
+    except HTTPException as e:
+        logger.info("Leaving %s out of batch: %s" % (url, e.detail))
+        return False
+
+
+def _check_size(count, max_records):
+    if count > max_records:
+        raise HTTPException(status_code=400, detail="Batches can hold at most %i records." % max_records)
+
+
+async def resolve_captures(captures, max_records=None, concurrency=None):
+    """
+    Looks up the closest capture for each of a list of (url, timestamp) pairs, concurrently.
+
+    :return: a list of Records for the captures that were found and can be accessed
+    """
+    max_records = max_records or WARC_BATCH_MAX_RECORDS
+    _check_size(len(captures), max_records)
+
+    async def resolve(url, timestamp):
+        if not await _allowed(url):
+            return None
+        filename, offset, length = await lookup_in_cdx_async(url, timestamp)
+        if filename is None:
+            logger.info("Leaving %s %s out of batch: not found" % (timestamp, url))
+            return None
+        return Record(url, timestamp, filename, int(offset), int(length) if length and int(length) > 0 else None)
+
+    results = await _gather_limited([lambda c=c: resolve(*c) for c in captures], concurrency or WARC_BATCH_CONCURRENCY)
+    return [record for record in results if record is not None]
+
+
+async def query_captures(params, cdx_filter=None, max_records=None, concurrency=None):
+    """
+    Runs a CDX query, checking access to each URL it returns, concurrently.
+
+    :param params: the upstream query parameters
+    :param cdx_filter: an optional CdxFilter to pass the results through
+    :return: a list of Records for the captures that can be accessed
+    """
+    max_records = max_records or WARC_BATCH_MAX_RECORDS
+    params = dict(params, limit=None if cdx_filter else max_records + 1)
+    client = get_client()
+    r = await client.send(
+        client.build_request(
+            'GET',
+            CDX_SERVER,
+            params={ key: str(value) for (key, value) in params.items() if value is not None },
+        ),
+        stream=True,
+    )
+    records = []
+    try:
+        if r.status_code != 200:
+            logger.warning("Batch CDX query failed: %i %s" % (r.status_code, r.reason_phrase))
+            raise HTTPException(status_code=502, detail="CDX query failed.")
+        lines = aiter_lines(r.aiter_bytes())
+        if cdx_filter:
+            lines = cdx_filter.apply(lines)
+        # Fields: urlkey timestamp original mimetype statuscode digest redirecturl robotflags length offset filename
+        async for line in lines:
+            fields = line.decode('utf-8').split()
+            if len(fields) < 11 or not fields[9].isdigit():
+                continue
+            length = int(fields[8]) if fields[8].isdigit() and int(fields[8]) > 0 else None
+            records.append(Record(fields[2], fields[1], fields[10], int(fields[9]), length))
+            _check_size(len(records), max_records)
+    finally:
+        with anyio.CancelScope(shield=True):
+            await r.aclose()
+
+    # Check each URL once:
+    urls = list(dict.fromkeys(record.url for record in records))
+    allowed = await _gather_limited([lambda u=u: _allowed(u) for u in urls], concurrency or WARC_BATCH_CONCURRENCY)
+    allowed = { url for (url, ok) in zip(urls, allowed) if ok }
+    return [record for record in records if record.url in allowed]
+
+
+def plan_reads(records, max_gap=None, max_span=None):
+    """
+    Groups records by WARC file, in offset order, joining records that lie close together into shared reads.
+
+    Records of unknown length, or too big to share a read, get a Span of their own with `end` set to None.
+
+    :return: a list of Spans
+    """
+    max_gap = WARC_BATCH_MAX_GAP if max_gap is None else max_gap
+    max_span = max_span or WARC_BATCH_MAX_SPAN
+
+    # The same record may have been asked for more than once, so only send it once:
+    unique = { (record.filename, record.offset): record for record in records }
+    spans = []
+    current = None
+    for key in sorted(unique):
+        record = unique[key]
+        if record.length is None or record.length > max_span:
+            spans.append(Span(record.filename, record.offset, None, [record]))
+            current = None
+            continue
+        end = record.offset + record.length
+        if (current is not None and current.filename == record.filename and
+                record.offset - current.end <= max_gap and end - current.start <= max_span):
+            current.records.append(record)
+            current = spans[-1] = current._replace(end=max(current.end, end))
+        else:
+            current = Span(record.filename, record.offset, end, [record])
+            spans.append(current)
+    return spans
+
+
+def _gzip_member(data):
+    # Compresses a record as a GZip member of its own, as in a .warc.gz file:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+async def _read_span(span):
+    # Fetches a whole span into memory, returning the (compressed) bytes of each record that was read in full:
+    r = await open_warc_record_async(span.filename, span.start, span.end - span.start)
+    try:
+        if r.status_code not in (200, 206):
+            raise Exception("got %i %s" % (r.status_code, r.reason_phrase))
+        data = await r.aread()
+    finally:
+        # Shielded, so the upstream connection is closed even if the read was cancelled:
+        with anyio.CancelScope(shield=True):
+            await r.aclose()
+    members = []
+    for record in span.records:
+        member = data[record.offset - span.start:record.offset - span.start + record.length]
+        if len(member) != record.length:
+            logger.warning("Leaving the record at %s:%i out of batch, as the read ended part-way through it." % (span.filename, record.offset))
+            continue
+        members.append(member if span.filename.endswith('.gz') else _gzip_member(member))
+    return members
+
+
+async def _stream_record(record, chunk_size):
+    # Streams a single record that's too big to read into memory, or of unknown length:
+    r = await open_warc_record_async(record.filename, record.offset, record.length)
+    try:
+        if r.status_code not in (200, 206):
+            raise Exception("got %i %s" % (r.status_code, r.reason_phrase))
+        if record.length is not None and record.filename.endswith('.gz'):
+            chunks = r.aiter_raw(chunk_size)
+            compressor = None
+        else:
+            # Without a length, the end of the record is only found by decompressing it, so it has to be compressed again:
+            chunks = aiter_first_member(r, strict=True)
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        size = 0
+        async for chunk in chunks:
+            size += len(chunk)
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+        if record.length is not None and size != record.length:
+            raise Exception("read ended part-way through the record at %i" % record.offset)
+        if compressor:
+            yield compressor.flush()
+    finally:
+        with anyio.CancelScope(shield=True):
+            await r.aclose()
+
+
+async def export_records(spans, request, read_ahead=None, chunk_size=None):
+    """
+    Fetches the records in each span, in order, as a stream of concatenated GZip members.
+
+    Shared reads are fetched into memory, up to `read_ahead` at a time, while the earlier ones are sent.
+    Any span that fails to load is logged and left out. Records that are too big to read into memory are
+    streamed, so if one of those fails after some of it has been sent, the export is aborted (and so the
+    response is cut off) rather than carrying on after a broken record. If the client goes away, the export stops.
+    """
+    read_ahead = read_ahead or WARC_BATCH_READ_AHEAD
+    chunk_size = chunk_size or WARC_BATCH_CHUNK_SIZE
+    reads = deque()
+    upcoming = iter([span for span in spans if span.end is not None])
+
+    def start_reads():
+        while len(reads) < read_ahead:
+            span = next(upcoming, None)
+            if span is None:
+                return
+            reads.append(asyncio.ensure_future(_read_span(span)))
+
+    try:
+        for span in spans:
+            if await request.is_disconnected():
+                logger.info("Client disconnected, stopping batch export.")
+                break
+            start_reads()
+            if span.end is not None:
+                try:
+                    members = await reads.popleft()
+                except Exception as e:
+                    logger.warning("Leaving %i record(s) from %s out of batch: %s" % (len(span.records), span.filename, e))
+                    continue
+                for member in members:
+                    yield member
+            else:
+                sent = False
+                try:
+                    async for chunk in _stream_record(span.records[0], chunk_size):
+                        sent = True
+                        yield chunk
+                except Exception as e:
+                    if sent:
+                        # Part of the record has gone out already, so the only way to avoid sending a broken
+                        # .warc.gz is to abort the response:
+                        logger.error("Aborting batch export, as the record at %s:%i failed part-way through: %s" % (span.filename, span.start, e))
+                        raise
+                    logger.warning("Leaving %i record(s) from %s out of batch: %s" % (len(span.records), span.filename, e))
+    finally:
+        # Let any reads still running finish, rather than cancelling them part-way through:
+        with anyio.CancelScope(shield=True):
+            await asyncio.gather(*reads, return_exceptions=True)
@@ -0,0 +1,163 @@
+"""
+Filtering and collapsing of CDX query results, as they stream through.
+
+Filters follow the pywb CDX Server API syntax, `[!][=|~]field:value`:
+
+- `field:regex` keeps rows where the field matches the regular expression (from the start),
+- `=field:value` keeps rows where the field is exactly the value,
+- `~field:value` keeps rows where the field contains the value,
+- and a leading `!` inverts the filter.
+
+Rows that pass all the filters can then be de-duplicated by digest, dropping any capture of a URL
+whose digest has already been seen for that URL (e.g. revisits), and collapsed, keeping just the
+first (or last) of each run of consecutive rows that share the first N characters of a field
+(e.g. timestamp:4 for one row per year).
+
+All of this works on the raw bytes of each line, only splitting off the fields it needs.
+"""
+import re
+
+from fastapi import HTTPException
+
+from .formats import CDX11_FIELDS
+
+# Other names that the fields go by:
+FIELD_ALIASES = {
+    'url': 'original',
+    'mime': 'mimetype',
+    'status': 'statuscode',
+    'redirect': 'redirecturl',
+    'robots': 'robotflags',
+}
+
+DIGEST = CDX11_FIELDS.index('digest')
+
+
+def field_index(name):
+    """
+    The position of a named field in a CDX11 line.
+    """
+    name = FIELD_ALIASES.get(name, name)
+    if name not in CDX11_FIELDS:
+        raise HTTPException(status_code=400, detail="Unknown CDX field '%s'." % name)
+    return CDX11_FIELDS.index(name)
+
+
+def _field(line, index):
+    # Splits off just as much of the line as is needed:
+    fields = line.rstrip(b'\r\n').split(b' ', index + 1)
+    return fields[index] if index < len(fields) else b''
+
+
+class FieldFilter:
+    """
+    A single filter on a field, parsed from the `[!][=|~]field:value` syntax.
+    """
+
+    def __init__(self, spec):
+        self.invert = spec.startswith('!')
+        spec = spec[1:] if self.invert else spec
+        self.op = spec[0] if spec[:1] in ('=', '~') else None
+        spec = spec[1:] if self.op else spec
+        name, sep, value = spec.partition(':')
+        if not sep:
+            raise HTTPException(status_code=400, detail="Filters should look like field:value.")
+        self.index = field_index(name)
+        self.value = value.encode('utf-8')
+        if self.op is None:
+            try:
+                self.regex = re.compile(self.value)
+            except re.error as e:
+                raise HTTPException(status_code=400, detail="Invalid filter regex '%s': %s" % (value, e))
+
+    def __call__(self, line):
+        value = _field(line, self.index)
+        if self.op == '=':
+            matched = value == self.value
+        elif self.op == '~':
+            matched = self.value in value
+        else:
+            matched = self.regex.match(value) is not None
+        return matched != self.invert
+
+
+class CdxFilter:
+    """
+    The filter, de-duplication and collapse stage for a CDX query.
+    """
+
+    def __init__(self, filters=(), dedup=False, collapse=None, collapse_last=False):
+        """
+        :param filters: filter specifications, in the `[!][=|~]field:value` syntax
+        :param dedup: whether to drop captures of URLs with digests that have already been seen
+        :param collapse: field to collapse on, optionally with :N to only compare the first N characters
+        :param collapse_last: whether to keep the last rather than the first row of each collapsed run
+        """
+        self.filters = [FieldFilter(spec) for spec in filters or ()]
+        self.dedup = dedup
+        self.collapse_index = None
+        if collapse:
+            name, sep, length = collapse.partition(':')
+            self.collapse_index = field_index(name)
+            self.collapse_length = int(length) if length else None
+            self.collapse_last = collapse_last
+        self._urlkey = None
+        self._digests = set()
+        self._group = None
+        self._pending = None
+
+    def __bool__(self):
+        return bool(self.filters) or self.dedup or self.collapse_index is not None
+
+    def feed(self, line):
+        """
+        Passes a line through the stage.
+
+        :return: a tuple of the lines to pass on, if any
+        """
+        for f in self.filters:
+            if not f(line):
+                return ()
+
+        if self.dedup:
+            fields = line.split(b' ', DIGEST + 1)
+            digest = fields[DIGEST] if len(fields) > DIGEST else b'-'
+            # Results are grouped by URL (unless sorted by closest), so only remember the digests for the current one:
+            if fields[0] != self._urlkey:
+                self._urlkey = fields[0]
+                self._digests.clear()
+            if digest != b'-':
+                if digest in self._digests:
+                    return ()
+                self._digests.add(digest)
+
+        if self.collapse_index is not None:
+            group = _field(line, self.collapse_index)[:self.collapse_length]
+            if group == self._group:
+                if self.collapse_last:
+                    self._pending = line
+                return ()
+            self._group = group
+            if self.collapse_last:
+                # This starts a new run, so the last row of the previous one can go:
+                previous, self._pending = self._pending, line
+                return (previous,) if previous is not None else ()
+
+        return (line,)
+
+    def flush(self):
+        """
+        :return: a tuple of any lines still held back at the end of the results
+        """
+        pending, self._pending = self._pending, None
+        return (pending,) if pending is not None else ()
+
+    async def apply(self, lines):
+        """
+        Passes an async iterator of lines through the stage.
+        """
+        async for line in lines:
+            for out in self.feed(line):
+                yield out
+        for out in self.flush():
+            yield out
@@ -0,0 +1,273 @@
+"""
+Transcoding of CDX11 query results into other formats.
+
+Lines are parsed in batches rather than one by one: each batch is joined into one buffer, decoded
+once, and split into a flat list of fields, from which every eleventh field makes up a column.
+Batches where that doesn't line up (lines without exactly eleven fields) are parsed line by line instead.
+
+The output formats are:
+
+- 'cdx': the CDX11 lines as they are,
+- 'json': a JSON array of arrays, the first holding the field names,
+- 'ndjson': one JSON object per line,
+- 'csv': CSV with a header row,
+- 'columns': one JSON object per line, each holding a batch of rows as arrays of column values,
+- 'arrow': an Apache Arrow IPC stream of record batches (requires the 'pyarrow' package).
+
+If asked to (see the pywb showResumeKey option), when there are more results to come, the output ends
+with the resume key (the cursor for the next page):
+after a blank line for 'cdx' and 'csv', as a final `[]` row then `["<key>"]` for 'json', as a final
+`{"cursor": "<key>"}` line for 'ndjson' and 'columns', and in the custom metadata of a final empty
+record batch for 'arrow'.
+"""
+import io
+import os
+import csv
+import json
+from json.encoder import encode_basestring_ascii
+
+import anyio
+
+from fastapi import HTTPException
+
+# The fields of a CDX11 line:
+CDX11_FIELDS = ('urlkey', 'timestamp', 'original', 'mimetype', 'statuscode', 'digest',
+                'redirecturl', 'robotflags', 'length', 'offset', 'filename')
+# Fields that hold integers, which columnar formats store as such:
+INTEGER_FIELDS = ('length', 'offset')
+
+MEDIA_TYPES = {
+    'cdx': 'text/plain; charset=utf-8',
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+    'columns': 'application/x-ndjson',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+# Template for an NDJSON line, to fill in with JSON-encoded field values:
+NDJSON_TEMPLATE = '{' + ', '.join('"%s": %%s' % name for name in CDX11_FIELDS) + '}\n'
+
+# Number of rows to transcode at a time:
+CDX_TRANSCODE_BATCH_ROWS = int(os.environ.get("CDX_TRANSCODE_BATCH_ROWS", 10000))
+
+
+def _fields(line):
+    # Splits a line into exactly eleven fields, padding with '-' if need be:
+    fields = line.decode('utf-8', 'replace').split()
+    if len(fields) > len(CDX11_FIELDS):
+        fields[len(CDX11_FIELDS)-1:] = [' '.join(fields[len(CDX11_FIELDS)-1:])]
+    return fields + ['-'] * (len(CDX11_FIELDS) - len(fields))
+
+
+def parse_columns(lines):
+    """
+    Parses a batch of CDX11 lines into columns.
+
+    :return: a list of eleven lists of strings, one per field
+    """
+    width = len(CDX11_FIELDS)
+    fields = b''.join(lines).decode('utf-8', 'replace').split()
+    columns = [fields[i::width] for i in range(width)]
+    if len(fields) != width * len(lines) or not ''.join(columns[1]).isdigit():
+        # Some lines are not plain CDX11, so go line by line:
+        fields = [field for line in lines for field in _fields(line)]
+        columns = [fields[i::width] for i in range(width)]
+    return columns
+
+
+def parse_rows(lines):
+    """
+    Parses a batch of CDX11 lines into rows.
+
+    :return: a list of tuples of eleven strings
+    """
+    return list(zip(*parse_columns(lines)))
+
+
+def _integers(column):
+    return [int(value) if value.isdigit() else None for value in column]
+
+
+def _batches(lines, size):
+    for i in range(0, len(lines), size):
+        yield lines[i:i+size]
+
+
+class Encoder:
+    """
+    Encodes batches of CDX11 lines into an output format, one batch at a time.
+
+    The encoding can end with the resume key for the next page, if there is one, in the style of the
+    pywb CDX Server API's showResumeKey option.
+    """
+
+    def start(self):
+        return b''
+
+    def encode(self, batch):
+        raise NotImplementedError()
+
+    def end(self, resume_key=None):
+        return b''
+
+
+class CdxEncoder(Encoder):
+
+    def encode(self, batch):
+        return b''.join(batch)
+
+    def end(self, resume_key=None):
+        # A blank line, then the resume key:
+        return ('\n%s\n' % resume_key).encode('utf-8') if resume_key else b''
+
+
+class JsonEncoder(Encoder):
+
+    def start(self):
+        return b'[' + json.dumps(CDX11_FIELDS).encode('utf-8')
+
+    def encode(self, batch):
+        rows = json.dumps(parse_rows(batch), separators=(',', ':'))
+        # Drop the list's own brackets, as the rows go into the outer list:
+        return (',\n' + rows[1:-1]).encode('utf-8')
+
+    def end(self, resume_key=None):
+        # An empty row, then the resume key:
+        return ((',\n[],\n%s' % json.dumps([resume_key])) if resume_key else '').encode('utf-8') + b']\n'
+
+
+class NdjsonEncoder(Encoder):
+
+    def encode(self, batch):
+        # Encoding the values directly is much faster than building and dumping a dict per row:
+        return ''.join(NDJSON_TEMPLATE % tuple(map(encode_basestring_ascii, row)) for row in parse_rows(batch)).encode('utf-8')
+
+    def end(self, resume_key=None):
+        return (json.dumps({'cursor': resume_key}) + '\n').encode('utf-8') if resume_key else b''
+
+
+class CsvEncoder(CdxEncoder):
+
+    def __init__(self):
+        self.out = io.StringIO()
+        self.writer = csv.writer(self.out, lineterminator='\n')
+
+    def _drain(self):
+        data = self.out.getvalue().encode('utf-8')
+        self.out.seek(0)
+        self.out.truncate()
+        return data
+
+    def start(self):
+        self.writer.writerow(CDX11_FIELDS)
+        return self._drain()
+
+    def encode(self, batch):
+        self.writer.writerows(parse_rows(batch))
+        return self._drain()
+
+
+class ColumnsEncoder(NdjsonEncoder):
+
+    def encode(self, batch):
+        columns = dict(zip(CDX11_FIELDS, parse_columns(batch)))
+        for name in INTEGER_FIELDS:
+            columns[name] = _integers(columns[name])
+        return (json.dumps(columns, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+class ArrowEncoder(Encoder):
+
+    def __init__(self):
+        import pyarrow as pa
+        self.pa = pa
+        self.schema = pa.schema([(name, pa.int64() if name in INTEGER_FIELDS else pa.string()) for name in CDX11_FIELDS])
+        self.out = io.BytesIO()
+        self.writer = None
+
+    def _drain(self):
+        data = self.out.getvalue()
+        self.out.seek(0)
+        self.out.truncate()
+        return data
+
+    def start(self):
+        self.writer = self.pa.ipc.new_stream(self.out, self.schema)
+        return self._drain()
+
+    def encode(self, batch):
+        columns = parse_columns(batch)
+        self.writer.write_batch(self.pa.record_batch([
+            self.pa.array(_integers(column) if name in INTEGER_FIELDS else column, type=self.schema.field(name).type)
+            for name, column in zip(CDX11_FIELDS, columns)
+        ], schema=self.schema))
+        return self._drain()
+
+    def end(self, resume_key=None):
+        if resume_key:
+            # An empty record batch, carrying the resume key in its metadata:
+            empty = self.pa.record_batch([self.pa.array([], type=field.type) for field in self.schema], schema=self.schema)
+            self.writer.write_batch(empty, custom_metadata={'cursor': resume_key})
+        self.writer.close()
+        return self._drain()
+
+
+ENCODERS = {
+    'cdx': CdxEncoder,
+    'json': JsonEncoder,
+    'ndjson': NdjsonEncoder,
+    'csv': CsvEncoder,
+    'columns': ColumnsEncoder,
+    'arrow': ArrowEncoder,
+}
+
+
+def check_format(output):
+    """
+    Checks that an output format can be produced, raising an HTTPException if not.
+    """
+    if output not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Unknown output format '%s'." % output)
+    if output == 'arrow':
+        try:
+            import pyarrow
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Arrow output is not available on this server.")
+
+
+def transcode(lines, output, batch_rows=CDX_TRANSCODE_BATCH_ROWS):
+    """
+    Transcodes a list of CDX11 lines into the given output format.
+
+    :return: an iterator of byte chunks
+    """
+    encoder = ENCODERS[output]()
+    yield encoder.start()
+    for batch in _batches(lines, batch_rows):
+        yield encoder.encode(batch)
+    yield encoder.end()
+
+
+async def atranscode(batches, output, resume_key=None):
+    """
+    Transcodes an async iterator of batches of CDX11 lines into the given output format, as they arrive.
+
+    The encoding is CPU-bound, so it runs in a worker thread rather than in the event loop (apart from
+    plain CDX, which is just joined up).
+
+    :param resume_key: called once the batches run out, to get the resume key for the next page, if any
+    :return: an async iterator of byte chunks
+    """
+    encoder = ENCODERS[output]()
+    header = encoder.start()
+    if header:
+        yield header
+    async for batch in batches:
+        if output == 'cdx':
+            yield encoder.encode(batch)
+        else:
+            yield await anyio.to_thread.run_sync(encoder.encode, batch)
+    footer = encoder.end(resume_key() if resume_key else None)
+    if footer:
+        yield footer
@@ -0,0 +1,248 @@
+"""
+Cursor-based paging of CDX query results.
+
+Rather than streaming every matching line through one worker, results are returned in pages that are
+bounded by a number of rows and a number of bytes. Once a page has been read, an opaque cursor says
+where the next page should start, so clients can carry on from there.
+
+The cursor records the key (urlkey and timestamp) of the last row returned, how many rows with that
+same key have already been returned (as keys are not unique), how many rows with that urlkey have been
+returned, and how many rows of the caller's overall limit remain. For 'closest' sorting, where rows are
+not in key order, it records how many rows have been returned instead.
+
+The next page is then fetched by resuming the query upstream from the cursor, rather than running the
+whole query again and skipping the rows already returned: exact queries start from the cursor's
+timestamp, and host, domain and prefix queries become a key range query starting from the cursor's
+urlkey, which is cut off locally once the rows go beyond what the original query covers.
+"""
+import os
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from urllib.parse import urlsplit
+
+from fastapi import HTTPException
+
+# Budgets for each page of results:
+CDX_PAGE_MAX_ROWS = int(os.environ.get("CDX_PAGE_MAX_ROWS", 100000))
+CDX_PAGE_MAX_BYTES = int(os.environ.get("CDX_PAGE_MAX_BYTES", 32*1024*1024))
+
+# Ports that don't appear in urlkeys:
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class Cursor:
+    """
+    Where a page of CDX results starts.
+    """
+
+    def __init__(self, key=None, skip=0, remaining=None, urlkey_rows=0):
+        # The key (b"urlkey timestamp") to carry on from, or None to just skip rows:
+        self.key = key
+        # How many rows with that key (or overall, if there's no key) to skip:
+        self.skip = skip
+        # How many rows the caller still wants, or None for no limit:
+        self.remaining = remaining
+        # How many rows with the urlkey part of the key have been returned, or None if not known:
+        self.urlkey_rows = urlkey_rows
+
+    def encode(self):
+        data = {
+            'k': self.key.decode('utf-8') if self.key is not None else None,
+            's': self.skip,
+            'r': self.remaining,
+            'u': self.urlkey_rows,
+        }
+        return urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode('utf-8')).decode('utf-8')
+
+    @classmethod
+    def decode(cls, token):
+        try:
+            data = json.loads(urlsafe_b64decode(token.encode('utf-8')))
+            key = data['k'].encode('utf-8') if data['k'] is not None else None
+            return cls(key, int(data['s']), data['r'], data.get('u'))
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+    def timestamp(self):
+        """
+        The timestamp part of the key, if any.
+        """
+        if self.key is not None:
+            return self.key.rsplit(b' ', 1)[-1].decode('utf-8')
+        return None
+
+    def urlkey(self):
+        """
+        The urlkey part of the key, if any.
+        """
+        if self.key is not None:
+            return self.key.rsplit(b' ', 1)[0]
+        return None
+
+
+async def aiter_lines(chunks):
+    """
+    Splits an async iterator of byte chunks into lines, keeping the line endings.
+    """
+    pending = b''
+    async for chunk in chunks:
+        pending += chunk
+        start = 0
+        end = pending.find(b'\n', start)
+        while end >= 0:
+            yield pending[start:end+1]
+            start = end + 1
+            end = pending.find(b'\n', start)
+        pending = pending[start:]
+    if pending:
+        yield pending
+
+
+def row_key(line):
+    """
+    The sort key of a CDX line, i.e. b"urlkey timestamp".
+    """
+    end = line.find(b' ', line.find(b' ') + 1)
+    return line[:end] if end >= 0 else line.rstrip(b'\r\n')
+
+
+def row_urlkey(line):
+    """
+    The urlkey of a CDX line.
+    """
+    end = line.find(b' ')
+    return line[:end] if end >= 0 else line.rstrip(b'\r\n')
+
+
+def key_scope(url, match_type):
+    """
+    Works out the urlkeys a host, domain or prefix query covers, canonicalising the URL the way the
+    index does (SURT form, lower case, with any leading 'www.' and the scheme and default port dropped).
+
+    :return: a tuple of urlkey prefixes, or None for other kinds of query
+    """
+    if match_type not in ('host', 'domain', 'prefix'):
+        return None
+    parts = urlsplit(str(url))
+    labels = (parts.hostname or '').rstrip('.').split('.')
+    if labels[0] == 'www' or (labels[0].startswith('www') and labels[0][3:].isdigit()):
+        labels = labels[1:]
+    host = ','.join(reversed(labels))
+    if match_type == 'domain':
+        return (host + ')').encode('utf-8'), (host + ',').encode('utf-8')
+    if parts.port and parts.port != DEFAULT_PORTS.get(parts.scheme.lower()):
+        host = '%s:%i' % (host, parts.port)
+    if match_type == 'host':
+        return ((host + ')').encode('utf-8'),)
+    path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    return ((host + ')' + path).lower().encode('utf-8'),)
+
+
+async def within_scope(lines, prefixes):
+    """
+    Passes on the CDX lines from a key range query, for as long as their urlkeys start with one of the prefixes.
+
+    Nothing a host name can hold sorts between a domain's own urlkeys ('...)') and its subdomains' ('...,'),
+    so the lines a query covers are all together, and the first line that isn't is the end of them.
+    """
+    async for line in lines:
+        if not line.startswith(prefixes):
+            break
+        yield line
+
+
+class Page:
+    """
+    One page of CDX lines, starting after the cursor, and within the row and byte budgets.
+
+    The lines are passed on as they are read, and once they have all been read, `next_cursor` says
+    where the next page starts, or is None if there are no more.
+    """
+
+    def __init__(self, lines, cursor=None, sort=None, max_rows=CDX_PAGE_MAX_ROWS, max_bytes=CDX_PAGE_MAX_BYTES):
+        """
+        :param sort: the sort order the lines are in, i.e. None (key order), 'reverse' or 'closest'
+        """
+        self.lines = lines
+        self.cursor = cursor or Cursor()
+        self.sort = sort
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.next_cursor = None
+
+    async def __aiter__(self):
+        cursor = self.cursor
+        keyed = self.sort != 'closest'
+        reverse = self.sort == 'reverse'
+        max_rows = self.max_rows
+        if cursor.remaining is not None:
+            max_rows = min(max_rows, cursor.remaining)
+
+        rows = 0
+        size = 0
+        skipped = 0
+        last_key, last_key_count = None, 0
+        last_urlkey, last_urlkey_count = None, 0
+        more = False
+        async for line in self.lines:
+            if not line.strip():
+                continue
+
+            # Skip what came before the cursor:
+            key = row_key(line) if keyed else None
+            if keyed and cursor.key is not None:
+                if (key > cursor.key) if reverse else (key < cursor.key):
+                    continue
+                if key == cursor.key and skipped < cursor.skip:
+                    skipped += 1
+                    continue
+            elif not keyed and skipped < cursor.skip:
+                skipped += 1
+                continue
+
+            # Stop once the page is full, noting that there is more to come:
+            if rows >= max_rows or (rows and size + len(line) > self.max_bytes):
+                more = True
+                break
+
+            yield line
+            rows += 1
+            size += len(line)
+            if key == last_key:
+                last_key_count += 1
+            else:
+                last_key, last_key_count = key, 1
+            urlkey = row_urlkey(line) if keyed else None
+            if urlkey == last_urlkey:
+                last_urlkey_count += 1
+            else:
+                last_urlkey, last_urlkey_count = urlkey, 1
+
+        remaining = cursor.remaining - rows if cursor.remaining is not None else None
+        if not more or not rows or remaining == 0:
+            return
+
+        # Work out where the next page starts:
+        if not keyed:
+            self.next_cursor = Cursor(None, cursor.skip + rows, remaining)
+            return
+        if last_key == cursor.key:
+            # Rows with this key were returned by earlier pages too:
+            last_key_count += cursor.skip
+        if last_urlkey == cursor.urlkey():
+            # Likewise rows with this urlkey:
+            last_urlkey_count = last_urlkey_count + cursor.urlkey_rows if cursor.urlkey_rows is not None else None
+        self.next_cursor = Cursor(last_key, last_key_count, remaining, last_urlkey_count)
+
+    async def batches(self, size):
+        """
+        Passes on the lines of the page in lists of up to `size` lines.
+        """
+        batch = []
+        async for line in self:
+            batch.append(line)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
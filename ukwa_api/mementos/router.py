@@ -5,16 +5,19 @@ This file declares the routes for the Mementos module.
 import os
 import re
 import logging
-import requests
 from enum import Enum
 from typing import List, Optional, Union
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+import anyio
 
 from fastapi import Depends, FastAPI, HTTPException, APIRouter, status, Request, Response, Query
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse, StreamingResponse
 
 from pydantic import AnyHttpUrl
+from starlette.background import BackgroundTask
 #from sqlalchemy.orm import Session
 
 #from fastapi_pagination import Page, add_pagination
@@ -24,16 +27,31 @@ from . import schemas
 #from .rss import ResponseFormat, nominations_to_rss
 #from ..dependencies import get_db, engine
 
-from ..cdx import lookup_in_cdx, list_from_cdx, can_access, CDX_SERVER, get_warc_stream
+from ..cdx import lookup_in_cdx_async, can_access_async, CDX_SERVER, open_warc_record_async, aiter_first_member, peek_record_size, WAYBACK_TS_FORMAT
 #from ..screenshots import get_rendered_original_stream, full_and_thumb_jpegs
 #from ..crawl_kafka import KafkaLauncher
 from ..pwid import gen_pwid
+from ..clients import get_client, stream_upstream
+from ..captures import lower_bound, upper_bound
+from ..ranges import parse_range, range_headers, slice_stream, open_slice
+from ..payloads import read_payload
+from .paging import Cursor, Page, aiter_lines, key_scope, within_scope, CDX_PAGE_MAX_ROWS
+from .formats import check_format, atranscode, MEDIA_TYPES, CDX_TRANSCODE_BATCH_ROWS
+from .filters import CdxFilter
+from .shards import plan_shards, merge_shards, CDX_SHARD_MIN_ROWS
+from .batch import resolve_captures, query_captures, plan_reads, export_records
 
 #models.Base.metadata.create_all(bind=engine)
 
 # Create a logger, beneath the Uvicorn error logger:
 logger = logging.getLogger(f"uvicorn.error.{__name__}")
 
+# Size of the chunks to pass CDX query results on in:
+CDX_STREAM_CHUNK_SIZE = int(os.environ.get("CDX_STREAM_CHUNK_SIZE", 64*1024))
+# Size of the chunks to pass WARC records on in, which grow up to the maximum for big records:
+WARC_CHUNK_SIZE = int(os.environ.get("WARC_CHUNK_SIZE", 64*1024))
+WARC_MAX_CHUNK_SIZE = int(os.environ.get("WARC_MAX_CHUNK_SIZE", 1024*1024))
+
 # Setup a router:
 router = APIRouter(
     prefix='/mementos'
@@ -60,10 +78,25 @@ uk,bl)/ 20220405104602 https://www.bl.uk/ text/html 200 HSJLEPFGS4K4KIDOHUYFJ3FE
 ...
 ```
 
+ Results can also be returned as `json` (an array of arrays, the first holding the field names), `ndjson`
+ (one object per line), `csv`, `columns` (one object per line, each holding a batch of rows as arrays
+ of column values) or `arrow` (an [Apache Arrow](https://arrow.apache.org/) IPC stream, if available).
+
+ Large result sets are returned in pages, each of at most 100,000 rows (or 32MB). When there are more
+ results, the response carries a `Link: <...>; rel="next"` header with the URL of the next page, which
+ is the same query with a `cursor` parameter added.
+
+ Alternatively, with `showResumeKey=true` (as per pywb), each page is streamed as it is read, and when
+ there are more results it ends with a resume key: after a blank line for `cdx` and `csv`, as a final
+ `[]` row followed by `["<key>"]` for `json`, as a final `{"cursor": "<key>"}` line for `ndjson` and
+ `columns`, or in the metadata of a final empty record batch for `arrow`. The next page is fetched by
+ repeating the same query with the resume key as the `cursor` parameter.
+
  Note that our <a href="/wayback/archive/">Wayback service</a> also supports the Memento API as per [RFC7089#4.2](https://datatracker.ietf.org/doc/html/rfc7089#section-4.2).
     """
 )
 async def lookup_url(
+    request: Request,
     url: AnyHttpUrl = Query(
         ...,
         title="URL to find.",
@@ -94,7 +127,7 @@ async def lookup_url(
         schemas.LookupOutputType.cdx,
             title='',
 
-        description='Content type returned. CDX (default) or JSON.',
+        description='Content type returned. CDX (default), JSON, NDJSON, CSV, columns or Arrow.',
         alias='output'
 
     ),
@@ -111,10 +144,30 @@ async def lookup_url(
     to_date: Optional[str] = schemas.create_query_param_from_path(schemas.path_range_ts, "to"),
     
     collapseToFirst: str = schemas.create_query_param_from_path(schemas.path_collapse),
-    collapseToLast: str = schemas.create_query_param_from_path(schemas.path_collapse)
+    collapseToLast: str = schemas.create_query_param_from_path(schemas.path_collapse),
+    filters: Optional[List[str]] = Query(
+        None,
+        alias='filter',
+        description="""Only return rows matching a filter, of the form `[!][=|~]field:value`, e.g. `mimetype:text/html`.
+                       The value is a regular expression to match, unless prefixed with `=` for an exact match or `~` to match
+                       anything containing it. A leading `!` inverts the filter. Can be given more than once."""
+    ),
+    dedup: bool = Query(
+        False,
+        description="Only return the first capture of each digest of each URL, dropping later duplicates such as revisits."
+    ),
+    cursor: Optional[str] = Query(
+        None,
+        description="Where to start the page of results, as given by the `Link: rel=\"next\"` header (or the resume key) of the previous page."
+    ),
+    showResumeKey: bool = Query(
+        False,
+        description="Stream each page as it is read, ending it with the resume key for the next page (if any), rather than giving the next page in a `Link` header."
+    ),
 ):
 
     # Basic validation and derived parameters:
+    check_format(outputType.value)
     if sort.value == "closest" and not closest:
         raise HTTPException(status_code=400, detail="Timestamp required for Closest sort.")
     if sort.value != "closest" and closest:
@@ -122,37 +175,138 @@ async def lookup_url(
     if collapseToFirst and collapseToLast:
         raise HTTPException(status_code=400, detail="Only one of collapseToFirst or collapseToLast can be specified")
 
+    # Set up any filtering, de-duplication and collapsing of the results, which happens here rather than upstream:
+    cdx_filter = CdxFilter(filters, dedup, collapseToFirst or collapseToLast, collapse_last=bool(collapseToLast))
+
+    # Work out where this page starts, and how far it goes:
+    if cursor:
+        page_cursor = Cursor.decode(cursor)
+    else:
+        page_cursor = Cursor(remaining=limit)
+    page_rows = CDX_PAGE_MAX_ROWS
+    if page_cursor.remaining is not None:
+        page_rows = min(page_rows, page_cursor.remaining)
+
     # Only put through allowed parameters:
     params = {
         'url': url,
         'matchType': matchType.value,
         'sort': sort.value,
-        'limit': limit,
-        'output': "json" if outputType == "json" else None,
+        # Ask for one row more than fits on the page, to find out if there are more:
+        'limit': page_rows + 1,
         'closest': closest if (closest and sort.value == "closest") else None,
         'from': from_date,
         'to': to_date,
-        'collapseToFirst': collapseToFirst,
-        'collapseToLast': collapseToLast
         }
-    
-    
-    # Open a streaming call to cdx.api.wa.bl.uk/data-heritrix and stream the results back...
-    r = requests.request(
-        method='GET',
-        url=f"{CDX_SERVER}",
-        params=params,
-        stream=True
+    scope = None
+    if sort.value == "closest":
+        params['limit'] = page_cursor.skip + page_rows + 1
+    elif page_cursor.key is not None:
+        urlkey = page_cursor.urlkey()
+        prefixes = key_scope(url, matchType.value)
+        if matchType.value == "exact" and not dedup:
+            # All the rows share the urlkey, so skip ahead by timestamp, leaving only repeats of the cursor key to skip
+            # (this doesn't work when de-duplicating, which needs to see the earlier digests):
+            ts = page_cursor.timestamp()
+            if sort.value == "reverse":
+                params['to'] = ts if not to_date or upper_bound(to_date) > int(ts) else to_date
+            else:
+                params['from'] = ts if not from_date or lower_bound(from_date) < int(ts) else from_date
+            params['limit'] = page_cursor.skip + page_rows + 1
+        elif sort.value == "default" and prefixes and urlkey.startswith(prefixes) and page_cursor.urlkey_rows is not None:
+            # Carry on with a key range query from the cursor's urlkey, cut off here once it goes past the query's urlkeys,
+            # so only the rows already returned for that urlkey need skipping:
+            scope = prefixes
+            params.update({ 'url': None, 'matchType': 'range', 'urlkey': urlkey.decode('utf-8') })
+            params['limit'] = page_cursor.urlkey_rows + page_rows + 1
+        else:
+            # Earlier rows get skipped here, so there's no telling how many rows will be needed
+            # (there's no range query to resume a reverse-sorted query with):
+            params['limit'] = None
+    if cdx_filter:
+        # Likewise if rows get filtered out here:
+        params['limit'] = None
+
+    # Split large host, domain and prefix queries into key range shards, to be run in parallel...
+    shards = None
+    if sort.value == "default" and page_rows >= CDX_SHARD_MIN_ROWS and (page_cursor.key is None or scope):
+        prefixes = key_scope(url, matchType.value)
+        shards = plan_shards(prefixes, page_cursor.urlkey())
+    if shards:
+        scope = prefixes
+        params.update({ 'url': None, 'matchType': 'range', 'urlkey': None })
+        logger.info("running query as %i shards: %s" % (len(shards), [first for (first, end) in shards]))
+        r = None
+        source = merge_shards(params, shards, scope, request)
+        scoped = source
+        content_type = MEDIA_TYPES[outputType.value]
+    else:
+        # ...or open a streaming call to cdx.api.wa.bl.uk/data-heritrix...
+        client = get_client()
+        r = await client.send(
+            client.build_request(
+                'GET',
+                CDX_SERVER,
+                params={ key: str(value) for (key, value) in params.items() if value is not None },
+            ),
+            stream=True,
         )
-    
-    # log url
-    logger.info("actual request url: ")
-    logger.info(r.url)
-    
 
-    return StreamingResponse(r.iter_content(chunk_size=10*1024),
-                media_type=r.headers['Content-Type'])
+        # log url
+        logger.info("actual request url: ")
+        logger.info(r.url)
+
+        # ...and stream any error responses straight back:
+        if r.status_code != 200:
+            return StreamingResponse(
+                stream_upstream(r, request, chunk_size=CDX_STREAM_CHUNK_SIZE),
+                status_code=r.status_code,
+                headers={ 'Content-Type': r.headers.get('Content-Type', 'text/plain') },
+                background=BackgroundTask(r.aclose),
+            )
+        content_type = r.headers.get('Content-Type', 'text/plain') if outputType == "cdx" else MEDIA_TYPES[outputType.value]
+        source = aiter_lines(stream_upstream(r, request, chunk_size=CDX_STREAM_CHUNK_SIZE))
+        scoped = within_scope(source, scope) if scope else source
+
+    # Read a page of results, closing the upstream queries as soon as the page is full:
+    lines = cdx_filter.apply(scoped) if cdx_filter else scoped
+    page = Page(lines, page_cursor, sort=sort.value if sort.value != "default" else None, max_rows=CDX_PAGE_MAX_ROWS)
+
+    async def close_page():
+        # This may run as the response is being cancelled, so shield the clean-up to make sure it happens:
+        with anyio.CancelScope(shield=True):
+            await lines.aclose()
+            await scoped.aclose()
+            await source.aclose()
+            if r is not None:
+                await r.aclose()
+
+    if showResumeKey:
+        # Stream the page in the requested format as it is read, ending it with the resume key:
+        async def page_chunks():
+            try:
+                async for chunk in atranscode(page.batches(CDX_TRANSCODE_BATCH_ROWS), outputType.value,
+                        resume_key=lambda: page.next_cursor.encode() if page.next_cursor else None):
+                    yield chunk
+            finally:
+                await close_page()
+
+        return StreamingResponse(page_chunks(), headers={ 'Content-Type': content_type }, background=BackgroundTask(close_page))
+
+    # Otherwise, read the whole page (within its budgets) first, so the link to the next page can go in the headers:
+    try:
+        rows = [line async for line in page]
+    finally:
+        await close_page()
+    headers = { 'Content-Type': content_type }
+    if page.next_cursor:
+        headers['Link'] = '<%s>; rel="next"' % request.url.include_query_params(cursor=page.next_cursor.encode())
+
+    async def page_batches():
+        for i in range(0, len(rows), CDX_TRANSCODE_BATCH_ROWS):
+            yield rows[i:i+CDX_TRANSCODE_BATCH_ROWS]
 
+    return StreamingResponse(atranscode(page_batches(), outputType.value), headers=headers)
 
 #
 #
@@ -182,9 +336,13 @@ async def resolve_url(
     response_class=StreamingResponse,
     description="""
 Look up a URL and timestamp and get the corresponding raw WARC record.
+
+If the client accepts `gzip` encoding, the compressed record is passed straight through with `Content-Encoding: gzip`.
+Byte `Range` requests are supported, and apply to the record as sent (i.e. to the compressed bytes when it is passed through compressed).
     """
 )
 async def get_warc(
+    request: Request,
     timestamp: str = schemas.path_ts,
     url: AnyHttpUrl = schemas.path_url,
 ):
@@ -193,48 +351,235 @@ async def get_warc(
 
         # Check access:
         logger.info("Checking %s %s" % (timestamp, url))
-        can_access(url)
+        await can_access_async(url)
 
         # Query CDX Server for the item
-        (warc_filename, warc_offset, compressed_end_offset) = lookup_in_cdx(url, timestamp)
+        (warc_filename, warc_offset, compressed_end_offset) = await lookup_in_cdx_async(url, timestamp)
 
         logger.error("Getting record: %s %s %s" % (warc_filename, warc_offset, compressed_end_offset))
 
         # If not found, say so:
         if warc_filename is None:
-            abort(404)
-
-        # Grab the payload from the WARC and return it.
-        stream, content_type = get_warc_stream(warc_filename,warc_offset, compressed_end_offset, payload_only=False)
-
-        # Wrap as generator
-        # https://fastapi.tiangolo.com/advanced/custom-response/#using-streamingresponse-with-file-like-objects
-        def iterfile():
-            while True:
-                chunk = stream.read(10240)
-                if len(chunk) > 0:
-                    yield chunk
-                else:
-                    break
+            raise HTTPException(status_code=404, detail="Not Found")
 
         # Add a filename header for direct downloads:
         slug = s = re.sub('[^0-9a-zA-Z]+', '-', url)
-        if 'application/warc' == content_type:
-            ext = 'warc'
-        else:
-            ext = 'arc'
         headers = {
-            'Content-Disposition': f'attachment; filename="{timestamp}_{slug}.{ext}"'
+            'Content-Disposition': f'attachment; filename="{timestamp}_{slug}.warc"',
+            'Accept-Ranges': 'bytes',
+            'Vary': 'Accept-Encoding',
         }
 
+        # If the client can take it, pass the compressed record straight through, ranges and all:
+        length = int(compressed_end_offset) if compressed_end_offset else None
+        if length and warc_filename.endswith('.gz') and _accepts_gzip(request):
+            byte_range = parse_range(request.headers.get('Range'), length)
+            first, last = byte_range or (0, length - 1)
+            r = await open_warc_record_async(warc_filename, warc_offset, length, first, last)
+            await _check_warc_response(r)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Content-Length'] = str(length)
+            chunks = None
+        else:
+            # Otherwise, decompress the record, working out its size so ranges can be supported:
+            r = await open_warc_record_async(warc_filename, warc_offset, length)
+            await _check_warc_response(r)
+            try:
+                length, chunks = await peek_record_size(aiter_first_member(r))
+                byte_range = parse_range(request.headers.get('Range'), length)
+            except BaseException:
+                # The response won't be sent, so close the upstream record now (even if cancelled):
+                with anyio.CancelScope(shield=True):
+                    await r.aclose()
+                raise
+            if length is not None:
+                headers['Content-Length'] = str(length)
+            if byte_range:
+                chunks = slice_stream(chunks, *byte_range)
+
+        if byte_range:
+            headers.update(range_headers(byte_range, length))
+
         # Return the WARC stream:
         return StreamingResponse(
-            iterfile(), 
-            media_type=content_type,
+            stream_upstream(r, request, chunk_size=WARC_CHUNK_SIZE, raw=True, max_chunk_size=WARC_MAX_CHUNK_SIZE, chunks=chunks),
+            status_code=206 if byte_range else 200,
+            media_type='application/warc',
             headers=headers,
+            background=BackgroundTask(r.aclose),
         )
 
 
+@router.post("/warc",
+    summary="Get a Batch of WARC Records",
+    response_class=StreamingResponse,
+    description="""
+Get many WARC records at once, as a single `.warc.gz` file.
+
+The batch is either a list of `captures`, each a URL and a timestamp that is resolved to the closest capture (as for `/mementos/warc`),
+or a CDX `query`, all of whose results are exported (up to a limit). For example:
+
+```
+{"captures": [{"url": "http://portico.bl.uk/", "timestamp": "19950630120000"}]}
+{"query": {"url": "http://portico.bl.uk/", "matchType": "prefix", "from": "1995", "filter": ["mimetype:text/html"]}}
+```
+
+The records are sent grouped by WARC file and in the order they appear in them, rather than in the order asked for.
+Any records that are not found, or cannot be accessed, are left out.
+    """
+)
+async def get_warc_batch(
+    request: Request,
+    batch: schemas.WarcBatchRequest,
+):
+        if bool(batch.captures) == bool(batch.query):
+            raise HTTPException(status_code=400, detail="Give either a list of captures or a query.")
+
+        # Find the records, checking access to each:
+        if batch.captures:
+            records = await resolve_captures([(c.url, c.timestamp) for c in batch.captures])
+        else:
+            query = batch.query
+            cdx_filter = CdxFilter(query.filters)
+            params = {
+                'url': query.url,
+                'matchType': query.matchType.value,
+                'from': query.from_date,
+                'to': query.to_date,
+            }
+            records = await query_captures(params, cdx_filter if cdx_filter else None)
+        if not records:
+            raise HTTPException(status_code=404, detail="Not Found")
+
+        # Fetch them, sharing reads between records that are close together in the same WARC file:
+        spans = plan_reads(records)
+        logger.info("Exporting %i records in %i reads" % (len(records), len(spans)))
+        return StreamingResponse(
+            export_records(spans, request),
+            media_type='application/gzip',
+            headers={ 'Content-Disposition': f'attachment; filename="batch-{len(records)}.warc.gz"' },
+        )
+
+
+@router.get("/raw/{timestamp}/{url:path}",
+    summary="Get an Archived Resource",
+    response_class=StreamingResponse,
+    description="""
+Look up a URL and timestamp and get the corresponding archived resource, i.e. the payload of the WARC record, as it was originally served but with any transfer and content encoding undone.
+
+The original `Content-Type` is passed on, and byte `Range` requests are supported. Where the size of the resource isn't known in advance (e.g. when it was archived with chunked or gzip encoding), only ranges with both a first and last byte are supported, and the `Content-Range` gives the total size as `*`.
+
+Revisit records are followed to the original capture, which must also be accessible and have the same payload digest.
+    """
+)
+async def get_raw(
+    request: Request,
+    timestamp: str = schemas.path_ts,
+    url: AnyHttpUrl = schemas.path_url,
+):
+        # Check access:
+        logger.info("Checking %s %s" % (timestamp, url))
+        await can_access_async(url)
+
+        # Query CDX Server for the item, and start reading the record:
+        r, payload = await _open_payload(url, timestamp)
+
+        # Revisit records don't hold the payload, so look up the original capture:
+        if payload.record_type == 'revisit':
+            await r.aclose()
+            refers_to = payload.record_headers.get('warc-refers-to-target-uri', url)
+            refers_to_date = re.sub(r'\D', '', payload.record_headers.get('warc-refers-to-date', ''))[:14]
+            digest = payload.record_headers.get('warc-payload-digest')
+            if not refers_to_date:
+                raise HTTPException(status_code=404, detail="Not Found")
+            # The original may be of another URL, so check access to that too:
+            if refers_to != url:
+                await can_access_async(refers_to)
+            r, payload = await _open_payload(refers_to, refers_to_date)
+            # Make sure it's the same payload the revisit refers to:
+            if not _same_digest(digest, payload.record_headers.get('warc-payload-digest')):
+                await r.aclose()
+                logger.warning("Revisit of %s %s refers to %s %s, which has a different payload digest" % (timestamp, url, refers_to_date, refers_to))
+                raise HTTPException(status_code=404, detail="Not Found")
+
+        if payload.record_type not in ('response', 'resource'):
+            await r.aclose()
+            raise HTTPException(status_code=404, detail="Not Found")
+
+        headers = {
+            'Content-Type': payload.content_type or 'application/octet-stream',
+        }
+        if payload.content_encoding:
+            headers['Content-Encoding'] = payload.content_encoding
+        if payload.timestamp():
+            headers['Memento-Datetime'] = format_datetime(datetime.strptime(payload.timestamp(), WAYBACK_TS_FORMAT).replace(tzinfo=timezone.utc), usegmt=True)
+        chunks = payload.chunks
+        headers['Accept-Ranges'] = 'bytes'
+        if payload.size is not None:
+            headers['Content-Length'] = str(payload.size)
+        try:
+            byte_range = parse_range(request.headers.get('Range'), payload.size)
+            if byte_range and payload.size is not None:
+                chunks = slice_stream(chunks, *byte_range)
+                headers.update(range_headers(byte_range, payload.size))
+            elif byte_range:
+                # The size isn't known until the payload has all been decoded, so read into the range to check it:
+                chunks, byte_range, size, length = await open_slice(chunks, *byte_range, read_ahead=WARC_MAX_CHUNK_SIZE)
+                headers.update(range_headers(byte_range, size))
+                if length is not None:
+                    headers['Content-Length'] = str(length)
+        except BaseException:
+            # The response won't be sent, so close the upstream record now (even if cancelled):
+            with anyio.CancelScope(shield=True):
+                await r.aclose()
+            raise
+
+        return StreamingResponse(
+            stream_upstream(r, request, chunk_size=WARC_CHUNK_SIZE, max_chunk_size=WARC_MAX_CHUNK_SIZE, chunks=chunks),
+            status_code=206 if byte_range else 200,
+            headers=headers,
+            background=BackgroundTask(r.aclose),
+        )
+
+
+async def _open_payload(url, timestamp):
+    # Look up the record and start reading it, returning the WebHDFS response and the payload:
+    (warc_filename, warc_offset, compressed_end_offset) = await lookup_in_cdx_async(url, timestamp)
+    if warc_filename is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    r = await open_warc_record_async(warc_filename, warc_offset, compressed_end_offset)
+    await _check_warc_response(r)
+    try:
+        return r, await read_payload(aiter_first_member(r))
+    except BaseException:
+        with anyio.CancelScope(shield=True):
+            await r.aclose()
+        raise
+
+
+def _same_digest(a, b):
+    # Whether two payload digests (e.g. 'sha1:BASE32') match, if both are known:
+    if not a or not b:
+        return True
+    return a.strip().lower().rsplit(':', 1)[-1] == b.strip().lower().rsplit(':', 1)[-1]
+
+
+def _accepts_gzip(request):
+    # Whether the Accept-Encoding header allows gzip (without q=0):
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip().lower() in ('gzip', 'x-gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+async def _check_warc_response(r):
+    if r.status_code not in (200, 206):
+        await r.aclose()
+        logger.warning("Could not read WARC record from %s: %s" % (r.url, r.status_code))
+        raise HTTPException(status_code=502, detail="Could not read WARC record.")
+
+
 @router.get("/screenshot/{timestamp}/{url:path}",
     summary="Generate an IIIF Screenshot URL",
     response_class=RedirectResponse,
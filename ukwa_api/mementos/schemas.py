@@ -20,6 +20,10 @@ class LookupSort(Enum):
 class LookupOutputType(str, Enum):
     cdx = 'cdx'
     json = 'json'
+    ndjson = 'ndjson'
+    csv = 'csv'
+    columns = 'columns'
+    arrow = 'arrow'
 
 path_ts = Path(
         ...,
@@ -68,4 +72,20 @@ def create_query_param_from_path(path: Path, alias: Optional[str] = None) -> Que
     }
     if alias is not None: # allow us to override for cdx params that might conflict with python keywords
         query_params['alias'] = alias
-    return Query(None, **query_params)
\ No newline at end of file
+    return Query(None, **query_params)
+
+class WarcBatchCapture(BaseModel):
+    url: AnyHttpUrl = Field(..., description="URL to look up.", example='http://portico.bl.uk/')
+    timestamp: str = Field(..., description="14-digit timestamp to aim for. Format YYYYMMDDHHMMSS.",
+        example='19950630120000', regex=r"^\d{14}$")
+
+class WarcBatchQuery(BaseModel):
+    url: AnyHttpUrl = Field(..., description="URL to look for.", example='http://portico.bl.uk/')
+    matchType: LookupMatchType = Field(LookupMatchType.exact, description="Type of match to look for, as for the CDX API.")
+    from_date: Optional[str] = Field(None, alias='from', description=path_range_ts.description, regex=path_range_ts.regex)
+    to_date: Optional[str] = Field(None, alias='to', description=path_range_ts.description, regex=path_range_ts.regex)
+    filters: Optional[List[str]] = Field(None, alias='filter', description="Filters of the form `[!][=|~]field:value`, as for the CDX API.")
+
+class WarcBatchRequest(BaseModel):
+    captures: Optional[List[WarcBatchCapture]] = Field(None, description="The captures to export, each resolved to the closest match.")
+    query: Optional[WarcBatchQuery] = Field(None, description="A CDX query, all of whose results are exported.")
@@ -0,0 +1,174 @@
+"""
+Parallel, sharded CDX queries.
+
+A large host, domain or prefix query is a single sequential scan of a range of urlkeys in OutbackCDX.
+To spread the work, the range is split at a few urlkeys, and each shard is run as a key range query
+(matchType=range) starting from its split key, which is cut off here as soon as its rows reach the next
+split key (or go beyond the urlkeys the query covers, as for resumed pages, see paging.within_scope()).
+The shards are disjoint, so between them they scan the same rows as the single query would have.
+
+The shards are run concurrently, up to CDX_SHARD_CONCURRENCY at a time, each read ahead into a bounded
+buffer, and heap-merged back into one stream in key order. Shards that haven't been read from yet sit
+in the heap under their split key, as none of their rows can come before it, so they are started in
+order, as the earlier shards finish.
+
+OutbackCDX can't say where its keys fall, so the split keys are picked without asking it: the part of
+the urlkeys after the query's prefix is split up evenly by its first letter.
+"""
+import os
+import heapq
+import asyncio
+import logging
+
+import anyio
+from fastapi import HTTPException
+
+from ..cdx import CDX_SERVER
+from ..clients import get_client, stream_upstream
+from .paging import aiter_lines, row_key, row_urlkey, within_scope
+
+# Maximum number of shards to split a query into (1 to disable sharding):
+CDX_SHARDS = int(os.environ.get("CDX_SHARDS", 8))
+# Maximum number of shards to run at once:
+CDX_SHARD_CONCURRENCY = int(os.environ.get("CDX_SHARD_CONCURRENCY", 4))
+# Smallest page of results worth sharding the query for:
+CDX_SHARD_MIN_ROWS = int(os.environ.get("CDX_SHARD_MIN_ROWS", 1000))
+# Number of lines to read ahead from each shard:
+CDX_SHARD_BUFFER = int(os.environ.get("CDX_SHARD_BUFFER", 1000))
+# Size of the chunks to read shard results in:
+CDX_SHARD_CHUNK_SIZE = int(os.environ.get("CDX_SHARD_CHUNK_SIZE", 64*1024))
+
+# The characters to split the urlkeys on, most of which start with one of these:
+SPLIT_CHARACTERS = b'abcdefghijklmnopqrstuvwxyz'
+
+# Create a logger, beneath the Uvicorn error logger:
+logger = logging.getLogger(f"uvicorn.error.{__name__}")
+
+
+def split_keys(prefixes, shards):
+    """
+    Picks the urlkeys to split the range covered by some urlkey prefixes at, to make up to `shards` shards.
+
+    :param prefixes: the urlkey prefixes a query covers, as from paging.key_scope()
+    :return: a sorted list of urlkeys
+    """
+    # The paths of a host all start with '/', so split after that:
+    bases = [prefix + b'/' if prefix.endswith(b')') else prefix for prefix in prefixes]
+    per_base = max(shards // len(bases), 1)
+    keys = []
+    for i, base in enumerate(bases):
+        if i > 0:
+            # Each further prefix starts a new shard:
+            keys.append(base)
+        for j in range(1, per_base):
+            keys.append(base + SPLIT_CHARACTERS[len(SPLIT_CHARACTERS) * j // per_base:][:1])
+    return sorted(keys)
+
+
+def plan_shards(prefixes, start=None, shards=None):
+    """
+    Splits the range of urlkeys a query covers into shards.
+
+    :param prefixes: the urlkey prefixes the query covers, as from paging.key_scope()
+    :param start: the urlkey to start from, if not the start of the range (e.g. for a resumed page)
+    :param shards: the maximum number of shards, defaulting to CDX_SHARDS
+    :return: a list of (first, end) urlkeys for each shard, the end being None for the last one,
+             or None if the query should not be sharded
+    """
+    shards = shards or CDX_SHARDS
+    if not prefixes or shards <= 1:
+        return None
+    start = start or min(prefixes)
+    keys = [key for key in split_keys(prefixes, shards) if key > start]
+    if not keys:
+        return None
+    return list(zip([start] + keys, keys + [None]))
+
+
+async def _read_shard(params, end, prefixes, request, queue, slots, scope):
+    # Read the shard into the queue, ending with None (or the error). The queue is bounded, so a slow merge slows the reads down.
+    # The merge stops the shard through its cancel scope, which (unlike cancelling the task) leaves the shielded parts be:
+    with scope:
+        if scope.cancel_called:
+            return
+        async with slots:
+            r = None
+            try:
+                client = get_client()
+                # Shielded, as cancelling a request while the connection pool is setting it up can leave it stuck there:
+                with anyio.CancelScope(shield=True):
+                    r = await client.send(
+                        client.build_request(
+                            'GET',
+                            CDX_SERVER,
+                            params={ key: str(value) for (key, value) in params.items() if value is not None },
+                        ),
+                        stream=True,
+                    )
+                if r.status_code != 200:
+                    raise IOError("status code %i" % r.status_code)
+                source = aiter_lines(stream_upstream(r, request, chunk_size=CDX_SHARD_CHUNK_SIZE))
+                lines = within_scope(source, prefixes)
+                try:
+                    async for line in lines:
+                        if end is not None and row_urlkey(line) >= end:
+                            break
+                        if line.strip():
+                            await queue.put(line)
+                finally:
+                    with anyio.CancelScope(shield=True):
+                        await lines.aclose()
+                        await source.aclose()
+            except Exception as e:
+                logger.warning("Reading CDX shard %s failed: %s" % (params.get('urlkey'), e))
+                await queue.put(e)
+                return
+            finally:
+                # Make sure the upstream query gets closed, even if the merge has given up on this shard:
+                if r is not None:
+                    with anyio.CancelScope(shield=True):
+                        await r.aclose()
+        await queue.put(None)
+
+
+async def _next_line(queue):
+    line = await queue.get()
+    if isinstance(line, Exception):
+        raise HTTPException(status_code=502, detail="CDX query failed.")
+    return line
+
+
+async def merge_shards(params, shards, prefixes, request, concurrency=None):
+    """
+    Runs a query as key range shards, merging their lines into one stream, in key order.
+
+    :param params: the upstream query parameters for a key range query, without the urlkey
+    :param shards: the (first, end) urlkeys of the shards, as from plan_shards()
+    :param prefixes: the urlkey prefixes the query covers, beyond which the shards are cut off
+    """
+    slots = asyncio.Semaphore(concurrency or CDX_SHARD_CONCURRENCY)
+    queues = [asyncio.Queue(maxsize=CDX_SHARD_BUFFER) for shard in shards]
+    scopes = [anyio.CancelScope() for shard in shards]
+    # The shards are started in order, so the earlier ones get to run first:
+    readers = [asyncio.ensure_future(_read_shard(dict(params, urlkey=first.decode('utf-8')), end, prefixes, request, queue, slots, scope))
+        for (first, end), queue, scope in zip(shards, queues, scopes)]
+    try:
+        # Each shard starts out under its first urlkey, which sorts before any of its rows:
+        heap = [(first, i, None) for i, (first, end) in enumerate(shards)]
+        heapq.heapify(heap)
+        while heap:
+            key, i, line = heap[0]
+            if line is not None:
+                yield line
+            line = await _next_line(queues[i])
+            if line is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (row_key(line), i, line))
+    finally:
+        # Stop any shards that are still running, which closes their upstream queries:
+        for scope in scopes:
+            scope.cancel()
+        with anyio.CancelScope(shield=True):
+            await asyncio.gather(*readers, return_exceptions=True)
+
@@ -0,0 +1,227 @@
+"""
+Streaming extraction of the payloads of archived resources from WARC (or ARC) records.
+
+This works through the record as it arrives, rather than reading it all in first: the record
+headers and any HTTP headers are parsed, and then the body is passed on, de-chunked and
+decompressed as needed, so even very large payloads (e.g. video) use little memory.
+"""
+import re
+import zlib
+import logging
+
+# The most that any set of headers is expected to take up:
+MAX_HEADER_SIZE = 64*1024
+
+# Create a logger, beneath the Uvicorn error logger:
+logger = logging.getLogger(f"uvicorn.error.{__name__}")
+
+
+class ChunkReader:
+    """
+    Buffered reading from an async iterator of byte chunks.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._buffer = b''
+        self._eof = False
+
+    async def _fill(self):
+        if self._eof:
+            return False
+        try:
+            self._buffer += await self._chunks.__anext__()
+            return True
+        except StopAsyncIteration:
+            self._eof = True
+            return False
+
+    async def read_until(self, separator, limit=MAX_HEADER_SIZE):
+        """
+        Reads up to and including the separator, or whatever is left if the data runs out first.
+        """
+        start = 0
+        while True:
+            end = self._buffer.find(separator, start)
+            if end >= 0:
+                end += len(separator)
+                data, self._buffer = self._buffer[:end], self._buffer[end:]
+                return data
+            # Only search the new data (and any separator it might complete) next time around:
+            start = max(len(self._buffer) - len(separator) + 1, 0)
+            if len(self._buffer) > limit or not await self._fill():
+                data, self._buffer = self._buffer, b''
+                return data
+
+    async def iter_exactly(self, size):
+        """
+        Iterates over the next `size` bytes (or fewer, if the data runs out).
+        """
+        while size > 0:
+            if not self._buffer and not await self._fill():
+                return
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+            size -= len(data)
+            yield data
+
+    async def iter_rest(self):
+        """
+        Iterates over everything that's left.
+        """
+        if self._buffer:
+            data, self._buffer = self._buffer, b''
+            yield data
+        while await self._fill():
+            data, self._buffer = self._buffer, b''
+            yield data
+
+
+def parse_headers(block):
+    """
+    Parses a block of headers into a dict, with lower-cased names.
+    """
+    headers = {}
+    for line in block.decode('utf-8', 'replace').splitlines():
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+async def dechunk(chunks):
+    """
+    Undoes HTTP chunked transfer encoding, passing the data on as-is if it turns out not to be chunked.
+    """
+    reader = ChunkReader(chunks)
+    first = True
+    while True:
+        line = await reader.read_until(b'\r\n', limit=1024)
+        try:
+            size = int(line.split(b';')[0].strip(), 16)
+        except ValueError:
+            if first:
+                # Not really chunked, so pass it all on:
+                yield line
+                async for data in reader.iter_rest():
+                    yield data
+            return
+        first = False
+        if size == 0:
+            return
+        async for data in reader.iter_exactly(size):
+            yield data
+        await reader.read_until(b'\r\n', limit=2)
+
+
+async def decode_content(chunks, coding):
+    """
+    Undoes gzip or deflate content encoding, passing the data on as-is if it can't be decoded.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if coding in ('gzip', 'x-gzip') else zlib.MAX_WBITS)
+    first = True
+    async for chunk in chunks:
+        if first:
+            first = False
+            try:
+                data = decompressor.decompress(chunk)
+            except zlib.error:
+                if coding != 'deflate':
+                    logger.warning("Could not decode %s payload, passing it on as-is" % coding)
+                    yield chunk
+                    async for chunk in chunks:
+                        yield chunk
+                    return
+                # Some servers send raw deflate data, without the zlib wrapper:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = decompressor.decompress(chunk)
+        else:
+            data = decompressor.decompress(chunk)
+        if data:
+            yield data
+        if decompressor.eof:
+            return
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+class Payload:
+    """
+    The payload of a record, as an async iterator of byte chunks, with what the record says about it.
+    """
+
+    def __init__(self):
+        # The record type, e.g. 'response', 'resource' or 'revisit':
+        self.record_type = None
+        # The record headers, with lower-cased names:
+        self.record_headers = {}
+        # The archived HTTP status code and headers, for HTTP responses:
+        self.status_code = None
+        self.http_headers = {}
+        self.content_type = None
+        # Any content encoding that could not be undone:
+        self.content_encoding = None
+        # The size of the payload, if it can be known in advance:
+        self.size = None
+        self.chunks = None
+
+    def timestamp(self):
+        """
+        The 14-digit timestamp of the record, if known.
+        """
+        date = self.record_headers.get('warc-date') or self.record_headers.get('archive-date')
+        return re.sub(r'\D', '', date)[:14] if date else None
+
+
+async def read_payload(chunks):
+    """
+    Reads the headers of a (decompressed) WARC or ARC record, setting up the payload to stream on.
+    """
+    payload = Payload()
+    reader = ChunkReader(chunks)
+
+    # Parse the record headers:
+    first_line = await reader.read_until(b'\n')
+    if first_line.startswith(b'WARC/'):
+        payload.record_headers = parse_headers(await reader.read_until(b'\r\n\r\n'))
+        payload.record_type = payload.record_headers.get('warc-type')
+        block_type = payload.record_headers.get('content-type', '')
+        block_size = int(payload.record_headers.get('content-length', 0))
+        is_http = block_type.startswith('application/http')
+    else:
+        # ARC records have a single header line: URL, IP address, date, content type and length:
+        fields = first_line.decode('utf-8', 'replace').split()
+        if len(fields) < 5 or not fields[-1].isdigit():
+            return payload
+        payload.record_type = 'response'
+        payload.record_headers = {'archive-date': fields[2]}
+        block_type = fields[3]
+        block_size = int(fields[-1])
+        is_http = fields[0].startswith('http')
+    payload.content_type = block_type
+
+    if is_http and payload.record_type in ('response', 'revisit'):
+        # Parse the archived HTTP response headers:
+        head = await reader.read_until(b'\r\n\r\n')
+        block_size -= len(head)
+        status_line, _, header_block = head.partition(b'\r\n')
+        status = status_line.split(b' ', 2)
+        payload.status_code = int(status[1]) if len(status) > 1 and status[1].isdigit() else None
+        payload.http_headers = parse_headers(header_block)
+        payload.content_type = payload.http_headers.get('content-type')
+
+    payload.chunks = reader.iter_exactly(max(block_size, 0))
+    payload.size = max(block_size, 0)
+
+    # Undo any transfer or content encoding, in which case the size is no longer known:
+    if 'chunked' in payload.http_headers.get('transfer-encoding', '').lower():
+        payload.chunks = dechunk(payload.chunks)
+        payload.size = None
+    coding = payload.http_headers.get('content-encoding', '').lower()
+    if coding in ('gzip', 'x-gzip', 'deflate'):
+        payload.chunks = decode_content(payload.chunks, coding)
+        payload.size = None
+    elif coding and coding != 'identity':
+        payload.content_encoding = coding
+
+    return payload
@@ -0,0 +1,250 @@
+"""
+Pre-renders screenshots into the shared screenshot store, so the first person to ask for one doesn't
+have to wait for the web rendering service.
+
+It needs the same settings as the API (SCREENSHOT_CACHE_PATH, WEBRENDER_ARCHIVE_SERVER, WAYBACK_SERVER
+etc.), so is best run alongside it, e.g.
+
+    $ python -m ukwa_api.prerender --activity test/data/fc.crawled.json --watch 300
+
+This takes the recently crawled seeds from the 'screenshots' list of the recent crawl activity feed (a
+file like fc.crawled.json, or a URL like .../crawls/fc/recent-activity), newest first, plus any PWIDs or
+URLs given on the command line or in an --input file, one per line. A URL can be followed by a timestamp,
+and otherwise the most recent archived version is rendered. Each one is checked against the access rules,
+and rendered unless it is already in the store.
+
+So as not to hold up interactive requests, it makes at most PRERENDER_CONCURRENCY renders at once, starts
+at most PRERENDER_RATE a minute, and waits while PRERENDER_MAX_ACTIVE or more renders (its own, or the
+API workers') are in progress.
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import datetime
+
+import anyio
+from fastapi import HTTPException
+from prometheus_client import Counter, Gauge, start_http_server
+
+from .cdx import can_access_async
+from .pwid import gen_pwid
+from .clients import get_client, close_clients
+from .screenshot_store import screenshot_store
+from .screenshots import close_pool
+from .iiif.router import screenshot_target, render_archived_screenshot
+from .iiif.derivatives import build_derivatives
+
+ANALYSIS_SOURCE_FILE = os.environ.get("ANALYSIS_SOURCE_FILE", "test/data/fc.crawled.json")
+PRERENDER_CONCURRENCY = int(os.environ.get("PRERENDER_CONCURRENCY", 2))
+PRERENDER_RATE = float(os.environ.get("PRERENDER_RATE", 30))
+PRERENDER_MAX_ACTIVE = int(os.environ.get("PRERENDER_MAX_ACTIVE", 4))
+
+# Create a logger, beneath the Uvicorn error logger:
+logger = logging.getLogger(f"uvicorn.error.{__name__}")
+
+# Progress metrics:
+PRERENDER_ITEMS = Counter('ukwa_api_prerender_items', 'Screenshots handled by the pre-renderer, by result (rendered, cached, blocked or failed).',
+    labelnames=('result',))
+PRERENDER_DEFERRALS = Counter('ukwa_api_prerender_deferrals', 'Times the pre-renderer waited for other renders to finish before starting one.')
+PRERENDER_QUEUE = Gauge('ukwa_api_prerender_queue', 'Screenshots waiting to be pre-rendered.', multiprocess_mode='livesum')
+
+
+def to_timestamp(value):
+    """
+    Turns an ISO date (or a partial 14-digit timestamp) into a 14-digit timestamp.
+    """
+    return re.sub('[^0-9]', '', value)[:14].ljust(14, '0')
+
+
+def parse_item(line):
+    """
+    Interprets a PWID, or a URL optionally followed by a timestamp.
+
+    :return: the PWID, or None for blank lines and comments
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    parts = line.split()
+    if line.startswith('urn:pwid:') or '://' not in parts[0]:
+        # PWIDs, including Base64-encoded ones:
+        return line
+    timestamp = parts[1] if len(parts) > 1 else datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    return gen_pwid(to_timestamp(timestamp), parts[0], encodeBase64=False)
+
+
+async def load_activity(source):
+    """
+    Reads the recently crawled seeds from the recent crawl activity feed, from a file or URL.
+
+    :return: the PWIDs, newest first
+    """
+    if source.startswith('http://') or source.startswith('https://'):
+        r = await get_client().get(source)
+        r.raise_for_status()
+        stats = r.json()
+    else:
+        with open(source) as f:
+            stats = json.load(f)
+    screenshots = sorted(stats.get('screenshots', []), key=lambda entry: entry[1], reverse=True)
+    return [gen_pwid(to_timestamp(timestamp), url, encodeBase64=False) for url, timestamp in screenshots]
+
+
+class Prerenderer:
+    """
+    Works through a queue of PWIDs, rendering any that aren't in the screenshot store.
+    """
+
+    def __init__(self, store=screenshot_store, concurrency=PRERENDER_CONCURRENCY, rate=PRERENDER_RATE,
+            max_active=PRERENDER_MAX_ACTIVE, poll_interval=1.0):
+        self.store = store
+        self.concurrency = concurrency
+        self.rate = rate
+        self.max_active = max_active
+        self.poll_interval = poll_interval
+        self.results = dict.fromkeys(('rendered', 'cached', 'blocked', 'failed'), 0)
+        self._queue = asyncio.Queue()
+        self._queued = set()
+        self._pacing = asyncio.Lock()
+        self._next_start = 0
+
+    def add(self, pwid):
+        """
+        Queues up a PWID, unless it's already queued.
+        """
+        if pwid not in self._queued:
+            self._queued.add(pwid)
+            self._queue.put_nowait(pwid)
+            PRERENDER_QUEUE.inc()
+
+    async def run(self):
+        """
+        Works through the queue until it's empty.
+        """
+        workers = [asyncio.ensure_future(self._worker()) for i in range(self.concurrency)]
+        try:
+            await self._queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _worker(self):
+        while True:
+            pwid = await self._queue.get()
+            try:
+                result = await self.prerender(pwid)
+            except Exception as e:
+                logger.warning("Pre-rendering %s failed: %s" % (pwid, e))
+                result = 'failed'
+            finally:
+                self._queued.discard(pwid)
+                self._queue.task_done()
+                PRERENDER_QUEUE.dec()
+            self.results[result] += 1
+            PRERENDER_ITEMS.labels(result).inc()
+
+    async def prerender(self, pwid):
+        """
+        Renders the screenshot for a PWID into the store, unless it's already there.
+
+        :return: the result, 'rendered', 'cached' or 'blocked'
+        """
+        pwid, url, target_date = screenshot_target(pwid)
+        try:
+            await can_access_async(url)
+        except HTTPException as e:
+            logger.info("Not pre-rendering %s, as access is blocked: %s" % (url, e.detail))
+            return 'blocked'
+        if await anyio.to_thread.run_sync(self.store.get, pwid) is not None:
+            return 'cached'
+
+        await self._wait_turn()
+        logger.info("Pre-rendering %s at %s..." % (url, target_date))
+        path, image, content_type = await self.store.get_or_create(pwid, lambda: render_archived_screenshot(url, target_date))
+        # If there's a path, someone else rendered it in the meantime:
+        if image is None:
+            return 'cached'
+        await build_derivatives(pwid, image)
+        return 'rendered'
+
+    async def _wait_turn(self):
+        async with self._pacing:
+            # Leave the rendering service to the interactive requests while it's busy:
+            while await anyio.to_thread.run_sync(self.store.creating) >= self.max_active:
+                PRERENDER_DEFERRALS.inc()
+                await asyncio.sleep(self.poll_interval)
+            # And don't start renders any faster than the rate allows:
+            delay = self._next_start - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_start = time.monotonic() + (60.0 / self.rate if self.rate else 0)
+
+
+async def prerender(items, activity=None, watch=None, **kwargs):
+    """
+    Pre-renders the given PWIDs, then the recently crawled seeds, re-reading the feed every `watch` seconds if set.
+    """
+    prerenderer = Prerenderer(**kwargs)
+    for pwid in items:
+        prerenderer.add(pwid)
+    try:
+        while True:
+            if activity:
+                try:
+                    for pwid in await load_activity(activity):
+                        prerenderer.add(pwid)
+                except Exception as e:
+                    logger.warning("Could not read the recent crawl activity from %s: %s" % (activity, e))
+            start = time.monotonic()
+            await prerenderer.run()
+            logger.info("Pre-rendering done in %.1fs, totals: %s" % (time.monotonic() - start,
+                ', '.join('%s %i' % result for result in prerenderer.results.items())))
+            if not watch:
+                return prerenderer.results
+            await asyncio.sleep(watch)
+    finally:
+        await close_clients()
+        close_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('items', nargs='*', help="PWIDs, or URLs (optionally followed by a timestamp) to render.")
+    parser.add_argument('--input', help="File listing PWIDs or URLs to render, one per line ('-' for standard input).")
+    parser.add_argument('--activity', nargs='?', const=ANALYSIS_SOURCE_FILE,
+        help="Render the recently crawled seeds from this recent crawl activity file or URL (default: %(const)s).")
+    parser.add_argument('--watch', type=float, help="Keep re-reading the recent crawl activity, every this many seconds.")
+    parser.add_argument('--concurrency', type=int, default=PRERENDER_CONCURRENCY, help="Number of renders to make at once (default: %(default)s).")
+    parser.add_argument('--rate', type=float, default=PRERENDER_RATE, help="Most renders to start a minute, or 0 for no limit (default: %(default)s).")
+    parser.add_argument('--max-active', type=int, default=PRERENDER_MAX_ACTIVE,
+        help="Wait while this many renders are in progress, including the API's (default: %(default)s).")
+    parser.add_argument('--metrics-port', type=int, help="Serve Prometheus metrics on this port.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "info").upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    items = list(args.items)
+    if args.input:
+        f = sys.stdin if args.input == '-' else open(args.input)
+        with f:
+            items.extend(f)
+    items = [pwid for pwid in map(parse_item, items) if pwid]
+    if not items and not args.activity:
+        parser.error("Nothing to render: give some PWIDs or URLs, an --input file, or the --activity feed.")
+
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+
+    results = asyncio.run(prerender(items, activity=args.activity, watch=args.watch,
+        concurrency=args.concurrency, rate=args.rate, max_active=args.max_active))
+    sys.exit(1 if results['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Support for HTTP Range requests (RFC 7233) on streamed responses.
+
+Only single byte ranges are supported. Requests for multiple ranges get the whole thing, which the
+RFC allows.
+"""
+import re
+
+from fastapi import HTTPException
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    """
+    Works out which bytes a Range header asks for.
+
+    :param header: the Range header, or None
+    :param size: the size of the whole thing, or None if not known
+    :return: (first, last) byte positions, inclusive, or None to send the whole thing
+    """
+    if not header:
+        return None
+    match = RANGE_PATTERN.match(header.replace(' ', ''))
+    if not match or not any(match.groups()):
+        # Not a single byte range, so ignore it:
+        return None
+    first, last = match.groups()
+
+    if not first:
+        # A suffix range, i.e. the last N bytes:
+        if size is None:
+            return None
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first = int(first)
+        if last:
+            last = int(last)
+            if last < first:
+                return None
+        elif size is not None:
+            last = size - 1
+        else:
+            return None
+        if size is not None:
+            last = min(last, size - 1)
+
+    if size is not None and first >= size:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable.", headers={'Content-Range': 'bytes */%i' % size})
+    return first, last
+
+
+def range_headers(byte_range, size):
+    """
+    The headers to send with a partial (206) response.
+    """
+    first, last = byte_range
+    if size is None:
+        # The range may turn out to be cut short by the end of the data, so leave out the length:
+        return { 'Content-Range': 'bytes %i-%i/*' % (first, last) }
+    return {
+        'Content-Range': 'bytes %i-%i/%i' % (first, last, size),
+        'Content-Length': str(last - first + 1),
+    }
+
+
+async def slice_stream(chunks, first, last):
+    """
+    Passes on just bytes first to last (inclusive) of an async iterator of byte chunks.
+    """
+    position = 0
+    async for chunk in chunks:
+        end = position + len(chunk)
+        if end > first:
+            yield chunk[max(first - position, 0):last + 1 - position]
+        position = end
+        if position > last:
+            break
+
+
+async def open_slice(chunks, first, last, read_ahead=1024*1024):
+    """
+    Starts passing on just bytes first to last (inclusive) of an async iterator of byte chunks of
+    unknown size.
+
+    Up to `read_ahead` bytes of the range are read first, so if the data turns out to end within
+    that, the range can be cut down to fit, and the total size is known after all.
+
+    :return: (async iterator of byte chunks, (first, last), total size or None, length of the range or None),
+             or raises an HTTPException (416) if the data ends before the range starts
+    """
+    sliced = slice_stream(chunks, first, last)
+    head, length = [], 0
+    async for chunk in sliced:
+        head.append(chunk)
+        length += len(chunk)
+        if length >= read_ahead:
+            break
+    else:
+        if not length:
+            raise HTTPException(status_code=416, detail="Requested range not satisfiable.")
+        if first + length <= last:
+            # The data ended before the end of the range:
+            return _prepend(head, sliced), (first, first + length - 1), first + length, length
+        return _prepend(head, sliced), (first, last), None, length
+    return _prepend(head, sliced), (first, last), None, None
+
+
+async def _prepend(head, chunks):
+    for chunk in head:
+        yield chunk
+    async for chunk in chunks:
+        yield chunk
@@ -0,0 +1,354 @@
+"""
+A persistent, size-bounded store for screenshots, shared by all the gunicorn workers.
+
+Images are stored as plain files named by the SHA-256 of their content (so identical images are
+only stored once) under SCREENSHOT_CACHE_PATH/objects, and can be served straight from disk. An
+index in a SQLite file alongside them maps each key (e.g. a PWID) to an image, with its content
+type, expiry time and usage.
+
+Once the images add up to more than SCREENSHOT_CACHE_MAX_BYTES, entries are evicted, expired ones
+first, then least-recently-used ('lru', the default) or least-frequently-used ('lfu') as set by
+SCREENSHOT_CACHE_EVICTION, and any images no longer used are deleted. The totals are kept up to date
+by triggers, as are the images that may no longer be used, so checking them on each write is cheap.
+
+Files are written to a temporary name and renamed into place, and the index is only updated while
+holding the SQLite write lock, so workers never see partly-written images or delete each other's.
+Several images can be stored in one go with set_many(), e.g. all the derivatives of a screenshot.
+
+Images are only made once at a time for each key: concurrent calls to get_or_create() in the same
+worker wait for the same one, and other workers wait on a lock file under SCREENSHOT_CACHE_PATH/locks
+and then pick it up from the store.
+"""
+import os
+import time
+import fcntl
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import tempfile
+import threading
+
+import anyio
+from prometheus_client import Counter, Gauge
+
+CACHE_FOLDER = os.environ.get("CACHE_FOLDER", ".")
+SCREENSHOT_CACHE_PATH = os.environ.get("SCREENSHOT_CACHE_PATH", os.path.join(CACHE_FOLDER, 'screenshot_cache'))
+SCREENSHOT_CACHE_MAX_BYTES = int(os.environ.get("SCREENSHOT_CACHE_MAX_BYTES", 1024*1024*1024))
+SCREENSHOT_CACHE_TTL = int(os.environ.get("SCREENSHOT_CACHE_TTL", 60*60))
+SCREENSHOT_CACHE_EVICTION = os.environ.get("SCREENSHOT_CACHE_EVICTION", "lru")
+
+# How often to check if another worker has finished making an image:
+SCREENSHOT_LOCK_POLL_INTERVAL = float(os.environ.get("SCREENSHOT_LOCK_POLL_INTERVAL", 0.1))
+
+# The index of entries and the images they use, plus a single-row table of totals, kept up to date by triggers.
+# Images whose last entry goes are noted as orphans, to be deleted once checked they're still unused.
+# The totals are worked out from scratch when the table is first added (e.g. to an existing index), and
+# any images not in use are noted whenever the index is opened, all in one transaction:
+SQLITE_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, digest TEXT, content_type TEXT, expires REAL, accessed REAL, hits INTEGER);
+CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER);
+CREATE TABLE IF NOT EXISTS orphans (digest TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), entries INTEGER, images INTEGER, size INTEGER);
+INSERT OR IGNORE INTO totals SELECT 0, (SELECT COUNT(*) FROM entries), COUNT(*), COALESCE(SUM(size), 0) FROM objects;
+INSERT OR IGNORE INTO orphans SELECT digest FROM objects WHERE digest NOT IN (SELECT digest FROM entries);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE totals SET entries = entries + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF digest ON entries WHEN old.digest != new.digest BEGIN
+    INSERT OR IGNORE INTO orphans SELECT old.digest WHERE NOT EXISTS (SELECT 1 FROM entries WHERE digest = old.digest);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE totals SET entries = entries - 1;
+    INSERT OR IGNORE INTO orphans SELECT old.digest WHERE NOT EXISTS (SELECT 1 FROM entries WHERE digest = old.digest);
+END;
+CREATE TRIGGER IF NOT EXISTS objects_insert AFTER INSERT ON objects BEGIN
+    UPDATE totals SET images = images + 1, size = size + new.size;
+END;
+CREATE TRIGGER IF NOT EXISTS objects_delete AFTER DELETE ON objects BEGIN
+    UPDATE totals SET images = images - 1, size = size - old.size;
+END;
+COMMIT;
+"""
+
+# Create a logger, beneath the Uvicorn error logger:
+logger = logging.getLogger(f"uvicorn.error.{__name__}")
+
+# Cache metrics:
+SCREENSHOT_CACHE_LOOKUPS = Counter('ukwa_api_screenshot_cache_lookups', 'Screenshot cache lookups, by result (hit, miss or expired).',
+    labelnames=('result',))
+SCREENSHOT_CACHE_EVICTIONS = Counter('ukwa_api_screenshot_cache_evictions', 'Entries evicted from the screenshot cache.')
+SCREENSHOT_CACHE_SIZE = Gauge('ukwa_api_screenshot_cache_size', 'Size of the shared screenshot cache, as last seen by this worker, in entries, images or bytes.',
+    labelnames=('unit',), multiprocess_mode='liveall')
+SCREENSHOT_CACHE_CREATES = Counter('ukwa_api_screenshot_cache_creates', 'Images needed for the screenshot cache, by outcome (made here, '
+    'coalesced with a call in this worker, or shared from another worker).', labelnames=('result',))
+
+
+class ScreenshotStore:
+    """
+    Content-addressed store of images on disk, with a shared index, a size budget and eviction.
+    """
+
+    def __init__(self, path=SCREENSHOT_CACHE_PATH, max_bytes=SCREENSHOT_CACHE_MAX_BYTES, eviction=SCREENSHOT_CACHE_EVICTION,
+            poll_interval=SCREENSHOT_LOCK_POLL_INTERVAL):
+        if eviction not in ('lru', 'lfu'):
+            raise ValueError(f"Unknown SCREENSHOT_CACHE_EVICTION: {eviction}")
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._connection = None
+        self._pid = None
+
+    def _db(self):
+        # Connections must not be shared across a fork, so open one per process:
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(self.objects, exist_ok=True)
+            self._connection = sqlite3.connect(os.path.join(self.path, 'index.sqlite'), timeout=30,
+                isolation_level=None, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            try:
+                self._connection.executescript(SQLITE_SCHEMA)
+            except sqlite3.Error:
+                if self._connection.in_transaction:
+                    self._connection.execute("ROLLBACK")
+                raise
+            self._pid = os.getpid()
+        return self._connection
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def get(self, key):
+        """
+        Looks up an image.
+
+        :return: (path to the image file, content type), or None if there isn't one
+        """
+        result, outcome = self._lookup(key)
+        SCREENSHOT_CACHE_LOOKUPS.labels(outcome).inc()
+        return result
+
+    def _lookup(self, key):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT digest, content_type, expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, 'miss'
+            digest, content_type, expires = row
+            if expires and expires < now:
+                return None, 'expired'
+            path = self._object_path(digest)
+            if not os.path.exists(path):
+                logger.warning("Screenshot cache entry %s is missing its image, dropping it." % key)
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None, 'miss'
+            db.execute("UPDATE entries SET accessed = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        return (path, content_type), 'hit'
+
+    def set(self, key, payload, content_type, timeout=SCREENSHOT_CACHE_TTL):
+        """
+        Stores an image, evicting older entries if needed to stay within the size budget.
+
+        :return: the path to the image file
+        """
+        return self.set_many([(key, payload, content_type)], timeout)[0]
+
+    def set_many(self, items, timeout=SCREENSHOT_CACHE_TTL):
+        """
+        Stores several images at once, as a single update to the index, so they all appear together.
+
+        :param items: a list of (key, payload, content type)
+        :return: the paths to the image files
+        """
+        items = [(key, hashlib.sha256(payload).hexdigest(), payload, content_type) for (key, payload, content_type) in items]
+        # Write the files first, so the index isn't locked for long. Any deleted by another worker in the meantime are written again below:
+        for key, digest, payload, content_type in items:
+            if not os.path.exists(self._object_path(digest)):
+                self._write(self._object_path(digest), payload)
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for key, digest, payload, content_type in items:
+                    path = self._object_path(digest)
+                    if not os.path.exists(path):
+                        self._write(path, payload)
+                    db.execute("INSERT OR IGNORE INTO objects (digest, size) VALUES (?, ?)", (digest, len(payload)))
+                    # An upsert rather than a replace, so the triggers see it as an update:
+                    db.execute("INSERT INTO entries (key, digest, content_type, expires, accessed, hits) VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (key) DO UPDATE SET digest = excluded.digest, content_type = excluded.content_type, "
+                        "expires = excluded.expires, accessed = excluded.accessed, hits = excluded.hits",
+                        (key, digest, content_type, now + timeout if timeout else 0, now, 1))
+                orphans = self._evict(db, now)
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            # Only delete the files once the index no longer refers to them:
+            for orphan in orphans:
+                try:
+                    os.unlink(self._object_path(orphan))
+                except FileNotFoundError:
+                    pass
+            self._report(db)
+        return [self._object_path(digest) for key, digest, payload, content_type in items]
+
+    async def get_or_create(self, key, create):
+        """
+        Looks up an image, or awaits create() to make one, which should return (payload, content_type),
+        and stores it. Only one image is made at a time for each key, across all the workers.
+
+        :return: (path, None, content_type) for an image on disk, or (None, payload, content_type) for one just made
+        """
+        result = await anyio.to_thread.run_sync(self.get, key)
+        if result is not None:
+            path, content_type = result
+            return path, None, content_type
+
+        # If this worker is already making it, wait for that instead.
+        # It is shielded, so one caller giving up doesn't cancel it for the others:
+        task = self._inflight.get(key)
+        if task is not None:
+            SCREENSHOT_CACHE_CREATES.labels('coalesced').inc()
+        else:
+            task = asyncio.ensure_future(self._create(key, create))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._created(key, t))
+        return await asyncio.shield(task)
+
+    def _created(self, key, task):
+        self._inflight.pop(key, None)
+        # Mark any failure as retrieved, in case all the callers have gone:
+        if not task.cancelled():
+            task.exception()
+
+    async def _create(self, key, create):
+        lock_path = os.path.join(self.path, 'locks', hashlib.sha256(key.encode('utf-8')).hexdigest())
+        fd = await self._acquire(lock_path)
+        try:
+            # Another worker may have made it while this one was waiting:
+            result, outcome = await anyio.to_thread.run_sync(self._lookup, key)
+            if result is not None:
+                SCREENSHOT_CACHE_CREATES.labels('shared').inc()
+                path, content_type = result
+                return path, None, content_type
+            SCREENSHOT_CACHE_CREATES.labels('created').inc()
+            payload, content_type = await create()
+            await anyio.to_thread.run_sync(self.set, key, payload, content_type)
+            return None, payload, content_type
+        finally:
+            # Remove the lock file before unlocking it, so no-one else can lock it after it's gone:
+            os.unlink(lock_path)
+            os.close(fd)
+
+    async def _acquire(self, lock_path):
+        # Polls rather than blocking a thread, so it's easy to give up. Takes an exclusive lock on the file:
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # Check the file wasn't removed by the previous holder just before it was locked:
+                if os.path.samestat(os.fstat(fd), os.stat(lock_path)):
+                    return fd
+            except (BlockingIOError, FileNotFoundError):
+                pass
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+            await asyncio.sleep(self.poll_interval)
+
+    def creating(self):
+        """
+        :return: the number of images being made right now, by any of the workers
+        """
+        count = 0
+        locks = os.path.join(self.path, 'locks')
+        for name in os.listdir(locks) if os.path.isdir(locks) else []:
+            try:
+                fd = os.open(os.path.join(locks, name), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                # Lock files left by workers that have gone can be locked, so aren't counted:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                count += 1
+            finally:
+                os.close(fd)
+        return count
+
+    def _write(self, path, payload):
+        # Write to a temporary file alongside, then rename it into place, so it appears all at once:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _evict(self, db, now):
+        # Once the images are over budget, drop expired entries, then the least recently (or frequently) used, until they fit.
+        # The entries just added are kept, as otherwise they would always be the least frequently used:
+        orphans = self._orphans(db)
+        entries, images, size = self._stats(db)
+        if size <= self.max_bytes:
+            return orphans
+        evicted = db.execute("DELETE FROM entries WHERE expires > 0 AND expires < ?", (now,)).rowcount
+        orphans += self._orphans(db)
+        entries, images, size = self._stats(db)
+        order = "accessed" if self.eviction == 'lru' else "hits, accessed"
+        while size > self.max_bytes:
+            # Drop a tenth of the entries at a time, plus one:
+            dropped = db.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries WHERE accessed < ? ORDER BY %s LIMIT ?)" % order,
+                (now, entries // 10 + 1)).rowcount
+            if dropped == 0:
+                break
+            evicted += dropped
+            orphans += self._orphans(db)
+            entries, images, size = self._stats(db)
+        if evicted:
+            SCREENSHOT_CACHE_EVICTIONS.inc(evicted)
+        return orphans
+
+    def _orphans(self, db):
+        # Drops the images that are no longer used from the index, returning their digests:
+        orphans = [row[0] for row in db.execute("SELECT digest FROM orphans WHERE digest NOT IN (SELECT digest FROM entries)")]
+        db.execute("DELETE FROM objects WHERE digest IN (SELECT digest FROM orphans WHERE digest NOT IN (SELECT digest FROM entries))")
+        db.execute("DELETE FROM orphans")
+        return orphans
+
+    def _stats(self, db):
+        entries, images, size = db.execute("SELECT entries, images, size FROM totals").fetchone()
+        return entries, images, size
+
+    def _report(self, db):
+        entries, images, size = self._stats(db)
+        SCREENSHOT_CACHE_SIZE.labels('entries').set(entries)
+        SCREENSHOT_CACHE_SIZE.labels('images').set(images)
+        SCREENSHOT_CACHE_SIZE.labels('bytes').set(size)
+
+    def stats(self):
+        """
+        :return: (entries, images, bytes) currently in the store
+        """
+        with self._lock:
+            return self._stats(self._db())
+
+
+# The shared store:
+screenshot_store = ScreenshotStore()
@@ -1,27 +1,78 @@
+"""
+Helpers for screenshots, including the image processing.
+
+Image work is CPU-bound, and full-page screenshots can be huge (e.g. 1366x20000 pixels), so the async
+functions here do it in a pool of IMAGE_PROCESSES separate processes, rather than holding up the event
+loop. The processes are started fresh rather than forked, and only need to import this module, so it
+avoids importing anything heavy at the top level.
+
+Decoded images take up a lot of memory, so jobs are only started while the images being worked on add
+up to no more than IMAGE_PIXEL_BUDGET pixels, and otherwise wait their turn (though an image bigger than
+the whole budget still gets done, on its own). Within a job, each image is decoded once, and all the sizes
+wanted are made from that, each from the one before, shrinking by whole factors with Image.reduce before
+resampling the rest of the way.
+
+Images can be saved as JPEG, PNG or WebP, and as AVIF if Pillow supports it (Pillow 11.2 onwards, or with
+the pillow-avif-plugin package installed).
+"""
 import io
 import os
+import atexit
+import asyncio
 import requests
 import logging
 import datetime
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 from PIL import Image
+from prometheus_client import Gauge
 from warcio import WARCWriter
 from warcio.recordloader import ArcWarcRecordLoader
 from warcio.bufferedreaders import DecompressingBufferedReader
 
-from access_api.cdx import lookup_in_cdx, list_from_cdx
+# Older versions of Pillow need a plugin for AVIF, which registers itself on import:
+try:
+    import pillow_avif
+except ImportError:
+    pass
+
+IMAGE_PROCESSES = int(os.environ.get("IMAGE_PROCESSES", 2))
+IMAGE_PIXEL_BUDGET = int(os.environ.get("IMAGE_PIXEL_BUDGET", 100*1000*1000))
+
+# The formats images can be saved in, and how Pillow and HTTP call them:
+FORMATS = {
+    'jpg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'),
+}
+Image.init()
+if 'AVIF' in Image.SAVE:
+    FORMATS['avif'] = ('AVIF', 'image/avif')
 
 # Create a logger, beneath the Uvicorn error logger:
 logger = logging.getLogger(f"uvicorn.error.{__name__}")
 
+IMAGE_JOBS = Gauge('ukwa_api_image_jobs', 'Image processing jobs, by state (running or waiting).',
+    labelnames=('state',), multiprocess_mode='livesum')
+IMAGE_PIXELS = Gauge('ukwa_api_image_pixels', 'Pixels in the images currently being processed.', multiprocess_mode='livesum')
+
 
 def get_rendered_original_list(url, render_type='screenshot'):
+    # Imported here, so the image processes don't have to:
+    from .cdx import index_from_cdx
+
     # Query URL
     qurl = "%s:%s" % (render_type, url)
 
-    return list_from_cdx(qurl)
+    return index_from_cdx(qurl)
 
 
 def get_rendered_original(url, render_type='screenshot', target_date=datetime.datetime.today()):
+    # Imported here, so the image processes don't have to:
+    from .cdx import lookup_in_cdx
+
     # Query URL
     qurl = "%s:%s" % (render_type, url)
     # Query CDX Server for the item
@@ -32,6 +83,9 @@ def get_rendered_original(url, render_type='screenshot', target_date=datetime.da
 
 
 def get_original(url, target_date=datetime.datetime.today()):
+    # Imported here, so the image processes don't have to:
+    from .cdx import lookup_in_cdx
+
     # Query URL
     qurl = "url"
     # Query CDX Server for the item
@@ -41,33 +95,93 @@ def get_original(url, target_date=datetime.datetime.today()):
     return warc_filename, warc_offset, compressedendoffset
 
 
-def full_and_thumb_jpegs(large_png, crop=False):
-    # Load the image and drop the alpha channel:
-    img = Image.open(io.BytesIO(large_png))
-    img = remove_transparency(img)
-    img = img.convert("RGB")
+def open_image(source, rows=None):
+    """
+    Opens an image, from a file path or bytes.
 
-    # Crop if needed:
-    w, h = img.size
-    logger.debug("IMAGE %i x %x" % (w, h))
-    if crop and h > 640:
-        img = img.crop((0,0,w,640))
+    If only the first few rows are needed, e.g. to crop off the top of a tall screenshot, only those rows
+    of a PNG are decoded, rather than the whole thing.
+    """
+    img = Image.open(source if isinstance(source, str) else io.BytesIO(source))
+    if rows is not None:
+        limit_rows(img, rows)
+    return img
+
+
+def limit_rows(img, rows):
+    """
+    Makes an opened (but not yet loaded) PNG only decode its first few rows, where possible.
+    """
+    if rows < img.height and img.format == 'PNG' and len(img.tile) == 1 and not img.info.get('interlace'):
+        # PNGs are decoded from the top down, so just stop early:
+        decoder, extents, offset, args = img.tile[0]
+        img._size = (img.width, rows)
+        img.tile = [(decoder, (0, 0, img.width, rows), offset, args)]
 
-    # Save it as a JPEG:
-    out = io.BytesIO()
-    img.save(out, "jpeg", quality=95)
-    full_jpeg = out.getvalue()
 
-    thumb_width = 300
-    thumb_height = int((float(thumb_width) / w) * h)
-    logger.debug("Got %i x %x" % (thumb_width, thumb_height))
-    img.thumbnail((thumb_width, thumb_height))
+def image_size(source):
+    """
+    Reads the size of an image from its header, from a file path or bytes.
+    """
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img:
+        return img.size
 
+
+def encode(img, format, quality=95):
+    """
+    :return: the image, in the given format (one of FORMATS)
+    """
     out = io.BytesIO()
-    img.save(out, "jpeg", quality=95)
-    thumb_jpeg = out.getvalue()
+    if format == 'png':
+        img.save(out, 'PNG')
+    else:
+        img.save(out, FORMATS[format][0], quality=quality)
+    return out.getvalue()
+
+
+def resized_versions(image, widths, formats=('jpg',), crop=None, quality=95):
+    """
+    Makes versions of an image at several widths (None meaning the full width, and never enlarging it)
+    and in several formats, from a single decode, optionally cropping it to the top `crop` rows first.
+
+    :return: {(width, format): image}, keyed by the widths as given
+    """
+    img = open_image(image)
+    w, h = img.size
+    if crop and h > crop:
+        # Only decode the top of the image:
+        limit_rows(img, crop)
+        h = crop
+    sizes = {width: min(width or w, w) for width in widths}
+    largest = max(sizes.values())
+    # JPEGs can be decoded at a reduced size straight away, if the full size isn't needed:
+    if largest < w:
+        img.draft('RGB', (largest, max(round(largest * img.height / w), 1)))
+    img = to_rgb(img)
+    if img.height > round(img.width * h / w):
+        img = img.crop((0, 0, img.width, round(img.width * h / w)))
+
+    versions = {}
+    for size in sorted(set(sizes.values()), reverse=True):
+        # Each size is made from the one before, which is less work than going back to the original:
+        target = (size, max(round(size * h / w), 1))
+        if img.size != target:
+            img = img.resize(target, Image.LANCZOS, reducing_gap=2.0)
+        for format in formats:
+            versions[(size, format)] = encode(img, format, quality)
+    return {(width, format): versions[(size, format)] for width, size in sizes.items() for format in formats}
+
 
-    return full_jpeg, thumb_jpeg
+def full_and_thumb_jpegs(large_png, crop=False):
+    versions = resized_versions(large_png, [None, 300], crop=640 if crop else None)
+    return versions[(None, 'jpg')], versions[(300, 'jpg')]
+
+
+def thumb_jpeg(image, thumb_width=300, crop=False):
+    """
+    Makes just the thumbnail JPEG of an image, decoding no more of it than needed.
+    """
+    return resized_versions(image, [thumb_width], crop=640 if crop else None)[(thumb_width, 'jpg')]
 
 
 def remove_transparency(im, bg_colour=(255, 255, 255)):
@@ -86,3 +200,112 @@ def remove_transparency(im, bg_colour=(255, 255, 255)):
 
     else:
         return im
+
+
+def to_rgb(im, bg_colour=(255, 255, 255)):
+    """
+    Flattens an image onto a plain background, as RGB, like remove_transparency(im).convert('RGB') but
+    without the copies, and without compositing at all if the alpha channel is fully opaque (as it is in
+    most screenshots).
+    """
+    if im.mode in ('RGBA', 'LA'):
+        alpha = im.getchannel('A')
+    elif im.mode == 'P' and 'transparency' in im.info:
+        im = im.convert('RGBA')
+        alpha = im.getchannel('A')
+    else:
+        return im if im.mode == 'RGB' else im.convert('RGB')
+    # Checking the alpha channel is much cheaper than compositing:
+    if alpha.getextrema()[0] == 255:
+        return im.convert('RGB')
+    bg = Image.new('RGB', im.size, bg_colour)
+    bg.paste(im.convert('RGB'), mask=alpha)
+    return bg
+
+
+class PixelBudget:
+    """
+    Limits the total number of pixels in the images being worked on at once.
+    """
+
+    def __init__(self, budget=IMAGE_PIXEL_BUDGET):
+        self.budget = budget
+        self.in_use = 0
+        self._condition = None
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, pixels):
+        # An image bigger than the whole budget has to wait until nothing else is running:
+        pixels = min(pixels, self.budget)
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            IMAGE_JOBS.labels('waiting').inc()
+            try:
+                await self._condition.wait_for(lambda: self.in_use + pixels <= self.budget)
+            finally:
+                IMAGE_JOBS.labels('waiting').dec()
+            self.in_use += pixels
+        IMAGE_JOBS.labels('running').inc()
+        IMAGE_PIXELS.inc(pixels)
+        try:
+            yield
+        finally:
+            IMAGE_JOBS.labels('running').dec()
+            IMAGE_PIXELS.dec(pixels)
+            async with self._condition:
+                self.in_use -= pixels
+                self._condition.notify_all()
+
+
+_pool = None
+_budget = PixelBudget()
+
+
+def get_pool():
+    """
+    Returns the process pool for image work, starting it if needed.
+
+    It is shut down when the process exits, but multiprocessing child processes skip that, and
+    wait for the pool's processes to finish instead, so they must call close_pool() themselves.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(IMAGE_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        atexit.register(close_pool)
+    return _pool
+
+
+def close_pool():
+    """
+    Shuts down the process pool, if it was started.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        atexit.unregister(close_pool)
+
+
+async def run_image_job(pixels, function, *args):
+    """
+    Runs a function in the process pool, once there's room in the pixel budget, without blocking the event loop.
+    """
+    async with _budget.reserve(pixels):
+        return await asyncio.get_running_loop().run_in_executor(get_pool(), function, *args)
+
+
+async def full_and_thumb_jpegs_async(large_png, crop=False):
+    """
+    Makes the full and thumbnail JPEGs, in the process pool.
+    """
+    w, h = image_size(large_png)
+    return await run_image_job(w * (min(h, 640) if crop else h), full_and_thumb_jpegs, large_png, crop)
+
+
+async def thumb_jpeg_async(image, thumb_width=300, crop=False):
+    """
+    Makes just the thumbnail JPEG, in the process pool.
+    """
+    w, h = image_size(image)
+    return await run_image_job(w * (min(h, 640) if crop else h), thumb_jpeg, image, thumb_width, crop)
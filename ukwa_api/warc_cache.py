@@ -0,0 +1,219 @@
+"""
+Block-level caching of reads from WARC files in remote storage (e.g. WebHDFS).
+
+Rather than each WARC record being fetched with its own call to the storage, WARC files are read in
+fixed-size blocks (WARC_CACHE_BLOCK_SIZE), which are kept in a size-bounded LRU cache on local disk
+shared by all the workers. This helps when the same few WARC files get a lot of small reads, e.g.
+the screenshot records read when rendering with source=original.
+
+Only remote storage is cached (see warc_storage). Block fetches are coalesced: requests for the same block share one fetch, and requests for
+adjacent blocks of the same file that arrive close together (within WARC_CACHE_COALESCE_DELAY
+seconds) are merged into a single read. When a file is being read sequentially, the next
+WARC_CACHE_PREFETCH blocks are fetched ahead of time.
+
+The most recently used WARC_CACHE_MEMORY_BLOCKS blocks are also kept in memory by each worker.
+A short block (the end of a file, as far as the read could tell) may only be short because the file is still
+being written, so it is only cached for WARC_CACHE_PARTIAL_TTL seconds (0 for not at all), and not kept in memory.
+Reads of unknown length, or bigger than WARC_CACHE_MAX_READ, bypass the cache.
+
+The storage is pluggable, using the cachelib interface. WARC_CACHE_TYPE can be:
+
+- 'sqlite' for an LRU cache in a local SQLite file shared by all workers (the default),
+- 'memory' for an in-process LRU cache,
+- 'none' to disable caching (reads are still coalesced).
+"""
+import os
+import asyncio
+import logging
+
+import anyio
+import cachetools
+from cachelib import NullCache
+from prometheus_client import Counter
+
+from .warc_storage import ChunkResponse, WarcReadError, warc_storage
+from .access_cache import LRUCache
+from .cdx_cache import SQLiteCache
+
+CACHE_FOLDER = os.environ.get("CACHE_FOLDER", ".")
+WARC_CACHE_TYPE = os.environ.get("WARC_CACHE_TYPE", "sqlite")
+WARC_CACHE_PATH = os.environ.get("WARC_CACHE_PATH", os.path.join(CACHE_FOLDER, 'warc_cache.sqlite'))
+WARC_CACHE_MAX_BYTES = int(os.environ.get("WARC_CACHE_MAX_BYTES", 1024*1024*1024))
+WARC_CACHE_BLOCK_SIZE = int(os.environ.get("WARC_CACHE_BLOCK_SIZE", 1024*1024))
+WARC_CACHE_MAX_READ = int(os.environ.get("WARC_CACHE_MAX_READ", 16*1024*1024))
+WARC_CACHE_COALESCE_DELAY = float(os.environ.get("WARC_CACHE_COALESCE_DELAY", 0.002))
+WARC_CACHE_MAX_MERGED_BLOCKS = int(os.environ.get("WARC_CACHE_MAX_MERGED_BLOCKS", 16))
+WARC_CACHE_PREFETCH = int(os.environ.get("WARC_CACHE_PREFETCH", 1))
+WARC_CACHE_MEMORY_BLOCKS = int(os.environ.get("WARC_CACHE_MEMORY_BLOCKS", 32))
+WARC_CACHE_PARTIAL_TTL = int(os.environ.get("WARC_CACHE_PARTIAL_TTL", 60))
+
+# Create a logger, beneath the Uvicorn error logger:
+logger = logging.getLogger(f"uvicorn.error.{__name__}")
+
+# Cache metrics:
+WARC_CACHE_BLOCKS = Counter('ukwa_api_warc_cache_blocks', 'WARC file blocks read through the cache, by result (hit, miss, coalesced or prefetch).',
+    labelnames=('result',))
+WARC_CACHE_READS = Counter('ukwa_api_warc_cache_upstream_reads', 'Reads from WARC storage made by the WARC block cache.')
+
+
+def create_backend(cache_type=WARC_CACHE_TYPE):
+    """
+    Sets up the configured cache backend.
+    """
+    max_blocks = max(WARC_CACHE_MAX_BYTES // WARC_CACHE_BLOCK_SIZE, 1)
+    if cache_type == 'sqlite':
+        return SQLiteCache(WARC_CACHE_PATH, max_entries=max_blocks, max_bytes=WARC_CACHE_MAX_BYTES)
+    elif cache_type == 'memory':
+        return LRUCache(maxsize=max_blocks)
+    elif cache_type == 'none':
+        return NullCache()
+    raise ValueError(f"Unknown WARC_CACHE_TYPE: {cache_type}")
+
+
+class WarcBlockCache:
+    """
+    Reads byte ranges of WARC files through a cache of fixed-size blocks, coalescing the fetches.
+    """
+
+    def __init__(self, backend, storage, block_size=WARC_CACHE_BLOCK_SIZE, max_read=WARC_CACHE_MAX_READ,
+            coalesce_delay=WARC_CACHE_COALESCE_DELAY, max_merged_blocks=WARC_CACHE_MAX_MERGED_BLOCKS,
+            prefetch=WARC_CACHE_PREFETCH, memory_blocks=WARC_CACHE_MEMORY_BLOCKS, partial_ttl=WARC_CACHE_PARTIAL_TTL):
+        """
+        :param backend: the cachelib cache to keep blocks in
+        :param storage: the WARC storage to read the blocks from
+        """
+        self.backend = backend
+        self.storage = storage
+        self.block_size = block_size
+        self.max_read = max_read
+        self.coalesce_delay = coalesce_delay
+        self.max_merged_blocks = max_merged_blocks
+        self.prefetch = prefetch
+        self.partial_ttl = partial_ttl
+        # Block fetches in progress, and those waiting to be merged into reads, by (filename, block):
+        self._inflight = {}
+        self._pending = {}
+        self._flush = None
+        # Where recent reads of each file ended, to spot sequential reading:
+        self._read_ends = cachetools.LRUCache(1000)
+        # The most recently used blocks are also kept in memory, to save going to the backend for each record:
+        self._recent = cachetools.LRUCache(max(memory_blocks, 1))
+
+    def cacheable(self, length):
+        return length is not None and 0 < length <= self.max_read
+
+    async def open(self, filename, offset, length):
+        """
+        Starts reading length bytes from offset in a WARC file.
+
+        :return: a ChunkResponse, or raises WarcReadError if the start of the range could not be read
+        """
+        first_block = offset // self.block_size
+        last_block = (offset + length - 1) // self.block_size
+
+        # Spot sequential reading, and fetch ahead:
+        blocks = list(range(first_block, last_block + 1))
+        previous_end = self._read_ends.get(filename)
+        if previous_end is not None and previous_end <= first_block <= previous_end + 1:
+            blocks.extend(range(last_block + 1, last_block + 1 + self.prefetch))
+        self._read_ends[filename] = last_block
+
+        # Ask for all the blocks at once, so the fetches of any not cached get merged:
+        fetches = [await self._block(filename, block, prefetch=block > last_block) for block in blocks]
+        chunks = self._read(filename, offset, length, fetches[:last_block - first_block + 1])
+        try:
+            first_chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            first_chunk = b''
+        except Exception:
+            await chunks.aclose()
+            raise
+        return ChunkResponse(self.storage.describe(filename, offset, length), chunks, first_chunk=first_chunk)
+
+    async def _read(self, filename, offset, length, fetches):
+        # Passes on the requested bytes from each block in turn:
+        end = offset + length
+        first_block = offset // self.block_size
+        for i, fetch in enumerate(fetches):
+            start = (first_block + i) * self.block_size
+            # Shielded, so one reader giving up doesn't cancel the fetch for any others:
+            data = await asyncio.shield(fetch) if isinstance(fetch, asyncio.Future) else fetch
+            chunk = data[max(offset - start, 0):end - start]
+            if chunk:
+                yield chunk
+            if len(data) < self.block_size:
+                # The end of the file:
+                break
+
+    async def _block(self, filename, block, prefetch=False):
+        # Returns the block if cached, or the future of its fetch:
+        key = (filename, block)
+        if key in self._inflight:
+            if not prefetch:
+                WARC_CACHE_BLOCKS.labels('coalesced').inc()
+            return self._inflight[key]
+        data = self._recent.get(key)
+        if data is None:
+            data = await anyio.to_thread.run_sync(self.backend.get, "%s:%i" % key)
+            if data is not None and len(data) == self.block_size:
+                self._recent[key] = data
+        if data is not None:
+            if not prefetch:
+                WARC_CACHE_BLOCKS.labels('hit').inc()
+            return data
+        if key in self._inflight:
+            # Another request started fetching it in the meantime:
+            return self._inflight[key]
+        WARC_CACHE_BLOCKS.labels('prefetch' if prefetch else 'miss').inc()
+        fetch = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fetch
+        self._pending[key] = fetch
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._fetch_pending())
+        return fetch
+
+    async def _fetch_pending(self):
+        # Wait a moment for more requests to arrive, then fetch runs of adjacent blocks with one read each:
+        await asyncio.sleep(self.coalesce_delay)
+        pending, self._pending, self._flush = self._pending, {}, None
+        runs = []
+        for key in sorted(pending):
+            filename, block = key
+            run = runs[-1] if runs else None
+            if run and run[0] == filename and run[-1] == block - 1 and len(run) - 1 < self.max_merged_blocks:
+                run.append(block)
+            else:
+                runs.append([filename, block])
+        await asyncio.gather(*[self._fetch_run(run[0], run[1:]) for run in runs])
+
+    async def _fetch_run(self, filename, blocks):
+        keys = [(filename, block) for block in blocks]
+        try:
+            WARC_CACHE_READS.inc()
+            data = await self.storage.read(filename, blocks[0] * self.block_size, len(blocks) * self.block_size)
+            for i, key in enumerate(keys):
+                block = data[i * self.block_size:(i + 1) * self.block_size]
+                self._inflight[key].set_result(block)
+                if len(block) == self.block_size:
+                    # Whole blocks don't change, so they never expire:
+                    self._recent[key] = block
+                    await anyio.to_thread.run_sync(self.backend.set, "%s:%i" % key, block, 0)
+                elif self.partial_ttl > 0:
+                    # But the file may grow past a short block, so that is only kept for a while:
+                    await anyio.to_thread.run_sync(self.backend.set, "%s:%i" % key, block, self.partial_ttl)
+        except Exception as e:
+            if not isinstance(e, WarcReadError):
+                logger.warning("Reading %s blocks %s failed: %s" % (filename, blocks, e))
+            for key in keys:
+                fetch = self._inflight[key]
+                if not fetch.done():
+                    fetch.set_exception(e)
+                    # Prefetched blocks may never be waited on, so don't complain about the error going unseen:
+                    fetch.exception()
+        finally:
+            for key in keys:
+                self._inflight.pop(key, None)
+
+
+# The shared cache of WARC file blocks, for remote storage:
+warc_block_cache = WarcBlockCache(create_backend(), warc_storage)
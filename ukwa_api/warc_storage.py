@@ -0,0 +1,282 @@
+"""
+Pluggable storage backends for reading WARC records.
+
+WARC_STORAGE can be:
+
+- 'webhdfs' to use WebHDFS op=OPEN calls under WEBHDFS_PREFIX (the default, which also suits ukwa/warc-server),
+- 'http' to use plain HTTP GETs of WARC_HTTP_PREFIX plus the filename, with Range headers,
+- 'file' to read straight from local (or NFS-mounted) folders, listed in WARC_PATHS and separated by ':'
+  (e.g. integration-testing/webarchive/collections/test/archive).
+
+Files are found by the filename given in the CDX index, which is tried as a path within each of the
+WARC_PATHS folders, and then just by its name. Local files are memory-mapped, so each record is
+sliced straight out of the page cache that all the workers share, without any HTTP in between.
+"""
+import os
+import mmap
+import logging
+
+import anyio
+import cachetools
+
+from .clients import get_client
+
+WARC_STORAGE = os.environ.get("WARC_STORAGE", "webhdfs")
+
+# Get the WebHDFS service:
+WEBHDFS_PREFIX = os.environ.get('WEBHDFS_PREFIX', 'http://warc-server.api.wa.bl.uk/webhdfs/v1/by-filename/')
+WEBHDFS_USER = os.environ.get('WEBHDFS_USER', 'access')
+
+# Or a plain HTTP server, or local folders:
+WARC_HTTP_PREFIX = os.environ.get('WARC_HTTP_PREFIX', '')
+WARC_PATHS = os.environ.get('WARC_PATHS', '')
+
+# Size of the chunks to read local files in:
+WARC_FILE_CHUNK_SIZE = int(os.environ.get("WARC_FILE_CHUNK_SIZE", 1024*1024))
+
+# Create a logger, beneath the Uvicorn error logger:
+logger = logging.getLogger(f"uvicorn.error.{__name__}")
+
+
+class WarcReadError(Exception):
+    """
+    A read from WARC storage failed, with the status code it failed with.
+    """
+
+    def __init__(self, status_code, reason):
+        super().__init__("%s %s" % (status_code, reason))
+        self.status_code = status_code
+        self.reason = reason
+
+
+class ChunkResponse:
+    """
+    A stand-in for a streaming httpx response, passing on an async iterator of byte chunks.
+
+    If the chunks come from an upstream response, that is closed along with this.
+    """
+
+    def __init__(self, url, chunks=None, status_code=200, reason_phrase='OK', first_chunk=None, upstream=None):
+        self.url = url
+        self.status_code = status_code
+        self.reason_phrase = reason_phrase
+        self.headers = {}
+        self._chunks = chunks
+        self._first_chunk = first_chunk
+        self._upstream = upstream
+
+    async def aiter_raw(self, chunk_size=None):
+        if self._first_chunk:
+            chunk, self._first_chunk = self._first_chunk, None
+            yield chunk
+        if self._chunks is not None:
+            async for chunk in self._chunks:
+                yield chunk
+
+    aiter_bytes = aiter_raw
+
+    async def aread(self):
+        return b''.join([chunk async for chunk in self.aiter_raw()])
+
+    async def aclose(self):
+        if self._chunks is not None:
+            await self._chunks.aclose()
+        if self._upstream is not None:
+            await self._upstream.aclose()
+
+
+def webhdfs_url(warc_filename, warc_offset, length=None):
+    """
+    The WebHDFS URL for reading length bytes (or the rest of the file) from an offset in a WARC file.
+    """
+    url = "%s%s?op=OPEN&user.name=%s&offset=%s" % (WEBHDFS_PREFIX, warc_filename, WEBHDFS_USER, warc_offset)
+    if length and int(length) > 0:
+        url = "%s&length=%s" % (url, length)
+    return url
+
+
+class WebHdfsStorage:
+    """
+    Reads WARC records via WebHDFS.
+    """
+    # Reads go over the network, so are worth caching:
+    remote = True
+
+    def describe(self, filename, offset, length=None):
+        return webhdfs_url(filename, offset, length)
+
+    async def open(self, filename, offset, length=None):
+        """
+        Opens a streaming read of length bytes (or the rest of the file) from the offset.
+
+        :return: the (httpx-like) response, which the caller must close
+        """
+        client = get_client()
+        return await client.send(client.build_request('GET', self.describe(filename, offset, length)), stream=True)
+
+    async def read(self, filename, offset, length):
+        """
+        Reads length bytes from the offset, raising WarcReadError if that fails.
+        """
+        r = await get_client().get(self.describe(filename, offset, length))
+        if r.status_code not in (200, 206):
+            raise WarcReadError(r.status_code, r.reason_phrase)
+        return r.content
+
+
+class HttpRangeStorage:
+    """
+    Reads WARC records from a plain HTTP server, using Range requests.
+    """
+    remote = True
+
+    def __init__(self, prefix=WARC_HTTP_PREFIX):
+        self.prefix = prefix
+
+    def describe(self, filename, offset, length=None):
+        return "%s%s" % (self.prefix, filename.lstrip('/'))
+
+    def _request(self, filename, offset, length=None):
+        last = offset + length - 1 if length else ''
+        return get_client().build_request('GET', self.describe(filename, offset, length),
+            headers={ 'Range': 'bytes=%i-%s' % (offset, last), 'Accept-Encoding': 'identity' })
+
+    async def open(self, filename, offset, length=None):
+        r = await get_client().send(self._request(filename, offset, length), stream=True)
+        if r.status_code == 200 and offset > 0:
+            # The server ignored the Range header, and sent the whole file:
+            await r.aclose()
+            logger.warning("%s does not support Range requests." % r.url)
+            return ChunkResponse(r.url, status_code=501, reason_phrase='Range requests not supported')
+        if r.status_code == 206 and _range_start(r) != offset:
+            await r.aclose()
+            logger.warning("%s sent Content-Range %s when asked for %s." % (r.url, r.headers.get('Content-Range'), r.request.headers['Range']))
+            return ChunkResponse(r.url, status_code=502, reason_phrase='Unexpected Content-Range')
+        if length and r.status_code in (200, 206):
+            # The server may send more than was asked for (e.g. the whole file, if it ignored the Range), so stop at the length:
+            return ChunkResponse(r.url, _limit(r.aiter_raw(), length), status_code=r.status_code, reason_phrase=r.reason_phrase, upstream=r)
+        return r
+
+    async def read(self, filename, offset, length):
+        r = await self.open(filename, offset, length)
+        try:
+            if r.status_code not in (200, 206):
+                raise WarcReadError(r.status_code, r.reason_phrase)
+            return await r.aread()
+        finally:
+            await r.aclose()
+
+
+def _range_start(r):
+    # The first byte of a partial response, from its Content-Range (e.g. 'bytes 100-199/1000'):
+    unit, _, byte_range = r.headers.get('Content-Range', '').partition(' ')
+    first = byte_range.partition('-')[0]
+    return int(first) if unit == 'bytes' and first.isdigit() else None
+
+
+async def _limit(chunks, length):
+    # Passes on the first length bytes of the chunks:
+    remaining = length
+    async for chunk in chunks:
+        chunk = chunk[:remaining]
+        remaining -= len(chunk)
+        yield chunk
+        if remaining <= 0:
+            break
+
+
+class FileStorage:
+    """
+    Reads WARC records from local or NFS-mounted folders, via memory-mapping.
+    """
+    # Reads come from the page cache, so there's no point caching them again:
+    remote = False
+
+    def __init__(self, paths=WARC_PATHS, chunk_size=WARC_FILE_CHUNK_SIZE):
+        self.paths = [os.path.abspath(path) for path in paths.split(':') if path]
+        self.chunk_size = chunk_size
+        self._located = cachetools.LRUCache(10000)
+
+    def locate(self, filename):
+        """
+        Finds a WARC file in the folders.
+
+        :return: the path, or None if it can't be found
+        """
+        path = self._located.get(filename)
+        if path is not None:
+            return path
+        for folder in self.paths:
+            for candidate in (os.path.join(folder, filename.lstrip('/')), os.path.join(folder, os.path.basename(filename))):
+                # Don't go outside the folders:
+                candidate = os.path.abspath(candidate)
+                if candidate.startswith(folder + os.sep) and os.path.isfile(candidate):
+                    self._located[filename] = candidate
+                    return candidate
+        return None
+
+    def describe(self, filename, offset, length=None):
+        return "file://%s#%s-%s" % (self.locate(filename) or filename, offset, offset + length - 1 if length else '')
+
+    def _map(self, filename):
+        path = self.locate(filename)
+        if path is None:
+            raise WarcReadError(404, 'Not Found')
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapped
+
+    async def _chunks(self, mapped, offset, length, chunk_size):
+        # Slices the record out of the mapped file, chunk by chunk, in a thread in case it has to come off disk:
+        try:
+            if mapped is None:
+                return
+            end = len(mapped) if length is None else min(offset + length, len(mapped))
+            position = offset
+            while position < end:
+                chunk = await anyio.to_thread.run_sync(mapped.__getitem__, slice(position, min(position + chunk_size, end)))
+                position += len(chunk)
+                yield chunk
+        finally:
+            if mapped is not None:
+                mapped.close()
+
+    async def open(self, filename, offset, length=None):
+        try:
+            mapped = await anyio.to_thread.run_sync(self._map, filename)
+        except WarcReadError as e:
+            return ChunkResponse(self.describe(filename, offset, length), status_code=e.status_code, reason_phrase=e.reason)
+        if mapped is not None and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL, offset - offset % mmap.PAGESIZE)
+        return ChunkResponse(self.describe(filename, offset, length), self._chunks(mapped, offset, length, self.chunk_size),
+            status_code=206 if offset or length else 200)
+
+    async def read(self, filename, offset, length):
+        def read():
+            mapped = self._map(filename)
+            if mapped is None:
+                return b''
+            try:
+                return mapped[offset:offset + length]
+            finally:
+                mapped.close()
+        return await anyio.to_thread.run_sync(read)
+
+
+def create_storage(storage_type=WARC_STORAGE):
+    """
+    Sets up the configured storage backend.
+    """
+    if storage_type == 'webhdfs':
+        return WebHdfsStorage()
+    elif storage_type == 'http':
+        return HttpRangeStorage()
+    elif storage_type == 'file':
+        return FileStorage()
+    raise ValueError(f"Unknown WARC_STORAGE: {storage_type}")
+
+
+# The configured storage:
+warc_storage = create_storage()